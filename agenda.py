@@ -1,131 +1,676 @@
 import sqlite3
+import argparse
+import csv
 import datetime
+import os
+import queue
+import re
+import sys
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import islice
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 
 # Nome do arquivo do banco de dados.
 NOME_DB = 'agenda.db'
+# Tarefas lidas por vez ao rolar a lista completa
+TAMANHO_PAGINA = 500
+# Linhas mantidas na lista completa; acima disso as páginas mais longe da rolagem
+# saem da tela e são lidas de novo se o usuário voltar até elas
+MAXIMO_LINHAS_LISTA = 4 * TAMANHO_PAGINA
+# Máximo de resultados exibidos em uma busca por texto
+LIMITE_BUSCA = 500
+# Linhas gravadas por executemany (e por aviso de progresso) na importação e na exportação
+TAMANHO_LOTE = 1000
 
-def conectar_bd():
-    """Cria e retorna uma conexão com o banco de dados."""
+SITUACAO_PENDENTE = "Não feito"
+SITUACAO_FEITA = "Feito"
+
+# Formato das datas digitadas e exibidas; no banco elas ficam em ISO (AAAA-MM-DD).
+FORMATO_DATA = '%d-%m-%Y'
+
+def data_para_iso(valor):
+    """Converte uma data (date, 'AAAA-MM-DD' ou 'DD-MM-AAAA') para ISO; vazio vira None."""
+    if not valor:
+        return None
+    if isinstance(valor, datetime.date):
+        return valor.isoformat()
+    try:
+        return datetime.date.fromisoformat(valor).isoformat()
+    except ValueError:
+        return datetime.datetime.strptime(valor, FORMATO_DATA).date().isoformat()
+
+def data_para_exibicao(valor_iso):
+    """Converte uma data ISO do banco para DD-MM-AAAA."""
+    if not valor_iso:
+        return ""
     try:
-        conn = sqlite3.connect(NOME_DB)
-        return conn
-    except sqlite3.Error as e:
-        messagebox.showerror("Erro de Conexão", f"Erro ao conectar ao banco de dados: {e}")
+        return datetime.date.fromisoformat(valor_iso).strftime(FORMATO_DATA)
+    except ValueError:
+        return valor_iso
+
+def migracao_tabela_tarefas(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tarefas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL,
+            descricao TEXT,
+            data_inicial TEXT NOT NULL,
+            data_final TEXT,
+            tipo_de_tarefa TEXT,
+            situacao TEXT NOT NULL
+        )
+    """)
+
+def migracao_datas_iso(conn):
+    """Converte as datas DD-MM-AAAA para AAAA-MM-DD e cria os índices de data e situação.
+
+    Cada data passa por data_para_iso, que também aceita as sem zeros à esquerda
+    (como 1-5-2025). As que não puderem ser lidas (como 31-02-2025) ficam como
+    estão e são listadas em stderr.
+    """
+    for coluna in ('data_inicial', 'data_final'):
+        linhas = conn.execute(f"SELECT id, {coluna} FROM tarefas WHERE {coluna} IS NOT NULL AND {coluna} != ''")
+        convertidas = []
+        for id_tarefa, valor in linhas.fetchall():
+            try:
+                valor_iso = data_para_iso(str(valor).strip())
+            except ValueError:
+                print(f"tarefa {id_tarefa}: {coluna} '{valor}' não é uma data válida e não foi convertida",
+                      file=sys.stderr)
+                continue
+            if valor_iso != valor:
+                convertidas.append((valor_iso, id_tarefa))
+        conn.executemany(f"UPDATE tarefas SET {coluna} = ? WHERE id = ?", convertidas)
+    conn.execute("UPDATE tarefas SET data_final = NULL WHERE data_final = ''")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tarefas_data_inicial ON tarefas (data_inicial)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tarefas_data_final ON tarefas (data_final)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tarefas_situacao_data_final ON tarefas (situacao, data_final)")
+
+def migracao_busca_textual(conn):
+    """Cria o índice FTS5 de nome, descrição e tipo, mantido em sincronia por triggers."""
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS tarefas_fts USING fts5(
+            nome,
+            descricao,
+            tipo_de_tarefa,
+            content = 'tarefas',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS tarefas_fts_insert AFTER INSERT ON tarefas BEGIN
+            INSERT INTO tarefas_fts (rowid, nome, descricao, tipo_de_tarefa)
+            VALUES (new.id, new.nome, new.descricao, new.tipo_de_tarefa);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS tarefas_fts_delete AFTER DELETE ON tarefas BEGIN
+            INSERT INTO tarefas_fts (tarefas_fts, rowid, nome, descricao, tipo_de_tarefa)
+            VALUES ('delete', old.id, old.nome, old.descricao, old.tipo_de_tarefa);
+        END
+    """)
+    # Só as colunas indexadas disparam a atualização; marcar como feita não mexe no índice
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS tarefas_fts_update AFTER UPDATE OF nome, descricao, tipo_de_tarefa ON tarefas BEGIN
+            INSERT INTO tarefas_fts (tarefas_fts, rowid, nome, descricao, tipo_de_tarefa)
+            VALUES ('delete', old.id, old.nome, old.descricao, old.tipo_de_tarefa);
+            INSERT INTO tarefas_fts (rowid, nome, descricao, tipo_de_tarefa)
+            VALUES (new.id, new.nome, new.descricao, new.tipo_de_tarefa);
+        END
+    """)
+    # Indexa as tarefas cadastradas antes da busca existir
+    conn.execute("INSERT INTO tarefas_fts (tarefas_fts) VALUES ('rebuild')")
+
+# Migrações aplicadas em ordem; a versão do banco fica em PRAGMA user_version.
+MIGRACOES = [
+    (1, migracao_tabela_tarefas),
+    (2, migracao_datas_iso),
+    (3, migracao_busca_textual),
+]
+
+def montar_consulta_fts(texto):
+    """Converte o texto digitado em uma consulta FTS5 sem operadores; a última palavra aceita prefixo."""
+    termos = [termo.replace('"', '""') for termo in texto.split()]
+    if not termos:
         return None
+    return ' '.join(f'"{termo}"' for termo in termos) + '*'
 
-def inicializar_bd():
-    """Cria a tabela de tarefas se ela ainda não existir."""
-    conn = conectar_bd()
-    if conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS tarefas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nome TEXT NOT NULL,
-                descricao TEXT,
-                data_inicial TEXT NOT NULL,
-                data_final TEXT,
-                tipo_de_tarefa TEXT,
-                situacao TEXT NOT NULL
-            )
-        """)
-        conn.commit()
-        conn.close()
-
-def cadastrar_tarefa(nome, descricao, data_inicial, data_final, tipo_de_tarefa):
-    """Insere uma nova tarefa no banco de dados."""
-    situacao = "Não feito"
-    conn = conectar_bd()
-    if conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute("""
+class TarefaRepository:
+    """Acesso às tarefas por meio de uma única conexão de longa duração (modo WAL).
+
+    Não depende da interface gráfica: os erros do SQLite são propagados como
+    sqlite3.Error e as operações retornam ids ou a quantidade de linhas
+    alteradas. As operações em lote rodam em uma única transação.
+
+    As datas são gravadas em ISO (AAAA-MM-DD), que ordena como texto, então as
+    consultas por período usam os índices de data_inicial e data_final.
+    """
+
+    def __init__(self, caminho=NOME_DB):
+        self.caminho = caminho
+        self.conn = sqlite3.connect(caminho)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.inicializar()
+
+    def inicializar(self):
+        """Cria a tabela de tarefas e aplica as migrações pendentes."""
+        versao = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for numero, migracao in MIGRACOES:
+            if numero <= versao:
+                continue
+            with self.conn:
+                migracao(self.conn)
+                self.conn.execute(f"PRAGMA user_version = {numero}")
+
+    def fechar(self):
+        """Fecha a conexão com o banco de dados."""
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excecao):
+        self.fechar()
+
+    def cadastrar(self, nome, descricao, data_inicial, data_final, tipo_de_tarefa):
+        """Insere uma nova tarefa e retorna o seu id."""
+        with self.conn:
+            cursor = self.conn.execute("""
+                INSERT INTO tarefas (nome, descricao, data_inicial, data_final, tipo_de_tarefa, situacao)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (nome, descricao, data_para_iso(data_inicial), data_para_iso(data_final),
+                  tipo_de_tarefa, SITUACAO_PENDENTE))
+        return cursor.lastrowid
+
+    def cadastrar_varias(self, tarefas):
+        """Insere várias tarefas (nome, descricao, data_inicial, data_final, tipo) e retorna quantas foram gravadas."""
+        with self.conn:
+            cursor = self.conn.executemany("""
                 INSERT INTO tarefas (nome, descricao, data_inicial, data_final, tipo_de_tarefa, situacao)
                 VALUES (?, ?, ?, ?, ?, ?)
-            """, (nome, descricao, data_inicial, data_final, tipo_de_tarefa, situacao))
-            conn.commit()
-            messagebox.showinfo("Sucesso", "Tarefa cadastrada com sucesso!")
-        except sqlite3.Error as e:
-            messagebox.showerror("Erro de Cadastro", f"Erro ao cadastrar a tarefa: {e}")
-        finally:
-            conn.close()
-
-def ver_todas_as_tarefas():
-    """Busca e retorna todas as tarefas do banco de dados."""
-    conn = conectar_bd()
-    tarefas = []
-    if conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM tarefas ORDER BY data_inicial")
-        tarefas = cursor.fetchall()
-        conn.close()
-    return tarefas
-
-def buscar_tarefas_por_texto(texto_busca):
-    """Busca tarefas que contenham o texto_busca no nome ou na descrição."""
-    conn = conectar_bd()
-    tarefas = []
-    if conn:
-        cursor = conn.cursor()
-        termo_busca = f"%{texto_busca}%"
+            """, ((nome, descricao, data_para_iso(data_inicial), data_para_iso(data_final), tipo, SITUACAO_PENDENTE)
+                  for nome, descricao, data_inicial, data_final, tipo in tarefas))
+        return cursor.rowcount
+
+    def listar(self):
+        """Retorna todas as tarefas."""
+        return self.conn.execute("SELECT * FROM tarefas ORDER BY data_inicial").fetchall()
+
+    def listar_entre(self, inicio, fim):
+        """Retorna as tarefas que começam entre as datas inicio e fim (inclusive)."""
+        return self.conn.execute("""
+            SELECT * FROM tarefas
+            WHERE data_inicial BETWEEN ? AND ?
+            ORDER BY data_inicial
+        """, (data_para_iso(inicio), data_para_iso(fim))).fetchall()
+
+    def listar_da_semana(self, referencia=None):
+        """Retorna as tarefas que terminam na semana (segunda a domingo) da data de referência."""
+        referencia = referencia or datetime.date.today()
+        segunda = referencia - datetime.timedelta(days=referencia.weekday())
+        domingo = segunda + datetime.timedelta(days=6)
+        return self.conn.execute("""
+            SELECT * FROM tarefas
+            WHERE data_final BETWEEN ? AND ?
+            ORDER BY data_final
+        """, (segunda.isoformat(), domingo.isoformat())).fetchall()
+
+    def listar_atrasadas(self, hoje=None):
+        """Retorna as tarefas não feitas cuja data final já passou."""
+        hoje = hoje or datetime.date.today()
+        return self.conn.execute("""
+            SELECT * FROM tarefas
+            WHERE situacao = ? AND data_final < ?
+            ORDER BY data_final
+        """, (SITUACAO_PENDENTE, hoje.isoformat())).fetchall()
+
+    def listar_pagina(self, depois=None, limite=TAMANHO_PAGINA):
+        """Retorna até limite tarefas, em ordem de data, após a chave (data_inicial, id) informada.
+
+        A paginação por chave percorre o índice de data_inicial a partir do
+        ponto certo, então o custo de uma página não cresce com a posição dela.
+        """
+        if depois is None:
+            return self.conn.execute("""
+                SELECT * FROM tarefas ORDER BY data_inicial, id LIMIT ?
+            """, (limite,)).fetchall()
+        return self.conn.execute("""
+            SELECT * FROM tarefas
+            WHERE (data_inicial, id) > (?, ?)
+            ORDER BY data_inicial, id
+            LIMIT ?
+        """, (*depois, limite)).fetchall()
+
+    def listar_pagina_anterior(self, antes, limite=TAMANHO_PAGINA):
+        """Retorna até limite tarefas, em ordem de data, imediatamente antes da chave (data_inicial, id) informada."""
+        tarefas = self.conn.execute("""
+            SELECT * FROM tarefas
+            WHERE (data_inicial, id) < (?, ?)
+            ORDER BY data_inicial DESC, id DESC
+            LIMIT ?
+        """, (*antes, limite)).fetchall()
+        tarefas.reverse()
+        return tarefas
+
+    def obter(self, tarefa_id):
+        """Retorna a tarefa com o id informado, ou None."""
+        return self.conn.execute("SELECT * FROM tarefas WHERE id = ?", (tarefa_id,)).fetchone()
+
+    def buscar_por_texto(self, texto_busca, limite=-1):
+        """Retorna as tarefas cujo nome, descrição ou tipo contém as palavras de texto_busca.
+
+        A última palavra é tratada como prefixo, para a busca funcionar enquanto
+        o texto é digitado. Os resultados vêm ordenados por relevância.
+        """
+        consulta = montar_consulta_fts(texto_busca)
+        if consulta is None:
+            return []
+        return self.conn.execute("""
+            SELECT t.* FROM tarefas_fts f
+            JOIN tarefas t ON t.id = f.rowid
+            WHERE tarefas_fts MATCH ?
+            ORDER BY f.rank
+            LIMIT ?
+        """, (consulta, limite)).fetchall()
+
+    def remover(self, tarefa_id):
+        """Remove uma tarefa pelo id; retorna False se ela não existir."""
+        return self.remover_varias([tarefa_id]) == 1
+
+    def remover_varias(self, tarefa_ids):
+        """Remove as tarefas com os ids informados e retorna quantas foram removidas."""
+        with self.conn:
+            cursor = self.conn.executemany("DELETE FROM tarefas WHERE id = ?", ((tarefa_id,) for tarefa_id in tarefa_ids))
+        return cursor.rowcount
+
+    def marcar_como_feita(self, tarefa_id):
+        """Marca uma tarefa como feita; retorna False se ela não existir."""
+        return self.marcar_varias_como_feitas([tarefa_id]) == 1
+
+    def marcar_varias_como_feitas(self, tarefa_ids):
+        """Marca as tarefas com os ids informados como feitas e retorna quantas foram alteradas."""
+        with self.conn:
+            cursor = self.conn.executemany("UPDATE tarefas SET situacao = ? WHERE id = ?",
+                                           ((SITUACAO_FEITA, tarefa_id) for tarefa_id in tarefa_ids))
+        return cursor.rowcount
+
+    def apagar_nao_feitas(self):
+        """Remove todas as tarefas com a situação 'Não feito' e retorna quantas foram removidas."""
+        with self.conn:
+            cursor = self.conn.execute("DELETE FROM tarefas WHERE situacao = ?", (SITUACAO_PENDENTE,))
+        return cursor.rowcount
+
+    def iterar(self):
+        """Percorre todas as tarefas em ordem de data, sem carregá-las todas na memória."""
+        yield from self.conn.execute("SELECT * FROM tarefas ORDER BY data_inicial, id")
+
+    def importar(self, linhas, tamanho_lote=TAMANHO_LOTE, progresso=None):
+        """Grava as linhas (nome, descricao, data_inicial, data_final, tipo, situacao) em uma única transação.
+
+        As linhas são consumidas em lotes de tamanho_lote, então a memória usada
+        não depende do tamanho do arquivo. Linhas sem nome ou com datas inválidas
+        são recusadas; se ocorrer um sqlite3.Error, nada é gravado.
+        progresso(lidas) é chamado após cada lote.
+
+        Retorna (importadas, recusadas, erros), onde erros traz (registro, motivo)
+        das primeiras linhas recusadas.
+        """
+        lidas = importadas = recusadas = 0
+        erros = []
+        with self.conn:
+            for lote in em_lotes(linhas, tamanho_lote):
+                validas, recusadas_lote = validar_lote(lote, lidas + 1)
+                self.conn.executemany("""
+                    INSERT INTO tarefas (nome, descricao, data_inicial, data_final, tipo_de_tarefa, situacao)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, validas)
+                lidas += len(lote)
+                importadas += len(validas)
+                recusadas += len(recusadas_lote)
+                erros.extend(recusadas_lote[:10 - len(erros)])
+                if progresso:
+                    progresso(lidas)
+        return importadas, recusadas, erros
+
+# --- Importação e Exportação ---
+
+FORMATOS_ARQUIVO = ('csv', 'ics')
+# Colunas do CSV, na ordem em que são lidas e gravadas
+CAMPOS_CSV = ('nome', 'descricao', 'data_inicial', 'data_final', 'tipo_de_tarefa', 'situacao')
+
+def em_lotes(itens, tamanho):
+    """Agrupa um iterável em listas de até tamanho itens."""
+    itens = iter(itens)
+    while True:
+        lote = list(islice(itens, tamanho))
+        if not lote:
+            return
+        yield lote
+
+def validar_lote(lote, primeiro_registro=1):
+    """Normaliza as datas de um lote de linhas; retorna (linhas válidas, [(registro, motivo)]).
+
+    Cada data distinta do lote é convertida uma única vez, já que em agendas
+    grandes muitas tarefas compartilham as mesmas datas.
+    """
+    datas = {}
+    for _, _, data_inicial, data_final, _, _ in lote:
+        for texto in (data_inicial, data_final):
+            if texto not in datas:
+                try:
+                    datas[texto] = data_para_iso(texto)
+                except ValueError:
+                    datas[texto] = ValueError
+    validas, recusadas = [], []
+    for registro, (nome, descricao, data_inicial, data_final, tipo, situacao) in enumerate(lote, primeiro_registro):
+        inicio, fim = datas[data_inicial], datas[data_final]
+        if not nome:
+            recusadas.append((registro, "nome vazio"))
+        elif inicio is None or inicio is ValueError:
+            recusadas.append((registro, f"data inicial inválida: {data_inicial!r}"))
+        elif fim is ValueError:
+            recusadas.append((registro, f"data final inválida: {data_final!r}"))
+        else:
+            situacao = SITUACAO_FEITA if situacao.strip().lower() in ("feito", "feita") else SITUACAO_PENDENTE
+            validas.append((nome, descricao, inicio, fim, tipo, situacao))
+    return validas, recusadas
+
+def ler_csv(arquivo):
+    """Gera uma linha (nome, descricao, data_inicial, data_final, tipo, situacao) por registro de um CSV com cabeçalho."""
+    for registro in csv.DictReader(arquivo):
+        yield tuple((registro.get(campo) or "").strip() for campo in CAMPOS_CSV)
+
+def escrever_csv(tarefas, arquivo):
+    escritor = csv.writer(arquivo)
+    escritor.writerow(CAMPOS_CSV)
+    for tarefa in tarefas:
+        escritor.writerow([tarefa[campo] for campo in CAMPOS_CSV])
+
+def _linhas_ics(arquivo):
+    """Junta as linhas dobradas do iCalendar (as continuações começam com espaço ou tab)."""
+    atual = None
+    for linha in arquivo:
+        linha = linha.rstrip("\r\n")
+        if linha[:1] in (" ", "\t") and atual is not None:
+            atual += linha[1:]
+            continue
+        if atual:
+            yield atual
+        atual = linha
+    if atual:
+        yield atual
+
+def _texto_ics(valor):
+    return re.sub(r"\\([\\;,nN])", lambda m: "\n" if m.group(1) in "nN" else m.group(1), valor)
+
+def _escapar_ics(valor):
+    return (valor or "").replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def _data_ics(valor):
+    """Converte AAAAMMDD (ou AAAAMMDDTHHMMSS) em AAAA-MM-DD; a validação fica para validar_lote."""
+    return f"{valor[:4]}-{valor[4:6]}-{valor[6:8]}" if len(valor) >= 8 else valor
+
+def ler_ics(arquivo):
+    """Gera uma linha por VTODO ou VEVENT de um arquivo iCalendar.
+
+    Usa SUMMARY, DESCRIPTION, DTSTART, DUE (ou DTEND), CATEGORIES e STATUS.
+    O DTEND de um evento de dia inteiro é exclusivo, então vira o dia anterior.
+    """
+    componente = None
+    for linha in _linhas_ics(arquivo):
+        nome_propriedade, _, valor = linha.partition(":")
+        propriedade, *parametros = nome_propriedade.upper().split(";")
+        if propriedade == "BEGIN" and valor.upper() in ("VTODO", "VEVENT"):
+            componente, campos = valor.upper(), {}
+        elif componente is None:
+            continue
+        elif propriedade == "END" and valor.upper() == componente:
+            data_final = campos.get("DUE", campos.get("DTEND", ""))
+            if "DUE" not in campos and "DTEND" in campos and "VALUE=DATE" in campos["parametros_DTEND"]:
+                try:
+                    data_final = (datetime.date.fromisoformat(data_final) - datetime.timedelta(days=1)).isoformat()
+                except ValueError:
+                    pass
+            concluida = campos.get("STATUS", "").upper() == "COMPLETED" or "COMPLETED" in campos
+            yield (campos.get("SUMMARY", "").strip(), campos.get("DESCRIPTION", ""), campos.get("DTSTART", ""),
+                   data_final, campos.get("CATEGORIES", ""), SITUACAO_FEITA if concluida else SITUACAO_PENDENTE)
+            componente = None
+        elif propriedade in ("DTSTART", "DUE", "DTEND"):
+            campos[propriedade] = _data_ics(valor.strip())
+            campos["parametros_" + propriedade] = parametros
+        elif propriedade in ("SUMMARY", "DESCRIPTION", "CATEGORIES", "STATUS", "COMPLETED"):
+            campos[propriedade] = _texto_ics(valor)
+
+def _dobrar_ics(linha):
+    """Quebra a linha em pedaços de até 75 bytes, como exige o iCalendar."""
+    if len(linha.encode("utf-8")) <= 75:
+        return linha + "\r\n"
+    pedacos, atual, tamanho = [], "", 0
+    for caractere in linha:
+        bytes_caractere = len(caractere.encode("utf-8"))
+        if tamanho + bytes_caractere > 75:
+            pedacos.append(atual)
+            atual, tamanho = " ", 1
+        atual += caractere
+        tamanho += bytes_caractere
+    pedacos.append(atual)
+    return "\r\n".join(pedacos) + "\r\n"
+
+def escrever_ics(tarefas, arquivo):
+    """Grava as tarefas como VTODOs de dia inteiro."""
+    carimbo = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    arquivo.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Agenda de Tarefas//PT-BR\r\n")
+    for tarefa in tarefas:
+        linhas = ["BEGIN:VTODO", f"UID:tarefa-{tarefa['id']}@agenda", f"DTSTAMP:{carimbo}",
+                  f"SUMMARY:{_escapar_ics(tarefa['nome'])}"]
+        if tarefa["descricao"]:
+            linhas.append(f"DESCRIPTION:{_escapar_ics(tarefa['descricao'])}")
+        for propriedade, coluna in (("DTSTART", "data_inicial"), ("DUE", "data_final")):
+            if tarefa[coluna]:
+                linhas.append(f"{propriedade};VALUE=DATE:{tarefa[coluna].replace('-', '')}")
+        if tarefa["tipo_de_tarefa"]:
+            linhas.append(f"CATEGORIES:{_escapar_ics(tarefa['tipo_de_tarefa'])}")
+        linhas.append("STATUS:COMPLETED" if tarefa["situacao"] == SITUACAO_FEITA else "STATUS:NEEDS-ACTION")
+        linhas.append("END:VTODO")
+        arquivo.write("".join(_dobrar_ics(linha) for linha in linhas))
+    arquivo.write("END:VCALENDAR\r\n")
+
+def formato_do_arquivo(caminho_arquivo, formato=None):
+    formato = (formato or os.path.splitext(caminho_arquivo)[1].lstrip(".")).lower()
+    if formato not in FORMATOS_ARQUIVO:
+        raise ValueError(f"Formato não suportado: {caminho_arquivo!r} (use .csv ou .ics).")
+    return formato
+
+def importar_arquivo(repositorio, caminho_arquivo, formato=None, progresso=None):
+    """Importa um arquivo CSV ou iCalendar; retorna o mesmo que TarefaRepository.importar."""
+    formato = formato_do_arquivo(caminho_arquivo, formato)
+    with open(caminho_arquivo, encoding="utf-8-sig", newline="") as arquivo:
+        linhas = ler_csv(arquivo) if formato == "csv" else ler_ics(arquivo)
+        return repositorio.importar(linhas, progresso=progresso)
+
+def exportar_arquivo(repositorio, caminho_arquivo, formato=None, progresso=None):
+    """Exporta todas as tarefas para um arquivo CSV ou iCalendar e retorna quantas foram gravadas."""
+    formato = formato_do_arquivo(caminho_arquivo, formato)
+    total = 0
+
+    def contar(tarefas):
+        nonlocal total
+        for total, tarefa in enumerate(tarefas, 1):
+            yield tarefa
+            if progresso and total % TAMANHO_LOTE == 0:
+                progresso(total)
+
+    with open(caminho_arquivo, "w", encoding="utf-8", newline="") as arquivo:
+        escrever = escrever_csv if formato == "csv" else escrever_ics
+        escrever(contar(repositorio.iterar()), arquivo)
+    return total
+
+# --- Leitura em Segundo Plano ---
+
+class LeitorTarefas:
+    """Executa as consultas de leitura da interface em uma thread com conexão própria.
+
+    Um pedido é o nome de um método de TarefaRepository seguido dos argumentos.
+    Só o pedido mais recente interessa: um pedido novo interrompe a consulta em
+    andamento (Connection.interrupt) e os resultados de pedidos antigos são
+    descartados. Os últimos resultados ficam em um LRU, esvaziado por
+    invalidar() sempre que as tarefas mudam.
+    """
+
+    def __init__(self, caminho=NOME_DB, tamanho_cache=32):
+        self.caminho = caminho
+        self.tamanho_cache = tamanho_cache
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.geracao = 0
+        self.versao_dados = 0
+        self.conn_leitura = None
+        self.pedidos = queue.Queue()
+        self.resultados = queue.Queue()
+        self.thread = threading.Thread(target=self._executar, name="leitor-tarefas", daemon=True)
+        self.thread.start()
+
+    def consultar(self, *pedido):
+        """Agenda o pedido; retorna o resultado na hora se ele estiver no cache."""
+        with self.lock:
+            self.geracao += 1
+            if pedido in self.cache:
+                self.cache.move_to_end(pedido)
+                return self.cache[pedido]
+            item = (self.geracao, self.versao_dados, pedido)
+        self._interromper()
+        self.pedidos.put(item)
+        return None
+
+    def cancelar(self):
+        """Descarta o pedido pendente, se houver."""
+        with self.lock:
+            self.geracao += 1
+        self._interromper()
+
+    def invalidar(self):
+        """Esvazia o cache; deve ser chamado depois de qualquer alteração nas tarefas."""
+        with self.lock:
+            self.versao_dados += 1
+            self.cache.clear()
+
+    def resultado_pronto(self):
+        """Retorna (pedido, versao_dados, resultado) do último pedido concluído, ou None.
+
+        O resultado é uma lista de tarefas ou o sqlite3.Error da consulta. Se
+        versao_dados for diferente da atual, as tarefas mudaram enquanto a
+        consulta rodava e o pedido deve ser refeito.
+        """
+        resultado = None
+        while True:
+            try:
+                resultado = self.resultados.get_nowait()
+            except queue.Empty:
+                return resultado
+
+    def fechar(self):
+        self.cancelar()
+        self.pedidos.put(None)
+
+    def _interromper(self):
+        conn = self.conn_leitura
+        if conn is not None:
+            conn.interrupt()
+
+    def _executar(self):
+        repositorio = TarefaRepository(self.caminho)
+        self.conn_leitura = repositorio.conn
+        while True:
+            item = self.pedidos.get()
+            # Enquanto a consulta anterior rodava, outras podem ter chegado: só a última vale
+            while not self.pedidos.empty():
+                item = self.pedidos.get()
+            if item is None:
+                break
+            geracao, versao, pedido = item
+            if geracao != self.geracao:
+                continue
+            try:
+                resultado = self._consultar(repositorio, geracao, pedido)
+            except sqlite3.Error as erro:
+                resultado = erro
+            if resultado is None:
+                continue
+            with self.lock:
+                if versao == self.versao_dados and not isinstance(resultado, sqlite3.Error):
+                    self.cache[pedido] = resultado
+                    if len(self.cache) > self.tamanho_cache:
+                        self.cache.popitem(last=False)
+                if geracao != self.geracao:
+                    continue
+            self.resultados.put((pedido, versao, resultado))
+        self.conn_leitura = None
+        repositorio.fechar()
+
+    def _consultar(self, repositorio, geracao, pedido):
+        metodo, argumentos = getattr(repositorio, pedido[0]), pedido[1:]
         try:
-            cursor.execute("""
-                SELECT * FROM tarefas 
-                WHERE nome LIKE ? OR descricao LIKE ?
-                ORDER BY data_inicial
-            """, (termo_busca, termo_busca))
-            tarefas = cursor.fetchall()
-        except sqlite3.Error as e:
-            messagebox.showerror("Erro de Busca", f"Erro ao buscar tarefas: {e}")
-        finally:
-            conn.close()
-    return tarefas
-
-def remover_tarefa(tarefa_id):
-    """Remove uma tarefa do banco de dados pelo ID."""
-    conn = conectar_bd()
-    if conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM tarefas WHERE id = ?", (tarefa_id,))
-        conn.commit()
-        conn.close()
-        messagebox.showinfo("Sucesso", "Tarefa removida com sucesso!")
-
-def apagar_tarefas_nao_feitas():
-    """Remove todas as tarefas com a situação 'Não feito'."""
-    conn = conectar_bd()
-    if conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM tarefas WHERE situacao = 'Não feito'")
-        conn.commit()
-        messagebox.showinfo("Limpeza", "Todas as tarefas não feitas foram removidas.")
-        conn.close()
-
-def marcar_como_feita(tarefa_id):
-    """Atualiza a situação de uma tarefa para 'Feito'."""
-    conn = conectar_bd()
-    if conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE tarefas SET situacao = 'Feito' WHERE id = ?", (tarefa_id,))
-        conn.commit()
-        conn.close()
-        messagebox.showinfo("Atualização", "Tarefa marcada como Feita!")
+            return metodo(*argumentos)
+        except sqlite3.OperationalError as erro:
+            if geracao != self.geracao:
+                return None
+            if "interrupted" not in str(erro):
+                raise
+            # A interrupção era para a consulta anterior e alcançou esta
+            return metodo(*argumentos)
 
 # --- Classe da Interface Gráfica ---
 
 class AgendaApp(tk.Tk):
-    def __init__(self):
+    def __init__(self, caminho=NOME_DB):
         super().__init__()
         self.title("Agenda de Tarefas")
-        self.geometry("650x550")
+        self.geometry("800x600")
+
+        self.repositorio = TarefaRepository(caminho)
+        self.leitor = LeitorTarefas(self.repositorio.caminho)
+        self.busca_agendada = None
+        self.transferencia = None
+        # Estado da lista: a consulta exibida, as tarefas carregadas (id -> tarefa)
+        # e, na lista completa, as chaves (data_inicial, id) carregadas, em ordem.
+        # A lista completa é uma janela de até MAXIMO_LINHAS_LISTA linhas que anda
+        # com a rolagem; inicio_da_lista e fim_da_lista dizem se ela chega às pontas.
+        self.visao = None
+        self.paginada = False
+        self.tarefas = {}
+        self.chaves = []
+        self.inicio_da_lista = True
+        self.fim_da_lista = True
+        self.pedido_pendente = None
+        self.substituir_ao_receber = False
 
-        inicializar_bd()
+        self.protocol("WM_DELETE_WINDOW", self.fechar)
         self.criar_widgets()
         self.carregar_tarefas()
+        self.receber_resultados()
+
+    def fechar(self):
+        self.leitor.fechar()
+        self.repositorio.fechar()
+        self.destroy()
 
     def criar_widgets(self):
+        # Menu com a importação e a exportação
+        barra_menu = tk.Menu(self)
+        menu_arquivo = tk.Menu(barra_menu, tearoff=False)
+        menu_arquivo.add_command(label="Importar Tarefas...", command=self.importar_tarefas)
+        menu_arquivo.add_command(label="Exportar Tarefas...", command=self.exportar_tarefas)
+        menu_arquivo.add_separator()
+        menu_arquivo.add_command(label="Sair", command=self.fechar)
+        barra_menu.add_cascade(label="Arquivo", menu=menu_arquivo)
+        self.config(menu=barra_menu)
+
         # Frame para os campos de entrada
         frame_input = ttk.LabelFrame(self, text="Cadastrar Tarefa", padding=(10, 5))
         frame_input.pack(fill="x", padx=10, pady=10)
@@ -160,25 +705,37 @@ class AgendaApp(tk.Tk):
         self.busca_entry = ttk.Entry(frame_busca)
         self.busca_entry.pack(side="left", fill="x", expand=True, padx=5, pady=2)
         self.busca_entry.bind('<Return>', lambda event: self.buscar_tarefas_na_interface())
+        self.busca_entry.bind('<KeyRelease>', self.agendar_busca)
 
         ttk.Button(frame_busca, text="Buscar", command=self.buscar_tarefas_na_interface).pack(side="left", padx=5)
-        ttk.Button(frame_busca, text="Limpar Busca", command=self.carregar_tarefas).pack(side="right", padx=5)
-
+        ttk.Button(frame_busca, text="Limpar Busca", command=self.limpar_busca).pack(side="right", padx=5)
+        ttk.Button(frame_busca, text="Atrasadas", command=lambda: self.mostrar(("listar_atrasadas",))).pack(side="right", padx=5)
+        ttk.Button(frame_busca, text="Desta Semana", command=lambda: self.mostrar(("listar_da_semana",))).pack(side="right", padx=5)
 
         # Frame para a lista de tarefas
         frame_lista = ttk.LabelFrame(self, text="Tarefas Cadastradas", padding=(10, 5))
         frame_lista.pack(fill="both", expand=True, padx=10, pady=10)
 
-        # Lista de tarefas
-        self.tarefas_listbox = tk.Listbox(frame_lista, height=10)
-        self.tarefas_listbox.pack(fill="both", expand=True)
-        
+        # Lista de tarefas; o iid de cada linha é o id da tarefa
+        colunas = ("id", "nome", "data_inicial", "data_final", "tipo_de_tarefa", "situacao")
+        self.tarefas_tree = ttk.Treeview(frame_lista, columns=colunas, show="headings", height=10, selectmode="extended")
+        for coluna, titulo, largura in zip(colunas, ("ID", "Nome", "Início", "Fim", "Tipo", "Situação"), (50, 250, 90, 90, 120, 90)):
+            self.tarefas_tree.heading(coluna, text=titulo)
+            self.tarefas_tree.column(coluna, width=largura, stretch=(coluna == "nome"))
+        self.barra_rolagem = ttk.Scrollbar(frame_lista, orient="vertical", command=self.tarefas_tree.yview)
+        self.tarefas_tree.configure(yscrollcommand=self.rolagem_alterada)
+        self.barra_rolagem.pack(side="right", fill="y")
+        self.tarefas_tree.pack(fill="both", expand=True)
+
+        self.status_label = ttk.Label(frame_lista, text="")
+        self.status_label.pack(fill="x")
+
         # Frame para os botões de ação
         frame_botoes = ttk.Frame(self, padding=(10, 5))
         frame_botoes.pack(fill="x", padx=10, pady=5)
 
         ttk.Button(frame_botoes, text="Marcar como Feita", command=self.marcar_feita).pack(side="left", expand=True, padx=5)
-        ttk.Button(frame_botoes, text="Remover Selecionada", command=self.remover_tarefa).pack(side="left", expand=True, padx=5)
+        ttk.Button(frame_botoes, text="Remover Selecionadas", command=self.remover_tarefa).pack(side="left", expand=True, padx=5)
         ttk.Button(frame_botoes, text="Limpar Não Feitas", command=self.limpar_tarefas).pack(side="right", expand=True, padx=5)
 
     def adicionar_tarefa(self):
@@ -193,71 +750,308 @@ class AgendaApp(tk.Tk):
             return
 
         try:
-            datetime.datetime.strptime(data_inicial, '%d-%m-%Y')
+            data_inicial = datetime.datetime.strptime(data_inicial, FORMATO_DATA).date()
             if data_final:
-                datetime.datetime.strptime(data_final, '%d-%m-%Y')
+                data_final = datetime.datetime.strptime(data_final, FORMATO_DATA).date()
         except ValueError:
             messagebox.showerror("Erro de Validação", "Formato de data inválido. Use DD-MM-AAAA.")
             return
 
-        cadastrar_tarefa(nome, descricao, data_inicial, data_final, tipo)
+        try:
+            tarefa_id = self.repositorio.cadastrar(nome, descricao, data_inicial, data_final, tipo)
+            tarefa = self.repositorio.obter(tarefa_id)
+        except sqlite3.Error:
+            messagebox.showerror("Erro", "Não foi possível cadastrar a tarefa.")
+            return
+        self.leitor.invalidar()
         self.limpar_campos()
-        self.carregar_tarefas()
+        if self.paginada:
+            self.inserir_na_ordem(tarefa)
+        else:
+            # Só a consulta sabe se a tarefa nova entra em uma busca ou filtro
+            self.recarregar()
 
     def carregar_tarefas(self):
-        """Carrega e exibe as tarefas na lista."""
-        self.tarefas_listbox.delete(0, tk.END)
-        tarefas = ver_todas_as_tarefas()
+        """Exibe a lista completa, carregada por páginas conforme a rolagem."""
+        self.mostrar(None)
+
+    def mostrar(self, visao):
+        """Troca a consulta exibida; visao é um pedido do LeitorTarefas ou None para a lista completa.
+
+        A lista atual continua na tela até o resultado chegar.
+        """
+        self.visao = visao
+        self.paginada = visao is None
+        self.recarregar()
+
+    def recarregar(self):
+        self.substituir_ao_receber = True
+        self.inicio_da_lista = True
+        self.fim_da_lista = not self.paginada
+        if self.paginada:
+            self.solicitar(("listar_pagina", None, TAMANHO_PAGINA))
+        else:
+            self.solicitar(self.visao)
+
+    def solicitar(self, pedido):
+        self.pedido_pendente = pedido
+        self.status_label.config(text="Carregando...")
+        tarefas = self.leitor.consultar(*pedido)
+        if tarefas is not None:
+            self.aplicar_resultado(tarefas)
+
+    def receber_resultados(self):
+        """Aplica os resultados da thread de leitura; roda periodicamente no loop do Tk."""
+        resultado = self.leitor.resultado_pronto()
+        if resultado is not None and resultado[0] == self.pedido_pendente:
+            pedido, versao, tarefas = resultado
+            if isinstance(tarefas, sqlite3.Error):
+                self.pedido_pendente = None
+                self.atualizar_status()
+                messagebox.showerror("Erro", "Não foi possível carregar as tarefas.")
+            elif versao != self.leitor.versao_dados:
+                # As tarefas mudaram durante a consulta
+                self.solicitar(pedido)
+            else:
+                self.aplicar_resultado(tarefas)
+        self.after(50, self.receber_resultados)
+
+    def aplicar_resultado(self, tarefas):
+        pedido, self.pedido_pendente = self.pedido_pendente, None
+        if self.substituir_ao_receber:
+            self.substituir_ao_receber = False
+            self.tarefas_tree.delete(*self.tarefas_tree.get_children())
+            self.tarefas.clear()
+            self.chaves.clear()
+        anterior = pedido is not None and pedido[0] == "listar_pagina_anterior"
+        # Posição da primeira linha visível, para manter a tela parada quando a
+        # janela ganha linhas no topo ou perde linhas do outro lado
+        primeira_visivel = round(self.tarefas_tree.yview()[0] * len(self.chaves)) if self.paginada else 0
+        novas = []
         for tarefa in tarefas:
-            self.tarefas_listbox.insert(tk.END, f"ID: {tarefa[0]} | Nome: {tarefa[1]} | Data: {tarefa[3]} | Situação: {tarefa[6]}")
+            if tarefa["id"] in self.tarefas:
+                continue
+            tarefa = dict(tarefa)
+            self.tarefas[tarefa["id"]] = tarefa
+            novas.append(tarefa)
+        if anterior:
+            for posicao, tarefa in enumerate(novas):
+                self.tarefas_tree.insert("", posicao, iid=tarefa["id"], values=self.valores_tarefa(tarefa))
+            self.chaves[:0] = [(tarefa["data_inicial"], tarefa["id"]) for tarefa in novas]
+            primeira_visivel += len(novas)
+            self.inicio_da_lista = len(tarefas) < TAMANHO_PAGINA
+        else:
+            for tarefa in novas:
+                self.tarefas_tree.insert("", "end", iid=tarefa["id"], values=self.valores_tarefa(tarefa))
+            if self.paginada:
+                self.chaves.extend((tarefa["data_inicial"], tarefa["id"]) for tarefa in novas)
+                self.fim_da_lista = len(tarefas) < TAMANHO_PAGINA
+        if self.paginada:
+            excesso = len(self.chaves) - MAXIMO_LINHAS_LISTA
+            if excesso > 0:
+                # Descarta as linhas do lado oposto ao que acabou de ser carregado
+                if anterior:
+                    descartadas = self.chaves[-excesso:]
+                    del self.chaves[-excesso:]
+                    self.fim_da_lista = False
+                else:
+                    descartadas = self.chaves[:excesso]
+                    del self.chaves[:excesso]
+                    self.inicio_da_lista = False
+                    primeira_visivel -= excesso
+                for _, tarefa_id in descartadas:
+                    del self.tarefas[tarefa_id]
+                self.tarefas_tree.delete(*(tarefa_id for _, tarefa_id in descartadas))
+            if self.chaves:
+                self.tarefas_tree.yview_moveto(max(primeira_visivel, 0) / len(self.chaves))
+        self.atualizar_status()
+        self.carregar_mais_se_preciso()
+
+    def rolagem_alterada(self, inicio, fim):
+        self.barra_rolagem.set(inicio, fim)
+        self.carregar_mais_se_preciso()
+
+    def carregar_mais_se_preciso(self):
+        """Pede a página seguinte (ou a anterior) quando a rolagem chega perto de uma ponta da janela carregada."""
+        if self.pedido_pendente is not None or not self.chaves:
+            return
+        if not self.tarefas_tree.winfo_ismapped():
+            return
+        inicio, fim = self.tarefas_tree.yview()
+        if not self.fim_da_lista and fim >= 0.9:
+            self.solicitar(("listar_pagina", self.chaves[-1], TAMANHO_PAGINA))
+        elif not self.inicio_da_lista and inicio <= 0.1:
+            self.solicitar(("listar_pagina_anterior", self.chaves[0], TAMANHO_PAGINA))
+
+    def atualizar_status(self):
+        if not self.tarefas:
+            texto = "Nenhuma tarefa encontrada."
+        else:
+            texto = f"{len(self.tarefas)} tarefas exibidas"
+            if not self.fim_da_lista or not self.inicio_da_lista:
+                texto += " (role para carregar mais)"
+        self.status_label.config(text=texto)
+
+    def valores_tarefa(self, tarefa):
+        return (tarefa["id"], tarefa["nome"], data_para_exibicao(tarefa["data_inicial"]),
+                data_para_exibicao(tarefa["data_final"]), tarefa["tipo_de_tarefa"], tarefa["situacao"])
+
+    def inserir_na_ordem(self, tarefa):
+        """Insere uma tarefa nova na posição dela, se ela cair no trecho já carregado da lista."""
+        chave = (tarefa["data_inicial"], tarefa["id"])
+        if not self.fim_da_lista and (not self.chaves or chave > self.chaves[-1]):
+            return  # aparece quando a página dela for carregada
+        if not self.inicio_da_lista and (not self.chaves or chave < self.chaves[0]):
+            return
+        posicao = bisect_left(self.chaves, chave)
+        self.chaves.insert(posicao, chave)
+        tarefa = dict(tarefa)
+        self.tarefas[tarefa["id"]] = tarefa
+        self.tarefas_tree.insert("", posicao, iid=tarefa["id"], values=self.valores_tarefa(tarefa))
+        self.tarefas_tree.see(tarefa["id"])
+        self.atualizar_status()
+
+    def retirar_da_lista(self, tarefa_ids):
+        for tarefa_id in tarefa_ids:
+            tarefa = self.tarefas.pop(tarefa_id, None)
+            if tarefa is None:
+                continue
+            self.tarefas_tree.delete(tarefa_id)
+            if self.paginada:
+                posicao = bisect_left(self.chaves, (tarefa["data_inicial"], tarefa_id))
+                del self.chaves[posicao]
+        self.atualizar_status()
+
+    def agendar_busca(self, event=None):
+        """Busca enquanto o usuário digita, esperando uma pausa de 200 ms."""
+        if self.busca_agendada is not None:
+            self.after_cancel(self.busca_agendada)
+        self.busca_agendada = self.after(200, self.buscar_tarefas_na_interface)
 
     def buscar_tarefas_na_interface(self):
         """Busca tarefas na interface com base no texto inserido."""
+        if self.busca_agendada is not None:
+            self.after_cancel(self.busca_agendada)
+            self.busca_agendada = None
         texto_busca = self.busca_entry.get().strip()
         if not texto_busca:
-            self.carregar_tarefas()
+            if not self.paginada:
+                self.carregar_tarefas()
             return
+        visao = ("buscar_por_texto", texto_busca, LIMITE_BUSCA)
+        if visao != self.visao:
+            self.mostrar(visao)
 
-        self.tarefas_listbox.delete(0, tk.END)
-        tarefas = buscar_tarefas_por_texto(texto_busca)
-        if tarefas:
-            for tarefa in tarefas:
-                self.tarefas_listbox.insert(tk.END, f"ID: {tarefa[0]} | Nome: {tarefa[1]} | Data: {tarefa[3]} | Situação: {tarefa[6]}")
-        else:
-            self.tarefas_listbox.insert(tk.END, "Nenhuma tarefa encontrada com este termo.")
+    def limpar_busca(self):
+        self.busca_entry.delete(0, tk.END)
+        self.buscar_tarefas_na_interface()
 
+    def ids_selecionados(self):
+        """Retorna os ids das tarefas selecionadas na lista."""
+        return [int(iid) for iid in self.tarefas_tree.selection()]
 
     def remover_tarefa(self):
+        tarefa_ids = self.ids_selecionados()
+        if not tarefa_ids:
+            messagebox.showwarning("Atenção", "Selecione uma tarefa para remover.")
+            return
         try:
-            item_selecionado = self.tarefas_listbox.curselection()
-            if item_selecionado:
-                linha_tarefa = self.tarefas_listbox.get(item_selecionado[0])
-                tarefa_id = int(linha_tarefa.split(" |")[0].split(":")[1].strip())
-                
-                remover_tarefa(tarefa_id)
-                self.carregar_tarefas()
-            else:
-                messagebox.showwarning("Atenção", "Selecione uma tarefa para remover.")
-        except Exception:
-            messagebox.showerror("Erro", "Não foi possível remover a tarefa selecionada.")
+            self.repositorio.remover_varias(tarefa_ids)
+        except sqlite3.Error:
+            messagebox.showerror("Erro", "Não foi possível remover as tarefas selecionadas.")
+            return
+        self.leitor.invalidar()
+        self.retirar_da_lista(tarefa_ids)
 
     def marcar_feita(self):
+        tarefa_ids = self.ids_selecionados()
+        if not tarefa_ids:
+            messagebox.showwarning("Atenção", "Selecione uma tarefa para marcar como feita.")
+            return
         try:
-            item_selecionado = self.tarefas_listbox.curselection()
-            if item_selecionado:
-                linha_tarefa = self.tarefas_listbox.get(item_selecionado[0])
-                tarefa_id = int(linha_tarefa.split(" |")[0].split(":")[1].strip())
-                
-                marcar_como_feita(tarefa_id)
-                self.carregar_tarefas()
-            else:
-                messagebox.showwarning("Atenção", "Selecione uma tarefa para marcar como feita.")
-        except Exception:
-            messagebox.showerror("Erro", "Não foi possível marcar a tarefa como feita.")
+            self.repositorio.marcar_varias_como_feitas(tarefa_ids)
+        except sqlite3.Error:
+            messagebox.showerror("Erro", "Não foi possível marcar as tarefas como feitas.")
+            return
+        self.leitor.invalidar()
+        if self.visao == ("listar_atrasadas",):
+            self.retirar_da_lista(tarefa_ids)
+            return
+        for tarefa_id in tarefa_ids:
+            tarefa = self.tarefas.get(tarefa_id)
+            if tarefa is not None:
+                tarefa["situacao"] = SITUACAO_FEITA
+                self.tarefas_tree.item(tarefa_id, values=self.valores_tarefa(tarefa))
 
     def limpar_tarefas(self):
-        apagar_tarefas_nao_feitas()
+        try:
+            self.repositorio.apagar_nao_feitas()
+        except sqlite3.Error:
+            messagebox.showerror("Erro", "Não foi possível apagar as tarefas não feitas.")
+            return
+        self.leitor.invalidar()
+        self.retirar_da_lista([tarefa_id for tarefa_id, tarefa in self.tarefas.items()
+                               if tarefa["situacao"] == SITUACAO_PENDENTE])
+
+    def importar_tarefas(self):
+        caminho_arquivo = filedialog.askopenfilename(
+            title="Importar Tarefas", filetypes=[("CSV ou iCalendar", "*.csv *.ics"), ("Todos os arquivos", "*")])
+        if caminho_arquivo:
+            self.transferir(importar_arquivo, caminho_arquivo, self.importacao_concluida)
+
+    def importacao_concluida(self, resultado):
+        importadas, recusadas, erros = resultado
+        self.leitor.invalidar()
         self.carregar_tarefas()
+        mensagem = f"{importadas} tarefas importadas, {recusadas} recusadas."
+        if erros:
+            mensagem += "\n\n" + "\n".join(f"Registro {registro}: {motivo}" for registro, motivo in erros)
+        messagebox.showinfo("Importação", mensagem)
+
+    def exportar_tarefas(self):
+        caminho_arquivo = filedialog.asksaveasfilename(
+            title="Exportar Tarefas", defaultextension=".csv", filetypes=[("CSV", "*.csv"), ("iCalendar", "*.ics")])
+        if caminho_arquivo:
+            self.transferir(exportar_arquivo, caminho_arquivo,
+                            lambda total: messagebox.showinfo("Exportação", f"{total} tarefas exportadas."))
+
+    def transferir(self, operacao, caminho_arquivo, concluir):
+        """Roda uma importação ou exportação em uma thread com conexão própria, mostrando o progresso."""
+        if self.transferencia is not None:
+            messagebox.showwarning("Atenção", "Aguarde o fim da importação ou exportação em andamento.")
+            return
+        self.transferencia = queue.Queue()
+        avisos = self.transferencia
+
+        def executar():
+            try:
+                with TarefaRepository(self.repositorio.caminho) as repositorio:
+                    resultado = operacao(repositorio, caminho_arquivo, progresso=avisos.put)
+            except (OSError, ValueError, sqlite3.Error) as erro:
+                resultado = erro
+            avisos.put(("fim", resultado))
+
+        threading.Thread(target=executar, name="transferencia", daemon=True).start()
+        self.acompanhar_transferencia(concluir)
+
+    def acompanhar_transferencia(self, concluir):
+        while True:
+            try:
+                aviso = self.transferencia.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(aviso, int):
+                self.status_label.config(text=f"{aviso} tarefas processadas...")
+                continue
+            self.transferencia = None
+            self.atualizar_status()
+            _, resultado = aviso
+            if isinstance(resultado, Exception):
+                messagebox.showerror("Erro", f"Não foi possível concluir a operação: {resultado}")
+            else:
+                concluir(resultado)
+            return
+        self.after(100, self.acompanhar_transferencia, concluir)
 
     def limpar_campos(self):
         self.nome_entry.delete(0, tk.END)
@@ -267,6 +1061,38 @@ class AgendaApp(tk.Tk):
         self.tipo_entry.delete(0, tk.END)
 
 # --- Ponto de Entrada da Aplicação ---
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Agenda de Tarefas. Sem comando, abre a interface gráfica.")
+    parser.add_argument("--banco", default=NOME_DB, help=f"arquivo do banco de dados (padrão: {NOME_DB})")
+    comandos = parser.add_subparsers(dest="comando")
+    for comando, ajuda in (("importar", "importa tarefas de um arquivo CSV ou .ics"),
+                           ("exportar", "exporta todas as tarefas para um arquivo CSV ou .ics")):
+        subparser = comandos.add_parser(comando, help=ajuda)
+        subparser.add_argument("arquivo")
+        subparser.add_argument("--formato", choices=FORMATOS_ARQUIVO, help="padrão: a extensão do arquivo")
+    args = parser.parse_args(argv)
+
+    if args.comando is None:
+        app = AgendaApp(args.banco)
+        app.mainloop()
+        return
+
+    def mostrar_progresso(processadas):
+        print(f"\r{processadas} tarefas processadas", end="", file=sys.stderr, flush=True)
+
+    try:
+        with TarefaRepository(args.banco) as repositorio:
+            if args.comando == "importar":
+                importadas, recusadas, erros = importar_arquivo(repositorio, args.arquivo, args.formato, mostrar_progresso)
+                print(f"\r{importadas} tarefas importadas, {recusadas} recusadas.", file=sys.stderr)
+                for registro, motivo in erros:
+                    print(f"  registro {registro}: {motivo}", file=sys.stderr)
+            else:
+                total = exportar_arquivo(repositorio, args.arquivo, args.formato, mostrar_progresso)
+                print(f"\r{total} tarefas exportadas para {args.arquivo}.", file=sys.stderr)
+    except (OSError, ValueError, sqlite3.Error) as erro:
+        sys.exit(f"Erro: {erro}")
+
 if __name__ == "__main__":
-    app = AgendaApp()
-    app.mainloop()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -1,11 +1,51 @@
-from flask import Flask, render_template, request, redirect, url_for, session, g, jsonify
+import os
+# Modo do servidor: 'threading' (padrão, uma thread do sistema por conexão),
+# 'eventlet' ou 'gevent' (green threads: conexões ociosas custam pouco). Os dois
+# últimos substituem os módulos de rede e de threads antes de qualquer outro import.
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, render_template, request, redirect, url_for, session, g, jsonify, json, Response
 import sqlite3
 import hashlib
-import os
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from datetime import datetime
+import socketio as socketio_lib
+from datetime import datetime, timezone
 import uuid # Importado para gerar nomes de arquivo únicos
-from werkzeug.utils import secure_filename # Importado para garantir nomes de arquivos seguros
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+import re
+import base64
+import hmac
+import bisect
+import csv
+import io
+import zlib
+import gzip
+import functools
+import logging
+import logging.handlers
+import struct
+import itertools
+import html
+import math
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+
+try:
+    from PIL import Image # Opcional: sem o Pillow as miniaturas não são geradas
+except ImportError:
+    Image = None
 
 # --- Configuração ---
 DATABASE = 'chat_database.db'
@@ -13,92 +53,813 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'uma_chave_secreta_muito_forte_e_unica
 # Nova configuração para a pasta de uploads
 UPLOADS_FOLDER = os.path.join('static', 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Hash de senhas com scrypt (memory-hard), executado em um pool limitado de threads
+KDF_SCRYPT_N = int(os.environ.get('KDF_SCRYPT_N', 2 ** 14))
+KDF_SCRYPT_R = 8
+KDF_SCRYPT_P = 1
+KDF_WORKERS = int(os.environ.get('KDF_WORKERS', os.cpu_count() or 2))
+KDF_MAX_PENDING = int(os.environ.get('KDF_MAX_PENDING', 64)) # acima disso o login responde 503
+# Nos modos eventlet/gevent o SQLite e os arquivos são acessados em um pool
+# limitado de threads do sistema, fora do loop de eventos
+BLOCKING_WORKERS = int(os.environ.get('BLOCKING_WORKERS', 16))
+SERVER_MAX_CONNECTIONS = int(os.environ.get('SERVER_MAX_CONNECTIONS', 10000)) # green threads simultâneas
+# DEBUG=1 liga o reloader e o debugger e permite o servidor do Werkzeug fora de um
+# terminal; em produção use ASYNC_MODE=eventlet/gevent ou o Gunicorn (README)
+DEBUG = os.environ.get('DEBUG', '0') == '1'
+# Uploads são gravados pelo hash do conteúdo (arquivos idênticos são armazenados uma vez)
+UPLOAD_MAX_BYTES = 5 * 1024 * 1024 # mesmo limite verificado no navegador
+UPLOAD_CHUNK_SIZE = 64 * 1024
+THUMBNAILS_FOLDER = os.path.join(UPLOADS_FOLDER, 'thumbs')
+THUMBNAIL_SIZE = 320 # pixels no maior lado
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+# Canal Socket.IO dos clientes que acompanham a lista de salas
+ROOMS_LIST_CHANNEL = 'rooms_list'
+# Paginação do histórico de mensagens (quantidade por página e limite máximo)
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX = 200
+# Reconexão: últimas mensagens de cada sala mantidas em memória para o catch-up
+RECENT_MESSAGES_PER_ROOM = int(os.environ.get('RECENT_MESSAGES_PER_ROOM', 200))
+SQLITE_MAX_INTEGER = 2 ** 63 - 1 # maior id que o SQLite consegue comparar
+CATCH_UP_MAX = 500 # acima disso o cliente recebe apenas a página mais recente
+# Retenção: mensagens fora da janela vão para segmentos NDJSON compactados (gzip)
+# em ARCHIVE_FOLDER e continuam acessíveis pela paginação do histórico
+RETENTION_MAX_AGE_DAYS = float(os.environ.get('RETENTION_MAX_AGE_DAYS', 0)) # 0 desativa
+RETENTION_MAX_PER_ROOM = int(os.environ.get('RETENTION_MAX_PER_ROOM', 0)) # mensagens mantidas por sala; 0 desativa
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 3600)) # segundos entre execuções
+ARCHIVE_FOLDER = os.environ.get('ARCHIVE_FOLDER', 'archive')
+ARCHIVE_SEGMENT_SIZE = 1000 # mensagens por segmento; só segmentos completos são arquivados
+ARCHIVE_CACHE_SEGMENTS = 32 # segmentos descompactados mantidos em memória
+# Exportação do histórico de uma sala (NDJSON ou CSV, em streaming)
+EXPORT_BATCH_SIZE = 1000 # linhas lidas do banco e enviadas por vez
+EXPORT_FIELDS = ('id', 'sala_id', 'username', 'conteudo', 'tipo', 'timestamp')
+# Busca textual (FTS5) nas mensagens
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_MAX_OFFSET = 1000
+SEARCH_PREFIX_MIN_LENGTH = 3 # termos mais curtos não viram busca por prefixo
+SEARCH_MAX_CANDIDATES = 5000 # ocorrências mais recentes ordenadas por relevância
+# Persistência das mensagens:
+#   'sync'  - INSERT + commit a cada mensagem (comportamento original)
+#   'group' - commits em lote; o handler aguarda o commit do lote antes de concluir
+#   'async' - commits em lote em segundo plano, sem aguardar (write-behind)
+MESSAGE_WRITE_MODE = os.environ.get('MESSAGE_WRITE_MODE', 'group')
+MESSAGE_BATCH_SIZE = int(os.environ.get('MESSAGE_BATCH_SIZE', 100))
+MESSAGE_BATCH_INTERVAL = float(os.environ.get('MESSAGE_BATCH_INTERVAL', 0.02)) # segundos
+MESSAGE_WRITE_TIMEOUT = 5.0 # segundos
+# Envio das mensagens às salas:
+#   BROADCAST_TICK = 0 - cada mensagem gera um 'new_message' imediato (padrão)
+#   BROADCAST_TICK > 0 - as mensagens de uma sala que chegam no mesmo tick viram um único 'new_messages'
+BROADCAST_TICK = float(os.environ.get('BROADCAST_TICK', 0)) # segundos
+BROADCAST_ROOMS = {int(room_id) for room_id in os.environ.get('BROADCAST_ROOMS', '').split(',') if room_id.strip()} # vazio = todas as salas
+BROADCAST_ENCODING = os.environ.get('BROADCAST_ENCODING', 'json') # 'json' ou 'binary'
+# Limites por conexão (sid) e por usuário para cada evento Socket.IO (token bucket):
+# (eventos por segundo, rajada). RATE_LIMIT_SCALE multiplica todas as taxas; 0 desativa.
+RATE_LIMITS = {
+    'send_message': {'sid': (5, 10), 'user': (10, 20)},
+    'get_active_users': {'sid': (2, 5), 'user': (5, 10)},
+    'join_room_event': {'sid': (1, 5), 'user': (3, 10)},
+    'leave_room_event': {'sid': (1, 5), 'user': (3, 10)},
+    'subscribe_rooms': {'sid': (1, 3), 'user': (3, 10)},
+    'mark_read': {'sid': (2, 5), 'user': (5, 10)},
+    'search': {'user': (1, 5)}, # rota HTTP: só por usuário
+}
+RATE_LIMIT_SCALE = float(os.environ.get('RATE_LIMIT_SCALE', 1))
+# Backpressure: novas mensagens são recusadas enquanto a fila de gravação ou a
+# latência média de gravação estiverem acima do limite (a média decai com o tempo
+# sem gravações, para que a recusa não se perpetue)
+BACKPRESSURE_QUEUE_DEPTH = int(os.environ.get('BACKPRESSURE_QUEUE_DEPTH', 5000)) # mensagens
+BACKPRESSURE_WRITE_LATENCY = float(os.environ.get('BACKPRESSURE_WRITE_LATENCY', 1.0)) # segundos
+BACKPRESSURE_RETRY_AFTER = 1.0 # segundos sugeridos ao cliente
+# Pool de conexões SQLite (modo WAL)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = 10.0 # segundos aguardando uma conexão livre
+DB_BUSY_TIMEOUT = 5000 # milissegundos aguardando o lock de escrita
+DB_STATEMENT_CACHE = 256 # prepared statements mantidos por conexão
+DB_PRAGMAS = {
+    'synchronous': 'NORMAL', # seguro em WAL; fsync apenas nos checkpoints
+    'cache_size': -16000, # ~16 MB de cache de páginas por conexão
+    'mmap_size': 128 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+# Presença em memória: intervalo de envio dos deltas e de persistência opcional (0 desativa)
+PRESENCE_FLUSH_INTERVAL = 0.25 # segundos
+PRESENCE_PERSIST_INTERVAL = float(os.environ.get('PRESENCE_PERSIST_INTERVAL', 0)) # segundos
+# Validade máxima do snapshot de /api/rooms (cobre salas criadas por outros processos)
+ROOM_LIST_CACHE_TTL = 5.0 # segundos
+# Logs estruturados (uma linha JSON por evento) e métricas em /metrics
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Com METRICS_TOKEN, /metrics exige 'Authorization: Bearer <token>'; sem ele,
+# só responde a requisições feitas pela própria máquina (loopback)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0) # segundos
+# Vários processos: fila de mensagens compartilhada pelos workers do Socket.IO.
+#   vazio          - um único processo (padrão)
+#   memory://nome  - canal em memória, para testes com vários servidores no mesmo processo
+#   redis://, kafka://, zmq+tcp://, amqp:// - backends suportados pelo python-socketio
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE', '')
+SOCKETIO_CHANNEL = os.environ.get('SOCKETIO_CHANNEL', 'flask-socketio')
+# Cada worker anuncia sua presença local periodicamente; sem anúncio, expira
+PRESENCE_HEARTBEAT_INTERVAL = 5.0 # segundos
+PRESENCE_PEER_TTL = 3 * PRESENCE_HEARTBEAT_INTERVAL
+# Cache LRU dos registros de salas e de usuários. A invalidação explícita só vale
+# no próprio processo; com vários workers a validade curta limita por quanto
+# tempo uma alteração feita em outro worker fica invisível.
+LOOKUP_CACHE_SIZE = int(os.environ.get('LOOKUP_CACHE_SIZE', 1024)) # registros por cache (0 desativa)
+LOOKUP_CACHE_TTL = float(os.environ.get('LOOKUP_CACHE_TTL', 5 if SOCKETIO_MESSAGE_QUEUE else 300)) # segundos
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = SECRET_KEY
 app.config['DATABASE'] = DATABASE
 app.config['UPLOADS_FOLDER'] = UPLOADS_FOLDER
-socketio = SocketIO(app, manage_session=False)
+app.config['THUMBNAILS_FOLDER'] = THUMBNAILS_FOLDER
+app.config['UPLOAD_MAX_BYTES'] = UPLOAD_MAX_BYTES
+# Margem para os cabeçalhos do multipart; o limite do arquivo é verificado ao gravar
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES + 64 * 1024
+app.config['MESSAGES_PAGE_SIZE'] = MESSAGES_PAGE_SIZE
+app.config['MESSAGES_PAGE_MAX'] = MESSAGES_PAGE_MAX
+app.config['RECENT_MESSAGES_PER_ROOM'] = RECENT_MESSAGES_PER_ROOM
+app.config['RETENTION_MAX_AGE_DAYS'] = RETENTION_MAX_AGE_DAYS
+app.config['RETENTION_MAX_PER_ROOM'] = RETENTION_MAX_PER_ROOM
+app.config['RETENTION_INTERVAL'] = RETENTION_INTERVAL
+app.config['ARCHIVE_FOLDER'] = ARCHIVE_FOLDER
+app.config['MESSAGE_WRITE_MODE'] = MESSAGE_WRITE_MODE
+app.config['MESSAGE_BATCH_SIZE'] = MESSAGE_BATCH_SIZE
+app.config['MESSAGE_BATCH_INTERVAL'] = MESSAGE_BATCH_INTERVAL
+app.config['DB_POOL_SIZE'] = DB_POOL_SIZE
+app.config['RATE_LIMITS'] = RATE_LIMITS
+app.config['RATE_LIMIT_SCALE'] = RATE_LIMIT_SCALE
+app.config['BACKPRESSURE_QUEUE_DEPTH'] = BACKPRESSURE_QUEUE_DEPTH
+app.config['BACKPRESSURE_WRITE_LATENCY'] = BACKPRESSURE_WRITE_LATENCY
+app.config['BROADCAST_TICK'] = BROADCAST_TICK
+app.config['BROADCAST_ROOMS'] = BROADCAST_ROOMS
+app.config['METRICS_TOKEN'] = METRICS_TOKEN
+app.config['BROADCAST_ENCODING'] = BROADCAST_ENCODING
+app.config['PRESENCE_PERSIST_INTERVAL'] = PRESENCE_PERSIST_INTERVAL
+
+# --- Logs ---
+class JsonLogFormatter(logging.Formatter):
+    """Formata cada registro como uma linha JSON, incluindo os campos passados em `extra`."""
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'event': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.RESERVED)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure_logging(level):
+    # O handler do logger só enfileira o registro; a escrita em stderr acontece na
+    # thread do QueueListener, fora dos handlers HTTP e Socket.IO
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonLogFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    chat_logger = logging.getLogger('chat')
+    chat_logger.setLevel(level)
+    chat_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    chat_logger.propagate = False
+    return chat_logger
+
+logger = configure_logging(LOG_LEVEL)
+
+# --- Métricas ---
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    """Métrica no formato de texto do Prometheus. Os valores ficam em um dicionário
+    indexado pela tupla de labels; `collect`, se informado, é chamado na coleta e
+    devolve {labels: valor} (usado nos gauges calculados a partir de outro estado)."""
+
+    def __init__(self, name, documentation, kind, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = labelnames
+        self.collect = collect
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def format_labels(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        if self.collect is not None:
+            values = self.collect()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{self.format_labels(labels)} {value}'
+
+class Histogram(Metric):
+    def __init__(self, name, documentation, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        super().__init__(name, documentation, 'histogram', labelnames)
+        self.buckets = buckets
 
-# Cria a pasta de uploads se ela não existir
-if not os.path.exists(UPLOADS_FOLDER):
-    os.makedirs(UPLOADS_FOLDER)
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Contagem por faixa (não cumulativa), soma e total
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
 
-# --- Funções Auxiliares do Banco de Dados (sem alterações) ---
+    def samples(self):
+        with self._lock:
+            values = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._values.items()}
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield f'{self.name}_bucket{self.format_labels(labels, [("le", le)])} {cumulative}'
+            yield f'{self.name}_sum{self.format_labels(labels)} {total}'
+            yield f'{self.name}_count{self.format_labels(labels)} {count}'
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Metric(name, documentation, 'counter', labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        return self.register(Metric(name, documentation, 'gauge', labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+http_request_latency = metrics.histogram('chat_http_request_duration_seconds', 'Duração das requisições HTTP.', ('endpoint', 'method', 'status'))
+socketio_event_latency = metrics.histogram('chat_socketio_event_duration_seconds', 'Duração dos handlers de eventos Socket.IO.', ('event',))
+db_query_latency = metrics.histogram('chat_db_query_duration_seconds', 'Duração das consultas feitas por query_db.', ('statement',))
+db_commit_latency = metrics.histogram('chat_db_commit_duration_seconds', 'Duração das gravações de mensagens, do início ao commit.', ('mode',))
+db_lock_wait = metrics.histogram('chat_db_lock_wait_seconds', 'Espera pelo lock de escrita no gravador de mensagens.')
+db_commits = metrics.counter('chat_db_commits_total', 'Commits de mensagens.', ('mode',))
+messages_persisted = metrics.counter('chat_messages_persisted_total', 'Mensagens gravadas no banco.', ('mode',))
+connected_clients = metrics.gauge('chat_connected_clients', 'Conexões Socket.IO abertas neste processo.')
+room_active_users = metrics.gauge('chat_room_active_users', 'Usuários ativos por sala.', ('room_id',),
+                                  collect=lambda: {(room_id,): count for room_id, count in presence.counts().items()})
+message_queue_depth = metrics.gauge('chat_message_writer_queue_depth', 'Mensagens aguardando o gravador em lote.',
+                                    collect=lambda: {(): message_writer.stats()['queue_depth']})
+password_hasher_queue_depth = metrics.gauge('chat_password_hasher_queue_depth', 'Hashes de senha aguardando um worker.',
+                                            collect=lambda: {(): password_hasher.stats()['queue_depth']})
+throttled_events = metrics.counter('chat_throttled_events_total', 'Eventos recusados por limite de taxa ou sobrecarga.', ('event', 'reason'))
+uploads = metrics.counter('chat_uploads_total', 'Envios de imagens por resultado.', ('result',))
+upload_bytes = metrics.counter('chat_upload_bytes_total', 'Bytes recebidos em envios de imagens aceitos.')
+lookup_cache_requests = metrics.counter('chat_lookup_cache_requests_total', 'Consultas ao cache de salas e usuários.', ('cache', 'result'))
+
+def timed_event(handler):
+    # Registra a duração do handler Socket.IO no histograma do evento
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            socketio_event_latency.observe(time.perf_counter() - start, request.event['message'])
+    return wrapper
+
+# --- Fila de mensagens entre processos ---
+PRESENCE_SYNC_EVENT = '__presence_sync__'
+PRESENCE_SYNC_NAMESPACE = '/__internal__'
+
+class PresenceSyncMixin:
+    """Intercepta, no gerenciador pub/sub, os anúncios de presença enviados
+    pelos outros workers; os demais eventos seguem o fluxo normal.
+
+    _handle_emit é interno ao python-socketio: a versão fica fixada no
+    requirements.txt e tests/test_presence_sync.py verifica o desvio."""
+
+    def _handle_emit(self, message):
+        if message.get('event') == PRESENCE_SYNC_EVENT:
+            if message.get('host_id') != self.host_id:
+                presence.update_peer(message['host_id'], message['data'][0])
+            return
+        return super()._handle_emit(message)
+
+class MemoryManager(socketio_lib.PubSubManager):
+    """Backend pub/sub em memória: vários servidores no mesmo processo
+    compartilham o canal, simulando workers sem depender de um broker."""
+
+    name = 'memory'
+    _subscribers = {} # canal -> [fila de cada servidor]
+    _subscribers_lock = threading.Lock()
+
+    def __init__(self, url='memory://', channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._inbox = queue.Queue()
+        if not write_only:
+            with self._subscribers_lock:
+                self._subscribers.setdefault(channel, []).append(self._inbox)
+
+    def _publish(self, data):
+        message = self.json.dumps(data)
+        with self._subscribers_lock:
+            inboxes = list(self._subscribers.get(self.channel, ()))
+        for inbox in inboxes:
+            inbox.put(message)
+
+    def _listen(self):
+        while True:
+            yield self._inbox.get()
+
+def create_client_manager(url, channel):
+    if url.startswith('memory://'):
+        queue_class = MemoryManager
+    elif url.startswith(('redis://', 'rediss://')):
+        queue_class = socketio_lib.RedisManager
+    elif url.startswith('kafka://'):
+        queue_class = socketio_lib.KafkaManager
+    elif url.startswith('zmq'):
+        queue_class = socketio_lib.ZmqManager
+    else:
+        queue_class = socketio_lib.KombuManager
+    if not callable(getattr(queue_class, '_handle_emit', None)):
+        raise RuntimeError('python-socketio sem PubSubManager._handle_emit; '
+                           'use a versão do requirements.txt para sincronizar a presença entre workers')
+    manager_class = type(f'PresenceSync{queue_class.__name__}', (PresenceSyncMixin, queue_class), {})
+    return manager_class(url, channel=channel)
+
+socketio_options = {}
+if SOCKETIO_MESSAGE_QUEUE:
+    socketio_options['client_manager'] = create_client_manager(SOCKETIO_MESSAGE_QUEUE, SOCKETIO_CHANNEL)
+socketio = SocketIO(app, async_mode=ASYNC_MODE, manage_session=False, **socketio_options)
+multi_worker = bool(SOCKETIO_MESSAGE_QUEUE)
+
+# Cria as pastas de uploads e miniaturas se elas não existirem
+os.makedirs(THUMBNAILS_FOLDER, exist_ok=True)
+
+# --- Chamadas bloqueantes fora do loop de eventos ---
+class BlockingPool:
+    """Pool limitado de threads do sistema para SQLite, arquivos e scrypt. Com
+    eventlet/gevent só a green thread que fez a chamada espera o resultado; o
+    loop de eventos continua atendendo as outras conexões."""
+
+    def __init__(self, workers, name):
+        self.workers = workers
+        if ASYNC_MODE == 'eventlet':
+            # O eventlet tem um único pool de threads reais (tpool), dimensionado abaixo
+            from eventlet import tpool
+            self._run = tpool.execute
+            self._shutdown = lambda: None
+        elif ASYNC_MODE == 'gevent':
+            from gevent.threadpool import ThreadPool
+            pool = ThreadPool(workers)
+            self._run = lambda function, *args: pool.apply(function, args)
+            self._shutdown = pool.kill
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+            self._run = lambda function, *args: executor.submit(function, *args).result()
+            self._shutdown = lambda: executor.shutdown(wait=True)
+
+    def run(self, function, *args):
+        return self._run(function, *args)
+
+    def shutdown(self):
+        self._shutdown()
+
+if ASYNC_MODE == 'eventlet':
+    from eventlet import tpool
+    tpool.set_num_threads(BLOCKING_WORKERS + KDF_WORKERS)
+
+def native_lock():
+    # Lock do sistema para estado compartilhado com as threads do BlockingPool:
+    # os locks substituídos pelo eventlet/gevent só funcionam entre green threads
+    if ASYNC_MODE == 'eventlet':
+        return eventlet.patcher.original('threading').Lock()
+    if ASYNC_MODE == 'gevent':
+        return monkey.get_original('_thread', 'allocate_lock')()
+    return threading.Lock()
+
+# No modo threading cada handler já roda em uma thread do sistema: a chamada é direta
+io_pool = BlockingPool(BLOCKING_WORKERS, 'io') if ASYNC_MODE != 'threading' else None
+if io_pool is not None:
+    atexit.register(io_pool.shutdown)
+
+def run_blocking(function, *args):
+    # Tudo o que chamar run_blocking não pode usar o contexto do Flask (g, session)
+    # nem emitir eventos: a função pode rodar em outra thread
+    if io_pool is None:
+        return function(*args)
+    return io_pool.run(function, *args)
+
+# --- Pool de Conexões do Banco de Dados ---
+def create_connection(database):
+    # Conexão de longa duração em modo WAL: leitores não bloqueiam o escritor
+    conn = sqlite3.connect(database, timeout=DB_BUSY_TIMEOUT / 1000,
+                           check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    for pragma, value in DB_PRAGMAS.items():
+        conn.execute(f'PRAGMA {pragma}={value}')
+    return conn
+
+class ConnectionPool:
+    """Conjunto limitado de conexões reutilizadas entre requisições HTTP e
+    eventos Socket.IO. As conexões são criadas sob demanda até `size`."""
+
+    def __init__(self, database, size):
+        self.database = database
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=DB_POOL_TIMEOUT):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return create_connection(self.database)
+            except sqlite3.Error:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('Nenhuma conexão livre no pool do banco de dados')
+
+    def release(self, conn):
+        # Descarta qualquer transação deixada aberta antes de devolver ao pool
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+db_pool = None
+db_pool_lock = threading.Lock()
+db_init_lock = threading.Lock()
+db_initialized = False
+
+def get_pool():
+    global db_pool
+    database = app.config['DATABASE']
+    if db_pool is None or db_pool.database != database:
+        with db_pool_lock:
+            if db_pool is None or db_pool.database != database:
+                if db_pool is not None:
+                    db_pool.close()
+                db_pool = ConnectionPool(database, app.config['DB_POOL_SIZE'])
+    return db_pool
+
+def close_pool():
+    if db_pool is not None:
+        db_pool.close()
+
+# --- Cache de salas e usuários ---
+class LookupCache:
+    """Cache LRU limitado e com validade para registros que quase nunca mudam.
+    Resultados vazios não são guardados, então um registro criado em outro
+    worker aparece na próxima consulta."""
+
+    def __init__(self, name, size, ttl):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict() # chave -> (expira_em, registro)
+        self._lock = threading.Lock()
+        self._generation = 0 # muda a cada invalidação; descarta leituras feitas antes dela
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+            generation = self._generation
+        lookup_cache_requests.inc(1, self.name, 'miss' if entry is None else 'hit')
+        if entry is not None:
+            return entry[1]
+
+        value = load(key)
+        if value is not None and self.size > 0:
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[key] = (now + self.ttl, value)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.size:
+                        self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        # Sem chave, esvazia o cache inteiro
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+room_cache = LookupCache('rooms', LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL)
+user_cache = LookupCache('users', LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL)
+
+# --- Funções Auxiliares do Banco de Dados ---
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(app.config['DATABASE'])
-        db.row_factory = sqlite3.Row
+        db = g._database = get_pool().acquire()
     return db
 
 @app.teardown_appcontext
 def close_db(error):
-    db = getattr(g, '_database', None)
+    # Devolve a conexão ao pool em vez de fechá-la
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        get_pool().release(db)
 
-def init_db():
-    with app.app_context():
-        db = get_db()
-        cursor = db.cursor()
+def ensure_db_initialized():
+    # Aplica as migrações uma única vez por processo; depois disso as requisições
+    # só verificam esta flag
+    if not db_initialized:
+        with db_init_lock:
+            if not db_initialized:
+                init_db()
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuarios (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL
+def init_db():
+    # Aplica, em ordem, as migrações ainda não registradas em schema_migrations. Cada
+    # uma roda em sua própria transação (BEGIN IMMEDIATE), e a versão é conferida de
+    # novo dentro dela: se vários workers iniciarem juntos, só um aplica cada migração.
+    global db_initialized
+    conn = create_connection(app.config['DATABASE'])
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                versao INTEGER PRIMARY KEY,
+                nome TEXT NOT NULL,
+                aplicada_em DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        conn.commit()
+        applied = {row['versao'] for row in conn.execute('SELECT versao FROM schema_migrations')}
+        for version, name, migration in MIGRATIONS:
+            if version in applied:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if conn.execute('SELECT 1 FROM schema_migrations WHERE versao = ?', (version,)).fetchone() is None:
+                    migration(conn.cursor())
+                    conn.execute('INSERT INTO schema_migrations (versao, nome) VALUES (?, ?)', (version, name))
+                    logger.info('migração aplicada', extra={'version': version, 'migration': name})
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+    finally:
+        conn.close()
+    db_initialized = True
 
+# --- Migrações do esquema ---
+# As migrações 1 a 4 usam IF NOT EXISTS (e conferem as colunas) porque também
+# adotam bancos criados antes de schema_migrations existir.
+def migration_initial_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS salas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT UNIQUE NOT NULL
+        )
+    ''')
+    # Tabela de Mensagens - agora com um campo para tipo (texto, imagem)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mensagens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sala_id INTEGER NOT NULL,
+            usuario_id INTEGER NOT NULL,
+            conteudo TEXT NOT NULL,
+            tipo TEXT NOT NULL DEFAULT 'text',
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sala_id) REFERENCES salas (id),
+            FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
+        )
+    ''')
+    # Bancos de versões anteriores ao envio de imagens não têm a coluna tipo
+    columns = [row['name'] for row in cursor.execute('PRAGMA table_info(mensagens)')]
+    if 'tipo' not in columns:
+        cursor.execute("ALTER TABLE mensagens ADD COLUMN tipo TEXT NOT NULL DEFAULT 'text'")
+    # Índice para a paginação por cursor do histórico (sala_id, id)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_mensagens_sala_id
+        ON mensagens (sala_id, id)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usuario_sala_ativo (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL,
+            sala_id INTEGER NOT NULL,
+            timestamp_entrada DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (usuario_id) REFERENCES usuarios (id),
+            FOREIGN KEY (sala_id) REFERENCES salas (id),
+            UNIQUE(usuario_id, sala_id)
+        )
+    ''')
+
+def migration_archive_segments(cursor):
+    # Segmentos de mensagens arquivadas (arquivo relativo a ARCHIVE_FOLDER)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS arquivo_segmentos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sala_id INTEGER NOT NULL,
+            primeiro_id INTEGER NOT NULL,
+            ultimo_id INTEGER NOT NULL,
+            quantidade INTEGER NOT NULL,
+            arquivo TEXT NOT NULL,
+            criado_em DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sala_id) REFERENCES salas (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_arquivo_segmentos_sala
+        ON arquivo_segmentos (sala_id, ultimo_id)
+    ''')
+    # Um segmento por início de faixa: duas execuções simultâneas não o registram duas vezes
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_arquivo_segmentos_inicio
+        ON arquivo_segmentos (sala_id, primeiro_id)
+    ''')
+    # Travas com validade entre os processos que compartilham o banco (laço de retenção)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS travas (
+            nome TEXT PRIMARY KEY,
+            dono TEXT NOT NULL,
+            expira_em REAL NOT NULL
+        )
+    ''')
+
+def migration_unread_counters(cursor):
+    # Total de mensagens de cada sala, incrementado junto com o INSERT. Não
+    # diminui quando as mensagens são arquivadas.
+    columns = [row['name'] for row in cursor.execute('PRAGMA table_info(salas)')]
+    if 'total_mensagens' not in columns:
+        cursor.execute('ALTER TABLE salas ADD COLUMN total_mensagens INTEGER NOT NULL DEFAULT 0')
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS salas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nome TEXT UNIQUE NOT NULL
-            )
-        ''')
-        # Tabela de Mensagens - agora com um campo para tipo (texto, imagem)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS mensagens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sala_id INTEGER NOT NULL,
-                usuario_id INTEGER NOT NULL,
-                conteudo TEXT NOT NULL,
-                tipo TEXT NOT NULL DEFAULT 'text',
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (sala_id) REFERENCES salas (id),
-                FOREIGN KEY (usuario_id) REFERENCES usuarios (id)
-            )
+            UPDATE salas SET total_mensagens =
+                (SELECT COUNT(*) FROM mensagens WHERE sala_id = salas.id) +
+                (SELECT IFNULL(SUM(quantidade), 0) FROM arquivo_segmentos WHERE sala_id = salas.id)
         ''')
+    # Cursor de leitura de cada usuário por sala: lidas é o total_mensagens da
+    # sala até ultima_lida_id, então não lidas = total_mensagens - lidas
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS leituras (
+            usuario_id INTEGER NOT NULL,
+            sala_id INTEGER NOT NULL,
+            ultima_lida_id INTEGER NOT NULL,
+            lidas INTEGER NOT NULL,
+            atualizado_em DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (usuario_id, sala_id),
+            FOREIGN KEY (usuario_id) REFERENCES usuarios (id),
+            FOREIGN KEY (sala_id) REFERENCES salas (id)
+        ) WITHOUT ROWID
+    ''')
+
+def migration_secondary_indexes(cursor):
+    # Janela de retenção por idade e filtros since/until da exportação, ambos por sala e timestamp
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mensagens_sala_timestamp ON mensagens (sala_id, timestamp)')
 
+def create_search_index(cursor):
+    # Índice FTS5 com conteúdo externo: guarda apenas os termos das mensagens de
+    # texto (imagens ficam de fora) e é mantido pelos triggers abaixo.
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'mensagens_fts'").fetchone()
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS mensagens_fts USING fts5(
+            conteudo,
+            sala_id UNINDEXED,
+            content = 'mensagens',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS mensagens_fts_insert AFTER INSERT ON mensagens
+        WHEN new.tipo = 'text' BEGIN
+            INSERT INTO mensagens_fts (rowid, conteudo, sala_id) VALUES (new.id, new.conteudo, new.sala_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS mensagens_fts_delete AFTER DELETE ON mensagens
+        WHEN old.tipo = 'text' BEGIN
+            INSERT INTO mensagens_fts (mensagens_fts, rowid, conteudo, sala_id) VALUES ('delete', old.id, old.conteudo, old.sala_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS mensagens_fts_update AFTER UPDATE ON mensagens BEGIN
+            INSERT INTO mensagens_fts (mensagens_fts, rowid, conteudo, sala_id)
+            SELECT 'delete', old.id, old.conteudo, old.sala_id WHERE old.tipo = 'text';
+            INSERT INTO mensagens_fts (rowid, conteudo, sala_id)
+            SELECT new.id, new.conteudo, new.sala_id WHERE new.tipo = 'text';
+        END
+    ''')
+    if not exists:
+        # Bancos existentes: indexa as mensagens gravadas antes da busca existir
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuario_sala_ativo (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_id INTEGER NOT NULL,
-                sala_id INTEGER NOT NULL,
-                timestamp_entrada DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (usuario_id) REFERENCES usuarios (id),
-                FOREIGN KEY (sala_id) REFERENCES salas (id),
-                UNIQUE(usuario_id, sala_id)
-            )
+            INSERT INTO mensagens_fts (rowid, conteudo, sala_id)
+            SELECT id, conteudo, sala_id FROM mensagens WHERE tipo = 'text'
         ''')
-        db.commit()
 
-# --- Funções Auxiliares do Banco de Dados ---
-def query_db(query, args=(), one=False):
-    cur = get_db().execute(query, args)
+MIGRATIONS = [
+    (1, 'esquema inicial', migration_initial_schema),
+    (2, 'busca textual (FTS5)', create_search_index),
+    (3, 'segmentos de arquivo', migration_archive_segments),
+    (4, 'contadores de não lidas', migration_unread_counters),
+    (5, 'índices por sala e timestamp', migration_secondary_indexes),
+]
+
+def fetch_all(db, query, args):
+    cur = db.execute(query, args)
     rv = cur.fetchall()
     cur.close()
+    return rv
+
+def execute_write(db, query, args):
+    # Escrita e commit em uma só chamada; retorna (lastrowid, linhas do RETURNING)
+    cur = db.execute(query, args)
+    rows = cur.fetchall()
+    db.commit()
+    return cur.lastrowid, rows
+
+def query_db(query, args=(), one=False):
+    start = time.perf_counter()
+    rv = run_blocking(fetch_all, get_db(), query, args)
+    db_query_latency.observe(time.perf_counter() - start, query.split(None, 1)[0].upper())
     return (rv[0] if rv else None) if one else rv
 
 def get_user_by_username(username):
-    return query_db('SELECT * FROM usuarios WHERE username = ?', [username], one=True)
+    return user_cache.get(username, lambda key: query_db('SELECT * FROM usuarios WHERE username = ?', [key], one=True))
 
 def add_user(username, password_hash):
-    db = get_db()
     try:
-        db.execute('INSERT INTO usuarios (username, password_hash) VALUES (?, ?)', [username, password_hash])
-        db.commit()
+        run_blocking(execute_write, get_db(), 'INSERT INTO usuarios (username, password_hash) VALUES (?, ?)',
+                     [username, password_hash])
+        user_cache.invalidate(username)
         return True
     except sqlite3.IntegrityError:
         return False
@@ -107,51 +868,1371 @@ def get_rooms():
     return query_db('SELECT * FROM salas ORDER BY nome')
 
 def get_room_by_id(room_id):
-    return query_db('SELECT * FROM salas WHERE id = ?', [room_id], one=True)
+    # O id chega como texto nos eventos Socket.IO: normaliza para usar uma só chave
+    try:
+        room_id = int(room_id)
+    except (TypeError, ValueError):
+        return None
+    # Só as colunas que não mudam: total_mensagens fica de fora do cache
+    return room_cache.get(room_id, lambda key: query_db('SELECT id, nome FROM salas WHERE id = ?', [key], one=True))
+
+def update_user_password(user_id, password_hash):
+    run_blocking(execute_write, get_db(), 'UPDATE usuarios SET password_hash = ? WHERE id = ?', [password_hash, user_id])
+    # O cache é indexado pelo nome; a troca de hash é rara (migração no login)
+    user_cache.invalidate()
 
 def add_room(room_name):
-    db = get_db()
     try:
-        db.execute('INSERT INTO salas (nome) VALUES (?)', [room_name])
-        db.commit()
+        room_id, _ = run_blocking(execute_write, get_db(), 'INSERT INTO salas (nome) VALUES (?)', [room_name])
+        room_cache.invalidate(room_id)
+        invalidate_room_list()
         return True
     except sqlite3.IntegrityError:
         return False
 
-def get_messages_in_room(room_id):
-    # Alterado para buscar o tipo da mensagem também
+def get_messages_page(room_id, before=None, limit=MESSAGES_PAGE_SIZE):
+    # Paginação por cursor: busca as `limit` mensagens mais recentes com id < before,
+    # usando o índice (sala_id, id), e devolve em ordem cronológica. Se a tabela
+    # acabar antes de completar a página, continua nos segmentos arquivados.
+    if before is None:
+        rows = query_db("""
+            SELECT m.id, m.conteudo, u.username, m.timestamp, m.tipo
+            FROM mensagens m
+            JOIN usuarios u ON m.usuario_id = u.id
+            WHERE m.sala_id = ?
+            ORDER BY m.id DESC
+            LIMIT ?
+        """, [room_id, limit])
+    else:
+        rows = query_db("""
+            SELECT m.id, m.conteudo, u.username, m.timestamp, m.tipo
+            FROM mensagens m
+            JOIN usuarios u ON m.usuario_id = u.id
+            WHERE m.sala_id = ? AND m.id < ?
+            ORDER BY m.id DESC
+            LIMIT ?
+        """, [room_id, before, limit])
+    if len(rows) < limit:
+        oldest_id = rows[-1]['id'] if rows else before
+        rows = rows + get_archived_messages(room_id, oldest_id, limit - len(rows))
+    return rows[::-1]
+
+def get_messages_after(room_id, after, limit):
+    # Mensagens com id > after, em ordem cronológica (usado no catch-up após reconexão)
     return query_db("""
-        SELECT m.conteudo, u.username, m.timestamp, m.tipo
+        SELECT m.id, m.conteudo, u.username, m.timestamp, m.tipo
         FROM mensagens m
         JOIN usuarios u ON m.usuario_id = u.id
-        WHERE m.sala_id = ?
-        ORDER BY m.timestamp
-    """, [room_id])
+        WHERE m.sala_id = ? AND m.id > ?
+        ORDER BY m.id
+        LIMIT ?
+    """, [room_id, after, limit])
+
+def serialize_message(row, room_id):
+    # Mesmo formato do evento 'new_message'
+    message = {
+        'id': row['id'],
+        'username': row['username'],
+        'message': row['conteudo'],
+        'timestamp': row['timestamp'],
+        'room_id': room_id,
+        'type': row['tipo']
+    }
+    if row['tipo'] == 'image':
+        message['thumbnail'] = thumbnail_url(row['conteudo'])
+    return message
+
+def build_search_query(text):
+    # Converte o texto digitado em uma consulta FTS5 segura: cada palavra vira um
+    # termo entre aspas (sem operadores) e a última aceita prefixo se tiver ao
+    # menos SEARCH_PREFIX_MIN_LENGTH caracteres ('a*' casaria com quase tudo).
+    words = text.split()
+    if not words:
+        return None
+    query = ' '.join('"{}"'.format(word.replace('"', '""')) for word in words)
+    return query + '*' if len(words[-1]) >= SEARCH_PREFIX_MIN_LENGTH else query
+
+# Delimitadores do termo encontrado no trecho. São caracteres de controle que o
+# html.escape preserva; só depois do escape eles viram <mark> e </mark>
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+
+def highlight_snippet(snippet):
+    # O trecho é o texto da mensagem, então é escapado antes de receber as tags
+    return html.escape(snippet).replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+def search_messages(text, room_id=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    match = build_search_query(text)
+    if match is None:
+        return []
+    # O bm25 pontua todas as ocorrências; para limitar o custo, só as
+    # SEARCH_MAX_CANDIDATES mais recentes (rowid a partir da menor delas) são
+    # ordenadas. A janela é a mesma na busca por sala: filtrar as candidatas pela
+    # sala exigiria ler a sala de cada ocorrência, que é o custo a evitar.
+    room_filter = 'AND f.sala_id = ?' if room_id is not None else ''
+    args = ([SNIPPET_START, SNIPPET_END, match] + ([room_id] if room_id is not None else [])
+            + [match, SEARCH_MAX_CANDIDATES, limit, offset])
+    rows = query_db(f"""
+        SELECT m.id, m.sala_id, s.nome AS sala, u.username, m.timestamp,
+               snippet(mensagens_fts, 0, ?, ?, '…', 12) AS trecho
+        FROM mensagens_fts f
+        JOIN mensagens m ON m.id = f.rowid
+        JOIN usuarios u ON m.usuario_id = u.id
+        JOIN salas s ON m.sala_id = s.id
+        WHERE mensagens_fts MATCH ? {room_filter}
+          AND f.rowid >= (
+              SELECT IFNULL(MIN(rowid), 0) FROM (
+                  SELECT rowid FROM mensagens_fts
+                  WHERE mensagens_fts MATCH ?
+                  ORDER BY rowid DESC
+                  LIMIT ?
+              )
+          )
+        ORDER BY f.rank
+        LIMIT ? OFFSET ?
+    """, args)
+    return [dict(row, trecho=highlight_snippet(row['trecho'])) for row in rows]
+
+INSERT_MESSAGE_SQL = 'INSERT INTO mensagens (sala_id, usuario_id, conteudo, tipo) VALUES (?, ?, ?, ?)'
+COUNT_ROOM_MESSAGES_SQL = 'UPDATE salas SET total_mensagens = total_mensagens + ? WHERE id = ? RETURNING id, total_mensagens'
+
+def count_new_messages(conn, written):
+    # written: [(sala_id, id da mensagem)] gravadas na transação em andamento.
+    # Incrementa o contador de cada sala uma vez e retorna {sala: (último id, total)}.
+    added = {}
+    for room_id, message_id in written:
+        count, last_id = added.get(room_id, (0, 0))
+        added[room_id] = (count + 1, max(last_id, message_id))
+    totals = {}
+    for room_id, (count, last_id) in added.items():
+        row = conn.execute(COUNT_ROOM_MESSAGES_SQL, (count, room_id)).fetchone()
+        if row is not None:
+            totals[row[0]] = (last_id, row[1])
+    return totals
 
 def add_message(room_id, user_id, content, message_type='text'):
-    db = get_db()
-    db.execute('INSERT INTO mensagens (sala_id, usuario_id, conteudo, tipo) VALUES (?, ?, ?, ?)', [room_id, user_id, content, message_type])
+    # Retorna um Future que é concluído com o id da mensagem quando ela estiver gravada no banco
+    params = (room_id, user_id, content, message_type)
+    if app.config['MESSAGE_WRITE_MODE'] == 'sync':
+        start = time.perf_counter()
+        future = Future()
+        try:
+            message_id, totals = run_blocking(insert_message, get_db(), params)
+        except sqlite3.Error as e:
+            # A mensagem já foi enviada à sala: o Future com erro faz o cliente descartá-la
+            get_db().rollback()
+            logger.error('erro ao gravar mensagem', extra={'error': str(e), 'room_id': room_id})
+            future.set_exception(e)
+            return future
+        room_activity.record(totals)
+        write_latency.observe(time.perf_counter() - start)
+        db_commit_latency.observe(time.perf_counter() - start, 'sync')
+        db_commits.inc(1, 'sync')
+        messages_persisted.inc(1, 'sync')
+        future.set_result(message_id)
+        return future
+    return message_writer.submit(params)
+
+def insert_message(db, params):
+    # Gravação de uma mensagem no modo 'sync': retorna (id, totais da sala)
+    message_id = db.execute(INSERT_MESSAGE_SQL, params).lastrowid
+    totals = count_new_messages(db, [(params[0], message_id)])
     db.commit()
+    return message_id, totals
+
+def wait_message_persisted(future):
+    # No modo 'group' o handler só conclui depois do commit do lote. Retorna False se
+    # a gravação falhou ou não terminou a tempo; a sala já recebeu a mensagem e fica
+    # sabendo da falha pelo 'messages_persisted' com id None (track_message).
+    if app.config['MESSAGE_WRITE_MODE'] != 'group':
+        return True
+    try:
+        future.result(timeout=MESSAGE_WRITE_TIMEOUT)
+    except (FutureTimeoutError, sqlite3.Error) as e:
+        logger.error('mensagem não confirmada', extra={'error': repr(e)})
+        return False
+    return True
 
 def get_active_users_in_room(room_id):
-    result = query_db('SELECT COUNT(DISTINCT usuario_id) as count FROM usuario_sala_ativo WHERE sala_id = ?', [room_id], one=True)
-    return result['count'] if result and result['count'] else 0
+    return presence.count(room_id)
 
-def set_user_active_in_room(user_id, room_id):
-    db = get_db()
-    db.execute('INSERT OR REPLACE INTO usuario_sala_ativo (usuario_id, sala_id, timestamp_entrada) VALUES (?, ?, ?)', [user_id, room_id, datetime.now()])
-    db.commit()
+MARK_READ_SQL = '''
+    INSERT INTO leituras (usuario_id, sala_id, ultima_lida_id, lidas)
+    SELECT ?, s.id,
+           MIN(?, MAX(IFNULL((SELECT MAX(id) FROM mensagens WHERE sala_id = s.id), 0),
+                      IFNULL((SELECT MAX(ultimo_id) FROM arquivo_segmentos WHERE sala_id = s.id), 0))),
+           s.total_mensagens - (SELECT COUNT(*) FROM mensagens WHERE sala_id = s.id AND id > ?)
+    FROM salas s WHERE s.id = ?
+    ON CONFLICT (usuario_id, sala_id) DO UPDATE SET
+        ultima_lida_id = excluded.ultima_lida_id, lidas = excluded.lidas, atualizado_em = CURRENT_TIMESTAMP
+    WHERE excluded.ultima_lida_id > leituras.ultima_lida_id
+    RETURNING sala_id, ultima_lida_id, lidas
+'''
+
+def mark_room_read(user_id, room_id, message_id):
+    # Avança o cursor até message_id (nunca volta), limitado ao maior id existente
+    # na sala, na tabela ou no arquivo: um id acima disso travaria o cursor. As
+    # mensagens posteriores são contadas pelo índice (sala_id, id) e normalmente
+    # são poucas ou nenhuma.
+    _, rows = run_blocking(execute_write, get_db(), MARK_READ_SQL, [user_id, message_id, message_id, room_id])
+    if not rows:
+        return None
+    row = rows[0]
+    return {'room_id': row['sala_id'], 'last_read_id': row['ultima_lida_id'], 'read_count': row['lidas']}
+
+def get_unread_counts(user_id):
+    # Uma linha de salas e uma consulta pela chave primária de leituras por sala,
+    # independente do tamanho do histórico
+    rows = query_db("""
+        SELECT s.id, s.total_mensagens, IFNULL(l.lidas, 0) AS lidas, IFNULL(l.ultima_lida_id, 0) AS ultima_lida_id
+        FROM salas s
+        LEFT JOIN leituras l ON l.sala_id = s.id AND l.usuario_id = ?
+    """, [user_id])
+    return {row['id']: {
+        'message_count': row['total_mensagens'],
+        'read_count': row['lidas'],
+        'unread_count': max(row['total_mensagens'] - row['lidas'], 0),
+        'last_read_id': row['ultima_lida_id']
+    } for row in rows}
 
-def remove_user_from_room(user_id, room_id):
-    db = get_db()
-    db.execute('DELETE FROM usuario_sala_ativo WHERE usuario_id = ? AND sala_id = ?', [user_id, room_id])
+def persist_presence_snapshot():
+    # Substitui o conteúdo de usuario_sala_ativo pelo estado atual do registro em memória
+    run_blocking(replace_presence_rows, get_db(), presence.snapshot())
+
+def replace_presence_rows(db, rows):
+    db.execute('DELETE FROM usuario_sala_ativo')
+    db.executemany('INSERT INTO usuario_sala_ativo (usuario_id, sala_id) VALUES (?, ?)', rows)
     db.commit()
 
+# --- Retenção e arquivo de mensagens ---
+@functools.lru_cache(maxsize=ARCHIVE_CACHE_SEGMENTS)
+def load_archive_segment(path):
+    # Segmentos nunca mudam depois de gravados: o conteúdo descompactado pode ficar em cache
+    with gzip.open(path, 'rt', encoding='utf-8') as segment:
+        return tuple(json.loads(line) for line in segment)
+
+def get_archived_messages(room_id, before, limit):
+    # Mensagens arquivadas com id < before (todas se before for None), da mais nova para a mais antiga
+    if before is None:
+        segments = query_db('SELECT arquivo FROM arquivo_segmentos WHERE sala_id = ? ORDER BY ultimo_id DESC', [room_id])
+    else:
+        segments = query_db('SELECT arquivo FROM arquivo_segmentos WHERE sala_id = ? AND primeiro_id < ? ORDER BY ultimo_id DESC',
+                            [room_id, before])
+    messages = []
+    for segment in segments:
+        path = os.path.join(app.config['ARCHIVE_FOLDER'], segment['arquivo'])
+        for message in reversed(run_blocking(load_archive_segment, path)):
+            if before is None or message['id'] < before:
+                messages.append(message)
+                if len(messages) == limit:
+                    return messages
+    return messages
+
+def archive_cutoff(conn, room_id, max_age_days, max_per_room):
+    # Maior id da sala que está fora da janela de retenção (0 se nenhum)
+    cutoff = 0
+    if max_per_room > 0:
+        row = conn.execute('SELECT id FROM mensagens WHERE sala_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?',
+                           (room_id, max_per_room)).fetchone()
+        if row:
+            cutoff = row['id']
+    if max_age_days > 0:
+        row = conn.execute("SELECT MAX(id) AS id FROM mensagens WHERE sala_id = ? AND timestamp < datetime('now', ?)",
+                           (room_id, f'-{max_age_days} days')).fetchone()
+        if row['id']:
+            cutoff = max(cutoff, row['id'])
+    return cutoff
+
+def write_archive_segment(path, rows):
+    # Arquivo temporário próprio do processo: outro worker pode gravar o mesmo segmento
+    temp_path = f'{path}.{os.getpid()}-{uuid.uuid4().hex[:8]}.part'
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as segment:
+        for row in rows:
+            segment.write(json.dumps(dict(row), ensure_ascii=False) + '\n')
+    os.replace(temp_path, path)
+
+def archive_room(conn, room_id, cutoff, segment_size):
+    # Grava o segmento antes de apagar as linhas: se o processo parar no meio, a próxima
+    # execução regrava o mesmo arquivo e nenhuma mensagem se perde. O DELETE vem antes
+    # do registro do segmento, na mesma transação: se outro processo já arquivou a
+    # faixa, o DELETE não encontra as linhas e o segmento não é registrado de novo.
+    folder = f'sala_{room_id}'
+    os.makedirs(os.path.join(app.config['ARCHIVE_FOLDER'], folder), exist_ok=True)
+    archived = 0
+    while True:
+        rows = conn.execute('''
+            SELECT m.id, m.sala_id, m.usuario_id, u.username, m.conteudo, m.tipo, m.timestamp
+            FROM mensagens m
+            LEFT JOIN usuarios u ON m.usuario_id = u.id
+            WHERE m.sala_id = ? AND m.id <= ?
+            ORDER BY m.id
+            LIMIT ?
+        ''', (room_id, cutoff, segment_size)).fetchall()
+        if len(rows) < segment_size:
+            return archived
+        first_id, last_id = rows[0]['id'], rows[-1]['id']
+        filename = os.path.join(folder, f'{first_id}-{last_id}.ndjson.gz')
+        write_archive_segment(os.path.join(app.config['ARCHIVE_FOLDER'], filename), rows)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            deleted = conn.execute('DELETE FROM mensagens WHERE sala_id = ? AND id BETWEEN ? AND ?',
+                                   (room_id, first_id, last_id)).rowcount
+            if deleted != len(rows):
+                conn.rollback()
+                logger.warning('faixa já arquivada por outro processo',
+                               extra={'room_id': room_id, 'first_id': first_id, 'last_id': last_id})
+                return archived
+            conn.execute('INSERT INTO arquivo_segmentos (sala_id, primeiro_id, ultimo_id, quantidade, arquivo) VALUES (?, ?, ?, ?, ?)',
+                         (room_id, first_id, last_id, len(rows), filename))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        archived += len(rows)
+
+def archive_old_messages(max_age_days=None, max_per_room=None):
+    # Move para o arquivo as mensagens fora da janela de retenção; retorna quantas foram movidas
+    if max_age_days is None:
+        max_age_days = app.config['RETENTION_MAX_AGE_DAYS']
+    if max_per_room is None:
+        max_per_room = app.config['RETENTION_MAX_PER_ROOM']
+    if max_age_days <= 0 and max_per_room <= 0:
+        return 0
+    ensure_db_initialized()
+    conn = create_connection(app.config['DATABASE'])
+    try:
+        archived = 0
+        for room in conn.execute('SELECT id FROM salas').fetchall():
+            cutoff = archive_cutoff(conn, room['id'], max_age_days, max_per_room)
+            if cutoff:
+                archived += archive_room(conn, room['id'], cutoff, ARCHIVE_SEGMENT_SIZE)
+        return archived
+    finally:
+        conn.close()
+
+# --- Exportação do histórico ---
+def parse_export_time(value):
+    # Aceita 'AAAA-MM-DD', 'AAAA-MM-DD HH:MM:SS' ou ISO 8601 e devolve no formato
+    # (UTC) da coluna timestamp; ValueError se o texto for inválido
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+def iter_room_history(room_id, since=None, until=None, batch_size=EXPORT_BATCH_SIZE):
+    # Percorre todo o histórico da sala em ordem de id, em lotes por cursor (id > último
+    # enviado): antes de cada lote da tabela, lê os segmentos arquivados posteriores ao
+    # cursor (um por vez, sem passar pelo cache), o que cobre também o que a retenção
+    # mover durante a exportação.
+    # Conexão própria e transações de leitura curtas: a exportação não ocupa o pool
+    # nem impede o checkpoint do WAL. `since` é inclusivo e `until` exclusivo.
+    in_range = lambda timestamp: (since is None or timestamp >= since) and (until is None or timestamp < until)
+    filters = ''
+    filter_args = []
+    if since is not None:
+        filters += ' AND m.timestamp >= ?'
+        filter_args.append(since)
+    if until is not None:
+        filters += ' AND m.timestamp < ?'
+        filter_args.append(until)
+    conn = create_connection(app.config['DATABASE'])
+    try:
+        last_id = 0
+        while True:
+            segments = run_blocking(fetch_all, conn, 'SELECT arquivo, ultimo_id FROM arquivo_segmentos WHERE sala_id = ? AND ultimo_id > ? ORDER BY primeiro_id',
+                                    (room_id, last_id))
+            for segment in segments:
+                path = os.path.join(app.config['ARCHIVE_FOLDER'], segment['arquivo'])
+                for message in run_blocking(load_archive_segment.__wrapped__, path):
+                    if message['id'] > last_id and in_range(message['timestamp']):
+                        yield message
+                last_id = segment['ultimo_id']
+            rows = run_blocking(fetch_all, conn, f'''
+                SELECT m.id, m.sala_id, u.username, m.conteudo, m.tipo, m.timestamp
+                FROM mensagens m
+                LEFT JOIN usuarios u ON m.usuario_id = u.id
+                WHERE m.sala_id = ? AND m.id > ?{filters}
+                ORDER BY m.id
+                LIMIT ?
+            ''', [room_id, last_id] + filter_args + [batch_size])
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1]['id']
+    finally:
+        conn.close()
+
+def format_export(messages, export_format, batch_size=EXPORT_BATCH_SIZE):
+    # Converte as mensagens em blocos de texto de até batch_size linhas
+    buffer = io.StringIO()
+    if export_format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        write = lambda message: writer.writerow([message[field] for field in EXPORT_FIELDS])
+    else:
+        write = lambda message: buffer.write(json.dumps({field: message[field] for field in EXPORT_FIELDS}, ensure_ascii=False) + '\n')
+    for count, message in enumerate(messages, 1):
+        write(message)
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def encode_export(chunks, compress):
+    # Compacta em gzip à medida que os blocos são gerados
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    for chunk in chunks:
+        data = chunk.encode()
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+retention_worker_lock = threading.Lock()
+retention_worker_started = False
+
+def start_retention_worker():
+    global retention_worker_started
+    if retention_worker_started or (app.config['RETENTION_MAX_AGE_DAYS'] <= 0 and app.config['RETENTION_MAX_PER_ROOM'] <= 0):
+        return
+    with retention_worker_lock:
+        if not retention_worker_started:
+            retention_worker_started = True
+            socketio.start_background_task(retention_worker)
+
+# Com vários workers só o dono da trava 'retencao' arquiva; ela vale por dois
+# intervalos e passa a outro processo se o dono parar de renová-la
+retention_lock_owner = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+def acquire_lock(name, owner, ttl):
+    # Pega (ou renova) a trava se estiver livre, vencida ou já for deste dono
+    conn = create_connection(app.config['DATABASE'])
+    try:
+        now = time.time()
+        with conn:
+            conn.execute('''
+                INSERT INTO travas (nome, dono, expira_em) VALUES (?, ?, ?)
+                ON CONFLICT (nome) DO UPDATE SET dono = excluded.dono, expira_em = excluded.expira_em
+                WHERE travas.dono = excluded.dono OR travas.expira_em < ?
+            ''', (name, owner, now + ttl, now))
+            row = conn.execute('SELECT dono FROM travas WHERE nome = ?', (name,)).fetchone()
+        return row['dono'] == owner
+    finally:
+        conn.close()
+
+def retention_worker():
+    while True:
+        try:
+            ensure_db_initialized()
+            if run_blocking(acquire_lock, 'retencao', retention_lock_owner,
+                            2 * app.config['RETENTION_INTERVAL']):
+                archived = run_blocking(archive_old_messages)
+                if archived:
+                    logger.info('mensagens arquivadas', extra={'count': archived})
+        except (sqlite3.Error, OSError) as e:
+            logger.error('erro ao arquivar mensagens', extra={'error': str(e)})
+        socketio.sleep(app.config['RETENTION_INTERVAL'])
+
+# --- Limites de taxa e backpressure ---
+class RateLimiter:
+    """Token buckets por (sid, evento) e por (usuário, evento). Um evento só é
+    aceito se os dois buckets tiverem uma ficha; nesse caso ambos são debitados."""
+
+    def __init__(self):
+        self._sids = {} # sid -> {evento: [fichas, atualizado_em]}
+        self._users = {} # usuário -> {evento: [fichas, atualizado_em]}
+        self._user_sids = {} # usuário -> sids conectados; o bucket sai com o último
+        self._sid_users = {} # sid -> usuário
+        self._lock = threading.Lock()
+
+    def check(self, event, sid, user_id):
+        # Retorna 0 se o evento foi aceito, ou os segundos até haver uma ficha disponível
+        limits = app.config['RATE_LIMITS'].get(event)
+        scale = app.config['RATE_LIMIT_SCALE']
+        if not limits or scale <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            if sid is not None and 'sid' in limits:
+                buckets.append((self._sids.setdefault(sid, {}), limits['sid']))
+            if user_id is not None and 'user' in limits:
+                buckets.append((self._users.setdefault(user_id, {}), limits['user']))
+                if self._sid_users.setdefault(sid, user_id) == user_id:
+                    self._user_sids.setdefault(user_id, set()).add(sid)
+            wait = 0
+            refilled = []
+            for owner, (rate, burst) in buckets:
+                rate *= scale
+                tokens, updated = owner.get(event, (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                refilled.append((owner, tokens))
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            for owner, tokens in refilled:
+                owner[event] = [tokens - 1 if not wait else tokens, now]
+            return wait
+
+    def forget(self, sid):
+        with self._lock:
+            self._sids.pop(sid, None)
+            user_id = self._sid_users.pop(sid, None)
+            sids = self._user_sids.get(user_id)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._user_sids[user_id]
+                    self._users.pop(user_id, None)
+
+rate_limiter = RateLimiter()
+
+class MovingAverage:
+    """Média móvel exponencial (usada na latência de gravação das mensagens).
+    Sem novas amostras o valor decai pela metade a cada half_life segundos:
+    como as gravações param justamente quando o backpressure recusa as
+    mensagens, sem o decaimento uma média alta recusaria tudo para sempre."""
+
+    def __init__(self, alpha=0.2, half_life=2.0):
+        self.alpha = alpha
+        self.half_life = half_life
+        self._value = 0.0
+        self._updated = time.monotonic()
+
+    @property
+    def value(self):
+        elapsed = time.monotonic() - self._updated
+        return self._value * 0.5 ** (elapsed / self.half_life)
+
+    def observe(self, sample):
+        value = self.value
+        self._value = value + self.alpha * (sample - value)
+        self._updated = time.monotonic()
+
+write_latency = MovingAverage()
+
+def write_backpressure():
+    # Segundos que o cliente deve aguardar quando a gravação está sobrecarregada (0 se não estiver)
+    if (message_writer.queue_depth() > app.config['BACKPRESSURE_QUEUE_DEPTH']
+            or write_latency.value > app.config['BACKPRESSURE_WRITE_LATENCY']):
+        return BACKPRESSURE_RETRY_AFTER
+    return 0
+
+def send_throttled(event, retry_after, reason, data=None):
+    # Avisa apenas o remetente; no send_message devolve o texto para que não se perca
+    throttled_events.inc(1, event, reason)
+    payload = {'event': event, 'reason': reason, 'retry_after': round(retry_after, 2)}
+    if event == 'send_message' and isinstance(data, dict):
+        payload['message'] = data.get('message')
+    emit('throttled', payload)
+
+def rate_limited(handler):
+    # Recusa o evento com 'throttled' quando o sid ou o usuário excedeu o limite
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        event = request.event['message']
+        retry_after = rate_limiter.check(event, request.sid, session.get('user_id'))
+        if retry_after:
+            send_throttled(event, retry_after, 'rate_limit', args[0] if args else None)
+            return
+        return handler(*args, **kwargs)
+    return wrapper
+
+# --- Gravação de mensagens em lote (group commit) ---
+class MessageWriter:
+    """Thread em segundo plano que agrupa as mensagens recebidas e faz um único
+    commit por lote, limitado pelo tamanho do lote e pelo tempo de espera."""
+
+    _STOP = object()
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+        self.lock_wait_seconds = 0.0 # tempo aguardando o lock de escrita do SQLite
+        self.max_lock_wait = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                args=(app.config['DATABASE'],
+                                                      app.config['MESSAGE_BATCH_SIZE'],
+                                                      app.config['MESSAGE_BATCH_INTERVAL']),
+                                                name='message-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, params):
+        future = Future()
+        if self._thread is None:
+            self.start()
+        self._queue.put((params, future))
+        return future
+
+    def stop(self):
+        # Grava tudo o que ainda está na fila antes de encerrar
+        with self._lock:
+            thread = self._thread
+            if thread is None or not thread.is_alive():
+                return
+            self._queue.put(self._STOP)
+        thread.join()
+        with self._lock:
+            self._thread = None
+
+    def _run(self, database, batch_size, interval):
+        conn = create_connection(database)
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is self._STOP:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + interval
+                while len(batch) < batch_size:
+                    timeout = deadline - time.monotonic()
+                    try:
+                        item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is self._STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._finish_batch(batch, *run_blocking(self._write_batch, conn, batch))
+        finally:
+            conn.close()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'queue_depth': self.queue_depth(),
+            'lock_wait_seconds': self.lock_wait_seconds,
+            'max_lock_wait': self.max_lock_wait,
+        }
+
+    def _write_batch(self, conn, batch):
+        # Só o acesso ao SQLite, que roda no pool de I/O nos modos assíncronos. Retorna
+        # (id ou exceção de cada mensagem, totais por sala, espera pelo lock, duração);
+        # a espera e a duração são None quando o lote precisou ser regravado uma a uma.
+        try:
+            # BEGIN IMMEDIATE reserva o lock de escrita logo no início, o que permite medir a espera
+            start = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            waited = time.perf_counter() - start
+            # Um INSERT por mensagem (para obter o id), mas um único commit por lote
+            message_ids = [conn.execute(INSERT_MESSAGE_SQL, params).lastrowid for params, _ in batch]
+            totals = count_new_messages(conn, [(params[0], message_id)
+                                               for (params, _), message_id in zip(batch, message_ids)])
+            conn.commit()
+            return message_ids, totals, waited, time.perf_counter() - start
+        except sqlite3.Error:
+            conn.rollback()
+        # Regrava uma a uma para que uma mensagem inválida não descarte o lote inteiro
+        results = []
+        totals = {}
+        for params, _ in batch:
+            try:
+                message_id = conn.execute(INSERT_MESSAGE_SQL, params).lastrowid
+                totals.update(count_new_messages(conn, [(params[0], message_id)]))
+                conn.commit()
+                results.append(message_id)
+            except sqlite3.Error as e:
+                conn.rollback()
+                results.append(e)
+        return results, totals, None, None
+
+    def _finish_batch(self, batch, results, totals, waited, elapsed):
+        # Métricas e Futures na thread do gravador: os callbacks emitem eventos Socket.IO
+        if waited is not None:
+            self.batches += 1
+            self.rows += len(batch)
+            self.lock_wait_seconds += waited
+            self.max_lock_wait = max(self.max_lock_wait, waited)
+            db_lock_wait.observe(waited)
+            write_latency.observe(elapsed)
+            db_commit_latency.observe(elapsed, 'batch')
+            db_commits.inc(1, 'batch')
+        persisted = [result for result in results if not isinstance(result, Exception)]
+        if waited is None:
+            db_commits.inc(len(persisted), 'batch')
+        messages_persisted.inc(len(persisted), 'batch')
+        room_activity.record(totals)
+        for (params, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error('erro ao gravar mensagem', extra={'error': str(result), 'room_id': params[0]})
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+message_writer = MessageWriter()
+# atexit executa em ordem inversa: primeiro esvazia a fila, depois fecha o pool
+atexit.register(close_pool)
+atexit.register(message_writer.stop)
+
+# --- Mensagens recentes (catch-up na reconexão) ---
+class RecentMessages:
+    """Últimas mensagens gravadas de cada sala, em ordem de id. Responde ao
+    catch-up de quem reconectou sem consultar o SQLite, desde que o último id
+    visto pelo cliente ainda esteja dentro do buffer."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._rooms = {} # sala -> lista de mensagens (dicts do evento 'new_message')
+        self._lock = threading.Lock()
+
+    def add(self, room_id, message):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            messages = self._rooms.setdefault(int(room_id), [])
+            # No modo 'sync' os commits concorrentes podem chegar fora de ordem
+            bisect.insort(messages, message, key=lambda item: item['id'])
+            if len(messages) > self.capacity:
+                del messages[:len(messages) - self.capacity]
+
+    def since(self, room_id, last_seen_id):
+        # None quando o buffer não garante ter todas as mensagens posteriores a last_seen_id
+        with self._lock:
+            messages = self._rooms.get(int(room_id))
+            if not messages or last_seen_id < messages[0]['id']:
+                return None
+            start = bisect.bisect_right(messages, last_seen_id, key=lambda item: item['id'])
+            return messages[start:]
+
+# Com vários workers cada processo só vê as próprias mensagens: o catch-up vai ao banco
+recent_messages = RecentMessages(0 if multi_worker else app.config['RECENT_MESSAGES_PER_ROOM'])
+
+timestamp_cache = (0, '')
+
+def current_timestamp():
+    # O texto só muda uma vez por segundo: evita um strftime por mensagem
+    global timestamp_cache
+    second = int(time.time())
+    if timestamp_cache[0] != second:
+        timestamp_cache = (second, datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S'))
+    return timestamp_cache[1]
+
+# Id provisório de cada mensagem: o 'new_message' sai antes do commit e o id
+# definitivo (cursor do catch-up) chega depois em 'messages_persisted'
+temp_id_prefix = f'{uuid.uuid4().hex[:8]}-' if multi_worker else ''
+temp_id_sequence = itertools.count(1)
+
+def next_temp_id():
+    return f'{temp_id_prefix}{next(temp_id_sequence)}'
+
+def track_message(pending, message_data):
+    # Após o commit a mensagem entra no buffer de catch-up e a sala recebe o id
+    # definitivo; se a gravação falhar, o id vai como None e o cliente descarta a mensagem
+    room_id = message_data['room_id']
+    def on_persisted(future):
+        message_id = None
+        if future.exception() is None:
+            message_id = future.result()
+            # Cópia: o evento original pode estar sendo serializado em outra thread
+            stored = {**message_data, 'id': message_id}
+            if 'timestamp' not in stored:
+                # Mensagem em lote (o timestamp do lote pode diferir em até um tick)
+                # ou imagem gravada antes de a miniatura ficar pronta
+                stored['timestamp'] = current_timestamp()
+            recent_messages.add(room_id, stored)
+        room_broadcaster.persisted(room_id, message_data['temp_id'], message_id)
+    pending.add_done_callback(on_persisted)
+
+def broadcast_message(message_data):
+    # Envia a mensagem na hora, sem esperar o commit, identificada pelo temp_id.
+    # Nas salas em lote o timestamp é atribuído uma vez por lote no flush
+    room_id = message_data['room_id']
+    if room_broadcaster.batches(room_id):
+        room_broadcaster.add(room_id, message_data)
+    else:
+        message_data['timestamp'] = current_timestamp()
+        socketio.emit('new_message', message_data, room=f'room_{room_id}')
+
+def get_missed_messages(room_id, last_seen_id):
+    # Retorna (mensagens, reset); reset indica que a lacuna era grande demais e
+    # as mensagens são apenas a página mais recente
+    cached = recent_messages.since(room_id, last_seen_id)
+    if cached is not None:
+        return cached, False
+    # Parte do que o cliente perdeu pode já ter ido para o arquivo (retenção): o
+    # catch-up só lê a tabela, então a lacuna vira um reset
+    archived = query_db('SELECT 1 FROM arquivo_segmentos WHERE sala_id = ? AND ultimo_id > ? LIMIT 1',
+                        [room_id, last_seen_id], one=True)
+    rows = [] if archived else get_messages_after(room_id, last_seen_id, CATCH_UP_MAX + 1)
+    if archived or len(rows) > CATCH_UP_MAX:
+        rows = get_messages_page(room_id, limit=app.config['MESSAGES_PAGE_SIZE'])
+        return [serialize_message(row, room_id) for row in rows], True
+    return [serialize_message(row, room_id) for row in rows], False
+
+def send_catch_up(room_id, last_seen_id):
+    # Um único evento com tudo o que o cliente perdeu enquanto estava desconectado.
+    # Ignora cursores que não sejam um id válido (inteiro do SQLite, não negativo)
+    if isinstance(last_seen_id, str):
+        try:
+            last_seen_id = int(last_seen_id)
+        except ValueError:
+            return
+    if type(last_seen_id) is not int or not 0 <= last_seen_id <= SQLITE_MAX_INTEGER:
+        return
+    messages, reset = get_missed_messages(room_id, last_seen_id)
+    if messages or reset:
+        emit('missed_messages', {'room_id': room_id, 'messages': messages, 'reset': reset})
+
+# --- Envio em lote das mensagens (new_messages) ---
+MESSAGE_TYPE_CODES = {'text': 0, 'image': 1}
+MESSAGE_BATCH_VERSION = 3
+BATCH_SHARED_FIELDS = ('room_id', 'timestamp') # enviados uma vez no lote, não em cada mensagem
+
+def encode_message_batch(room_id, timestamp, messages):
+    # Formato binário (big-endian) decodificado por decodeMessageBatch em chat.html:
+    #   versão (B), sala (I), quantidade (I), timestamp (B + bytes)
+    #   por mensagem: temp_id (I), tipo (B), usuário (H + bytes), conteúdo (I + bytes), miniatura (H + bytes)
+    # O formato binário só é usado com um único worker, quando o temp_id é numérico.
+    encoded_timestamp = timestamp.encode()
+    parts = [struct.pack('!BIIB', MESSAGE_BATCH_VERSION, room_id, len(messages), len(encoded_timestamp)), encoded_timestamp]
+    for message in messages:
+        username = message['username'].encode()
+        content = message['message'].encode()
+        thumbnail = (message.get('thumbnail') or '').encode()
+        parts.append(struct.pack('!IBH', int(message['temp_id']), MESSAGE_TYPE_CODES[message['type']], len(username)))
+        parts.append(username)
+        parts.append(struct.pack('!I', len(content)))
+        parts.append(content)
+        parts.append(struct.pack('!H', len(thumbnail)))
+        parts.append(thumbnail)
+    return b''.join(parts)
+
+class RoomBroadcaster:
+    """Agrupa as mensagens de cada sala recebidas dentro de um tick em um único
+    evento 'new_messages', serializado uma vez e entregue a todos os inscritos.
+    As confirmações de gravação da sala ('messages_persisted') seguem no mesmo tick."""
+
+    def __init__(self):
+        self._pending = {} # sala -> mensagens aguardando o próximo tick
+        self._persisted = {} # sala -> [[temp_id, id], ...] aguardando o próximo tick
+        self._lock = threading.Lock()
+        self._started = False
+        self.frames = 0
+        self.messages = 0
+
+    def batches(self, room_id):
+        rooms = app.config['BROADCAST_ROOMS']
+        return app.config['BROADCAST_TICK'] > 0 and (not rooms or int(room_id) in rooms)
+
+    def add(self, room_id, message):
+        with self._lock:
+            self._pending.setdefault(int(room_id), []).append(message)
+            self._start()
+
+    def persisted(self, room_id, temp_id, message_id):
+        if not self.batches(room_id):
+            socketio.emit('messages_persisted', {'room_id': room_id, 'ids': [[temp_id, message_id]]},
+                          room=f'room_{room_id}')
+            return
+        with self._lock:
+            self._persisted.setdefault(int(room_id), []).append([temp_id, message_id])
+            self._start()
+
+    def _start(self):
+        if not self._started:
+            self._started = True
+            socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(app.config['BROADCAST_TICK'])
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            persisted, self._persisted = self._persisted, {}
+        if not pending and not persisted:
+            return
+        timestamp = current_timestamp() # um por lote
+        # A fila entre processos serializa em JSON, que não transporta bytes
+        binary = app.config['BROADCAST_ENCODING'] == 'binary' and not multi_worker
+        for room_id, messages in pending.items():
+            if binary:
+                payload = encode_message_batch(room_id, timestamp, messages)
+            else:
+                payload = {
+                    'room_id': room_id,
+                    'timestamp': timestamp,
+                    'messages': [{key: value for key, value in message.items() if key not in BATCH_SHARED_FIELDS}
+                                 for message in messages]
+                }
+            socketio.emit('new_messages', payload, room=f'room_{room_id}')
+            self.frames += 1
+            self.messages += len(messages)
+        # Depois das mensagens, para que o cliente já as tenha quando o id chegar
+        for room_id, ids in persisted.items():
+            socketio.emit('messages_persisted', {'room_id': room_id, 'ids': ids}, room=f'room_{room_id}')
+
+room_broadcaster = RoomBroadcaster()
+
+# --- Atividade das salas (mensagens não lidas) ---
+class RoomActivity:
+    """Último id e total de mensagens das salas que receberam mensagens desde o
+    último envio. O presence_flusher transforma as mudanças de cada intervalo em
+    um 'room_activity' por sala; cada cliente calcula as não lidas com o total
+    e o seu próprio cursor de leitura."""
+
+    def __init__(self):
+        self._changes = {} # sala -> (último id, total de mensagens)
+        self._lock = threading.Lock()
+
+    def record(self, totals):
+        with self._lock:
+            for room_id, (last_id, total) in totals.items():
+                previous = self._changes.get(room_id)
+                if previous is None or previous[1] < total:
+                    self._changes[room_id] = (last_id, total)
+
+    def pop_changes(self):
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        return changes
+
+room_activity = RoomActivity()
+
+# --- Presença em memória ---
+class PresenceRegistry:
+    """Usuários ativos por sala, indexados pelo sid de cada conexão Socket.IO.
+    Um usuário com várias abas abertas conta uma única vez e só sai da sala
+    quando a última aba desconecta. Com vários workers, as salas dos demais
+    processos chegam por update_peer e entram na contagem."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms = {} # room_id -> {user_id: {sid, ...}}
+        self._sids = {} # sid -> {room_id: user_id}
+        self._peers = {} # worker -> ({room_id: {user_id, ...}}, expira_em)
+        self._dirty = set()
+        self.version = 0
+        self.local_version = 0
+
+    @staticmethod
+    def _room_key(room_id):
+        try:
+            return int(room_id)
+        except (TypeError, ValueError):
+            return None
+
+    def join(self, room_id, user_id, sid):
+        room_id = self._room_key(room_id)
+        if room_id is None:
+            return False
+        with self._lock:
+            users = self._rooms.setdefault(room_id, {})
+            before = self._count(room_id)
+            users.setdefault(user_id, set()).add(sid)
+            self._sids.setdefault(sid, {})[room_id] = user_id
+            return self._touch(room_id, before, self._count(room_id))
+
+    def leave(self, room_id, sid):
+        room_id = self._room_key(room_id)
+        with self._lock:
+            return self._leave(room_id, sid)
+
+    def leave_all(self, sid):
+        # Remove o sid de todas as salas; retorna as salas em que ele estava
+        with self._lock:
+            room_ids = list(self._sids.get(sid, {}))
+            for room_id in room_ids:
+                self._leave(room_id, sid)
+            return room_ids
+
+    def _leave(self, room_id, sid):
+        rooms = self._sids.get(sid)
+        if not rooms or room_id not in rooms:
+            return False
+        user_id = rooms.pop(room_id)
+        if not rooms:
+            del self._sids[sid]
+        users = self._rooms[room_id]
+        before = self._count(room_id)
+        sids = users[user_id]
+        sids.discard(sid)
+        if not sids:
+            del users[user_id]
+        if not users:
+            del self._rooms[room_id]
+        return self._touch(room_id, before, self._count(room_id))
+
+    def _touch(self, room_id, before, after, local=True):
+        if local:
+            self.local_version += 1
+        if before == after:
+            return False
+        self._dirty.add(room_id)
+        self.version += 1
+        return True
+
+    def _users(self, room_id):
+        users = set(self._rooms.get(room_id, ()))
+        for peer_rooms, _ in self._peers.values():
+            users.update(peer_rooms.get(room_id, ()))
+        return users
+
+    def _count(self, room_id):
+        if not self._peers:
+            return len(self._rooms.get(room_id, ()))
+        return len(self._users(room_id))
+
+    def _room_ids(self):
+        room_ids = set(self._rooms)
+        for peer_rooms, _ in self._peers.values():
+            room_ids.update(peer_rooms)
+        return room_ids
+
+    def count(self, room_id):
+        room_id = self._room_key(room_id)
+        with self._lock:
+            return self._count(room_id)
+
+    def counts(self):
+        with self._lock:
+            counts = {room_id: self._count(room_id) for room_id in self._room_ids()}
+            return {room_id: count for room_id, count in counts.items() if count}
+
+    def snapshot(self):
+        with self._lock:
+            return [(user_id, room_id) for room_id in self._room_ids() for user_id in self._users(room_id)]
+
+    def local_state(self):
+        # Estado anunciado aos outros workers: [[room_id, [user_id, ...]], ...]
+        with self._lock:
+            return [[room_id, list(users)] for room_id, users in self._rooms.items()]
+
+    def update_peer(self, worker_id, state):
+        rooms = {int(room_id): set(user_ids) for room_id, user_ids in state}
+        with self._lock:
+            previous = self._peers.get(worker_id, ({}, 0))[0]
+            affected = set(previous) | set(rooms)
+            before = {room_id: self._count(room_id) for room_id in affected}
+            if rooms:
+                self._peers[worker_id] = (rooms, time.monotonic() + PRESENCE_PEER_TTL)
+            else:
+                self._peers.pop(worker_id, None)
+            for room_id in affected:
+                self._touch(room_id, before[room_id], self._count(room_id), local=False)
+
+    def expire_peers(self):
+        # Descarta workers que pararam de anunciar (encerrados ou travados)
+        now = time.monotonic()
+        with self._lock:
+            expired = [worker_id for worker_id, (_, expires_at) in self._peers.items() if expires_at < now]
+            for worker_id in expired:
+                rooms = self._peers[worker_id][0]
+                before = {room_id: self._count(room_id) for room_id in rooms}
+                del self._peers[worker_id]
+                for room_id in rooms:
+                    self._touch(room_id, before[room_id], self._count(room_id), local=False)
+
+    def pop_changes(self):
+        # Salas cuja contagem mudou desde a última chamada, com a contagem atual
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            return {room_id: self._count(room_id) for room_id in dirty}
+
+presence = PresenceRegistry()
+presence_flusher_lock = threading.Lock()
+presence_flusher_started = False
+
+def start_presence_flusher():
+    global presence_flusher_started
+    with presence_flusher_lock:
+        if not presence_flusher_started:
+            presence_flusher_started = True
+            socketio.start_background_task(presence_flusher)
+
+def presence_flusher():
+    # Agrupa as mudanças de presença de cada intervalo em um único
+    # 'active_users_update' por sala, enviado à sala e à lista de salas.
+    # Com vários workers cada um calcula a contagem global e avisa apenas os
+    # seus próprios clientes (ignore_queue), evitando entregas duplicadas.
+    last_sent = {}
+    persisted_version = None
+    last_persist = time.monotonic()
+    announced_version = None
+    last_announce = 0
+    while True:
+        socketio.sleep(PRESENCE_FLUSH_INTERVAL)
+        if multi_worker:
+            presence.expire_peers()
+            if presence.local_version != announced_version or time.monotonic() - last_announce >= PRESENCE_HEARTBEAT_INTERVAL:
+                announced_version = presence.local_version
+                last_announce = time.monotonic()
+                socketio.emit(PRESENCE_SYNC_EVENT, presence.local_state(), namespace=PRESENCE_SYNC_NAMESPACE)
+
+        for room_id, count in presence.pop_changes().items():
+            if last_sent.get(room_id) == count:
+                continue
+            last_sent[room_id] = count
+            update = {'room_id': room_id, 'count': count}
+            socketio.emit('active_users_update', update, room=f'room_{room_id}', ignore_queue=True)
+            socketio.emit('active_users_update', update, room=ROOMS_LIST_CHANNEL, ignore_queue=True)
+
+        # Os totais vêm do banco e valem para todos os workers, então passam pela fila
+        for room_id, (last_id, total) in room_activity.pop_changes().items():
+            socketio.emit('room_activity', {'room_id': room_id, 'last_message_id': last_id, 'message_count': total},
+                          room=ROOMS_LIST_CHANNEL)
+
+        persist_interval = app.config['PRESENCE_PERSIST_INTERVAL']
+        if persist_interval and time.monotonic() - last_persist >= persist_interval:
+            last_persist = time.monotonic()
+            if presence.version != persisted_version:
+                persisted_version = presence.version
+                try:
+                    with app.app_context():
+                        persist_presence_snapshot()
+                except sqlite3.Error as e:
+                    logger.error('erro ao persistir presença', extra={'error': str(e)})
+
+# --- Hash de senhas ---
+class PasswordHasherBusy(Exception):
+    """Fila do pool de hash cheia; a requisição deve ser recusada."""
+
+class PasswordHasher:
+    """Executa o scrypt em um pool de threads (o OpenSSL libera o GIL), com um
+    limite de tarefas pendentes para que uma rajada de logins não acumule
+    trabalho indefinidamente. Mantém contadores para monitoramento."""
+
+    def __init__(self, workers, max_pending):
+        self._pool = BlockingPool(workers, 'kdf')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = native_lock() # também usado dentro das threads do pool
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+
+    def run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHasherBusy()
+        with self._lock:
+            self.pending += 1
+        try:
+            return self._pool.run(self._call, function, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+
+    def _call(self, function, *args):
+        with self._lock:
+            self.running += 1
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                self.busy_seconds += elapsed
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'queue_depth': self.pending - self.running,
+                'running': self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'busy_seconds': self.busy_seconds,
+            }
+
+password_hasher = PasswordHasher(KDF_WORKERS, KDF_MAX_PENDING)
+atexit.register(password_hasher.shutdown)
+
+def compute_scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * r * n * p, dklen=32)
+
+def encode_b64(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+def decode_b64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+def hash_password_blocking(password):
+    salt = os.urandom(16)
+    digest = compute_scrypt(password, salt, KDF_SCRYPT_N, KDF_SCRYPT_R, KDF_SCRYPT_P)
+    return f'scrypt${KDF_SCRYPT_N}${KDF_SCRYPT_R}${KDF_SCRYPT_P}${encode_b64(salt)}${encode_b64(digest)}'
+
+def verify_password_blocking(stored_password_hash, provided_password):
+    if not stored_password_hash.startswith('scrypt$'):
+        # Formato antigo: SHA-256 sem salt
+        legacy = hashlib.sha256(provided_password.encode()).hexdigest()
+        return hmac.compare_digest(stored_password_hash, legacy)
+    _, n, r, p, salt, digest = stored_password_hash.split('$')
+    computed = compute_scrypt(provided_password, decode_b64(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(computed, decode_b64(digest))
+
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    return password_hasher.run(hash_password_blocking, password)
 
 def verify_password(stored_password_hash, provided_password):
-    return stored_password_hash == hash_password(provided_password)
+    return password_hasher.run(verify_password_blocking, stored_password_hash, provided_password)
+
+def password_needs_rehash(stored_password_hash):
+    # Hashes SHA-256 antigos ou com custo diferente do atual são refeitos no login
+    return stored_password_hash.split('$')[:4] != ['scrypt', str(KDF_SCRYPT_N), str(KDF_SCRYPT_R), str(KDF_SCRYPT_P)]
+
+# --- Snapshot da lista de salas (/api/rooms) ---
+rooms_version = 0
+rooms_version_lock = threading.Lock()
+room_list_snapshot = None # (versão, criado_em, lista de salas)
+
+def invalidate_room_list():
+    global rooms_version
+    with rooms_version_lock:
+        rooms_version += 1
+
+def get_room_list_snapshot():
+    # Reaproveita a lista já montada enquanto nenhuma sala for criada e a presença
+    # não mudar; caso contrário monta de novo com uma única consulta.
+    global room_list_snapshot
+    version = (rooms_version, presence.version)
+    snapshot = room_list_snapshot
+    if snapshot and snapshot[0] == version and time.monotonic() - snapshot[1] < ROOM_LIST_CACHE_TTL:
+        return snapshot[2]
+
+    counts = presence.counts()
+    room_list = [{
+        'id': room['id'],
+        'name': room['nome'],
+        'active_users': counts.get(room['id'], 0)
+    } for room in get_rooms()]
+    room_list_snapshot = (version, time.monotonic(), room_list)
+    return room_list
+
+def get_room_list(user_id):
+    # Parte comum do snapshot + contadores de não lidas do usuário
+    unread = get_unread_counts(user_id)
+    room_list = [dict(room, **unread.get(room['id'], {})) for room in get_room_list_snapshot()]
+    body = json.dumps(room_list)
+    return body, hashlib.sha1(body.encode()).hexdigest()
+
+# --- Uploads de imagens ---
+CONTENT_ADDRESSED_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z]+$')
+thumbnail_executor = None
+thumbnail_executor_lock = threading.Lock()
+
+def store_upload(stream, extension):
+    # Grava o arquivo em blocos enquanto calcula o SHA-256; o nome final é o hash,
+    # então um conteúdo já enviado reaproveita o arquivo existente.
+    # Retorna o nome do arquivo, ou None se ultrapassar UPLOAD_MAX_BYTES.
+    folder = app.config['UPLOADS_FOLDER']
+    temp_path = os.path.join(folder, f'.{uuid.uuid4().hex}.part')
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > app.config['UPLOAD_MAX_BYTES']:
+                    return None
+                digest.update(chunk)
+                temp_file.write(chunk)
+        filename = f'{digest.hexdigest()}.{extension}'
+        final_path = os.path.join(folder, filename)
+        if not os.path.exists(final_path):
+            os.replace(temp_path, final_path)
+        return filename
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def thumbnail_url(image_url):
+    # Uploads antigos (nomes com uuid) não têm miniatura: usa a imagem original
+    filename = image_url.rsplit('/', 1)[-1]
+    if Image is None or not CONTENT_ADDRESSED_NAME.match(filename):
+        return image_url
+    return image_url.rsplit('/', 1)[0] + '/thumbs/' + filename
+
+def generate_thumbnail(source_path, thumbnail_path, size):
+    # Executada em um processo do pool, fora do caminho da requisição
+    temp_path = f'{thumbnail_path}.{os.getpid()}.part'
+    image_format = Image.registered_extensions()['.' + thumbnail_path.rsplit('.', 1)[1]]
+    with Image.open(source_path) as image:
+        image.thumbnail((size, size))
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(temp_path, format=image_format)
+    os.replace(temp_path, thumbnail_path)
+
+def get_thumbnail_executor():
+    global thumbnail_executor
+    with thumbnail_executor_lock:
+        if thumbnail_executor is None:
+            thumbnail_executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+        return thumbnail_executor
+
+def shutdown_thumbnail_executor():
+    if thumbnail_executor is not None:
+        thumbnail_executor.shutdown(wait=True)
+
+atexit.register(shutdown_thumbnail_executor)
+
+def schedule_thumbnail(filename, callback):
+    # Chama callback(True) quando a miniatura estiver pronta, ou callback(False)
+    # se ela não puder ser gerada (Pillow ausente ou imagem inválida).
+    thumbnail_path = os.path.join(app.config['THUMBNAILS_FOLDER'], filename)
+    if Image is None:
+        callback(False)
+        return
+    if os.path.exists(thumbnail_path):
+        callback(True)
+        return
+    source_path = os.path.join(app.config['UPLOADS_FOLDER'], filename)
+
+    def finish(error):
+        if error is not None:
+            logger.warning('erro ao gerar miniatura', extra={'file': filename, 'error': str(error)})
+        callback(error is None)
+
+    if io_pool is not None:
+        # eventlet/gevent: o ProcessPoolExecutor depende de threads reais, então a
+        # miniatura é gerada no pool de I/O e o callback roda em uma green thread
+        def generate():
+            try:
+                run_blocking(generate_thumbnail, source_path, thumbnail_path, THUMBNAIL_SIZE)
+            except Exception as error:
+                finish(error)
+            else:
+                finish(None)
+        socketio.start_background_task(generate)
+        return
+    future = get_thumbnail_executor().submit(generate_thumbnail, source_path, thumbnail_path, THUMBNAIL_SIZE)
+    future.add_done_callback(lambda future: finish(future.exception()))
+
+app.add_template_filter(thumbnail_url)
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -160,19 +2241,33 @@ def allowed_file(filename):
 # --- Rotas Flask (com pequenas modificações) ---
 @app.before_request
 def before_request():
-    if 'db' not in g:
-        g.db = sqlite3.connect(app.config['DATABASE'])
-        g.db.row_factory = sqlite3.Row
-    if not os.path.exists(app.config['DATABASE']):
-        init_db()
-    if 'user_id' not in session and request.endpoint not in ['login', 'register', 'static', 'create_room', 'get_rooms_api', 'join_room_api', 'upload_image']:
+    g.request_started = time.perf_counter()
+    ensure_db_initialized()
+    start_retention_worker()
+    if 'user_id' not in session and request.endpoint not in ['login', 'register', 'static', 'create_room', 'get_rooms_api', 'join_room_api', 'upload_image', 'get_room_messages_api', 'search_room_messages_api', 'search_messages_api', 'metrics_endpoint', 'export_room_api']:
         return redirect(url_for('login'))
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+@app.after_request
+def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        http_request_latency.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                                     request.method, response.status_code)
+    return response
+
+def metrics_authorized():
+    # Fica fora do login (o Prometheus não tem sessão), mas exige o token ou loopback
+    token = app.config['METRICS_TOKEN']
+    if token:
+        scheme, _, supplied = request.headers.get('Authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(supplied.encode(), token.encode())
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 @app.route('/')
 def index():
@@ -186,12 +2281,17 @@ def login():
         username = request.form['username']
         password = request.form['password']
         user = get_user_by_username(username)
-        if user and verify_password(user['password_hash'], password):
-            session['user_id'] = user['id']
-            session['username'] = user['username']
-            return redirect(url_for('rooms'))
-        else:
-            return render_template('login.html', error="Usuário ou senha incorretos.")
+        try:
+            if user and verify_password(user['password_hash'], password):
+                # Migra transparentemente hashes antigos para o scrypt
+                if password_needs_rehash(user['password_hash']):
+                    update_user_password(user['id'], hash_password(password))
+                session['user_id'] = user['id']
+                session['username'] = user['username']
+                return redirect(url_for('rooms'))
+        except PasswordHasherBusy:
+            return render_template('login.html', error="Servidor ocupado, tente novamente em instantes."), 503
+        return render_template('login.html', error="Usuário ou senha incorretos.")
     return render_template('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -201,7 +2301,10 @@ def register():
         password = request.form['password']
         if not username or not password:
             return render_template('register.html', error="Nome de usuário e senha não podem ser vazios.")
-        password_hash = hash_password(password)
+        try:
+            password_hash = hash_password(password)
+        except PasswordHasherBusy:
+            return render_template('register.html', error="Servidor ocupado, tente novamente em instantes."), 503
         if add_user(username, password_hash):
             return redirect(url_for('login'))
         else:
@@ -211,8 +2314,6 @@ def register():
 @app.route('/logout')
 def logout():
     if 'current_room_id' in session:
-        if 'user_id' in session:
-            remove_user_from_room(session['user_id'], session['current_room_id'])
         del session['current_room_id']
         del session['current_room_name']
     session.pop('user_id', None)
@@ -224,11 +2325,10 @@ def rooms():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     if 'current_room_id' in session:
-        if 'user_id' in session:
-            remove_user_from_room(session['user_id'], session['current_room_id'])
         del session['current_room_id']
         del session['current_room_name']
-    return render_template('rooms.html', username=session['username'], rooms=get_rooms())
+    return render_template('rooms.html', username=session['username'], rooms=get_rooms(), active_counts=presence.counts(),
+                           unread=get_unread_counts(session['user_id']))
 
 @app.route('/create_room', methods=['POST'])
 def create_room():
@@ -238,7 +2338,8 @@ def create_room():
     if room_name and add_room(room_name):
         return redirect(url_for('rooms'))
     else:
-        return render_template('rooms.html', username=session['username'], rooms=get_rooms(), error="Nome da sala inválido ou já existe.")
+        return render_template('rooms.html', username=session['username'], rooms=get_rooms(), active_counts=presence.counts(),
+                               unread=get_unread_counts(session['user_id']), error="Nome da sala inválido ou já existe.")
 
 @app.route('/chat/<int:room_id>')
 def chat(room_id):
@@ -249,11 +2350,26 @@ def chat(room_id):
         return "Sala não encontrada", 404
     session['current_room_id'] = room['id']
     session['current_room_name'] = room['nome']
+    # Renderiza apenas a página mais recente; as anteriores são buscadas via API
+    page_size = app.config['MESSAGES_PAGE_SIZE']
+    messages = get_messages_page(room_id, limit=page_size + 1)
+    has_more = len(messages) > page_size
+    if has_more:
+        messages = messages[1:]
+    if messages:
+        # As mensagens exibidas na abertura da sala contam como lidas
+        cursor = mark_room_read(session['user_id'], room_id, messages[-1]['id'])
+        if cursor:
+            socketio.emit('read_cursor', cursor, room=f"user_{session['user_id']}")
     return render_template('chat.html', 
                            username=session['username'], 
                            room_name=room['nome'],
                            room_id=room_id,
-                           messages=get_messages_in_room(room_id))
+                           messages=messages,
+                           oldest_id=messages[0]['id'] if messages else None,
+                           newest_id=messages[-1]['id'] if messages else 0,
+                           has_more=has_more,
+                           page_size=page_size)
 
 # --- Nova Rota para Upload de Imagens ---
 @app.route('/upload_image', methods=['POST'])
@@ -270,10 +2386,17 @@ def upload_image():
         return jsonify({'error': 'No selected file'}), 400
 
     if file and allowed_file(file.filename):
-        # Gera um nome de arquivo único para evitar conflitos
-        filename = secure_filename(f"{uuid.uuid4()}_{file.filename}")
-        file_path = os.path.join(app.config['UPLOADS_FOLDER'], filename)
-        file.save(file_path)
+        if write_backpressure():
+            uploads.inc(1, 'overloaded')
+            return jsonify({'error': 'Server busy'}), 503, {'Retry-After': str(int(BACKPRESSURE_RETRY_AFTER))}
+        # Nome derivado do hash do conteúdo: envios repetidos não duplicam o arquivo
+        extension = file.filename.rsplit('.', 1)[1].lower()
+        filename = run_blocking(store_upload, file.stream, extension)
+        if filename is None:
+            uploads.inc(1, 'too_large')
+            return jsonify({'error': 'File too large'}), 413
+        uploads.inc(1, 'stored')
+        upload_bytes.inc(file.stream.tell())
         
         # O caminho relativo para o cliente (web)
         image_url = url_for('static', filename=f'uploads/{filename}')
@@ -282,21 +2405,34 @@ def upload_image():
         room_id = session['current_room_id']
 
         # Salva a mensagem como tipo 'image' no banco de dados
-        add_message(room_id, user_id, image_url, message_type='image')
+        pending = add_message(room_id, user_id, image_url, message_type='image')
         
-        # Emite o evento 'new_message' para a sala com a URL da imagem
+        # Emite o evento 'new_message' para a sala quando a miniatura estiver pronta;
+        # a imagem original só é baixada quando o usuário abre a imagem
         message_data = {
+            'temp_id': next_temp_id(),
             'username': session['username'],
             'message': image_url,
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'thumbnail': image_url,
             'room_id': room_id,
             'type': 'image'
         }
-        
-        socketio.emit('new_message', message_data, room=f'room_{room_id}')
+        thumbnail = thumbnail_url(image_url)
+        track_message(pending, message_data)
+
+        def broadcast(thumbnail_ready):
+            if thumbnail_ready:
+                message_data['thumbnail'] = thumbnail
+            broadcast_message(message_data)
+
+        schedule_thumbnail(filename, broadcast)
+        if not wait_message_persisted(pending):
+            uploads.inc(1, 'not_saved')
+            return jsonify({'error': 'Message not saved'}), 503, {'Retry-After': str(int(BACKPRESSURE_RETRY_AFTER))}
         
         return jsonify({'success': True, 'url': image_url})
     
+    uploads.inc(1, 'invalid_type')
     return jsonify({'error': 'Invalid file type'}), 400
 
 # --- Rotas API (sem alterações) ---
@@ -305,16 +2441,115 @@ def get_rooms_api():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    rooms = get_rooms()
-    room_list = []
-    for room in rooms:
-        active_count = get_active_users_in_room(room['id'])
-        room_list.append({
-            'id': room['id'],
-            'name': room['nome'],
-            'active_users': active_count
-        })
-    return jsonify(room_list)
+    body, etag = get_room_list(session['user_id'])
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    # O cliente sempre revalida, mas recebe 304 sem corpo se nada mudou
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/rooms/<int:room_id>/messages', methods=['GET'])
+def get_room_messages_api(room_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if not get_room_by_id(room_id):
+        return jsonify({'error': 'Room not found'}), 404
+
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', app.config['MESSAGES_PAGE_SIZE'], type=int)
+    if limit is None or limit < 1:
+        return jsonify({'error': 'Invalid limit'}), 400
+    limit = min(limit, app.config['MESSAGES_PAGE_MAX'])
+
+    # Busca um registro a mais para saber se ainda existem páginas anteriores
+    rows = get_messages_page(room_id, before=before, limit=limit + 1)
+    has_more = len(rows) > limit
+    if has_more:
+        rows = rows[1:]
+
+    return jsonify({
+        'messages': [serialize_message(row, room_id) for row in rows],
+        'next_before': rows[0]['id'] if rows and has_more else None,
+        'has_more': has_more
+    })
+
+def search_response(room_id=None):
+    retry_after = rate_limiter.check('search', None, session['user_id'])
+    if retry_after:
+        throttled_events.inc(1, 'search', 'rate_limit')
+        return jsonify({'error': 'Too many requests'}), 429, {'Retry-After': str(math.ceil(retry_after))}
+    text = request.args.get('q', '').strip()
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    if not text:
+        return jsonify({'error': 'Missing query'}), 400
+    if limit is None or limit < 1 or offset is None or offset < 0 or offset > SEARCH_MAX_OFFSET:
+        return jsonify({'error': 'Invalid pagination'}), 400
+    limit = min(limit, SEARCH_PAGE_MAX)
+
+    # Um resultado a mais indica se existe próxima página
+    rows = search_messages(text, room_id=room_id, limit=limit + 1, offset=offset)
+    has_more = len(rows) > limit
+    results = [{
+        'id': row['id'],
+        'room_id': row['sala_id'],
+        'room_name': row['sala'],
+        'username': row['username'],
+        'timestamp': row['timestamp'],
+        'snippet': row['trecho']
+    } for row in rows[:limit]]
+    return jsonify({
+        'results': results,
+        'next_offset': offset + limit if has_more else None,
+        'has_more': has_more
+    })
+
+@app.route('/api/rooms/<int:room_id>/export', methods=['GET'])
+def export_room_api(room_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not get_room_by_id(room_id):
+        return jsonify({'error': 'Room not found'}), 404
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'Invalid format'}), 400
+    compression = request.args.get('compress')
+    if compression not in (None, 'gzip'):
+        return jsonify({'error': 'Invalid compression'}), 400
+    try:
+        since = parse_export_time(request.args.get('since'))
+        until = parse_export_time(request.args.get('until'))
+    except ValueError:
+        return jsonify({'error': 'Invalid since/until'}), 400
+
+    filename = f'sala_{room_id}.{export_format}'
+    if compression:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    # Sem Content-Length: o corpo é enviado em partes (chunked) enquanto é gerado
+    body = encode_export(format_export(iter_room_history(room_id, since, until), export_format), compression == 'gzip')
+    return Response(body, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/api/search', methods=['GET'])
+def search_messages_api():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    return search_response()
+
+@app.route('/api/rooms/<int:room_id>/search', methods=['GET'])
+def search_room_messages_api(room_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not get_room_by_id(room_id):
+        return jsonify({'error': 'Room not found'}), 404
+    return search_response(room_id)
 
 @app.route('/api/rooms/<int:room_id>/join', methods=['POST'])
 def join_room_api(room_id):
@@ -326,7 +2561,7 @@ def join_room_api(room_id):
     if not room:
         return jsonify({'error': 'Room not found'}), 404
     
-    set_user_active_in_room(user_id, room_id)
+    # A presença é registrada quando o socket entra na sala (join_room_event)
     session['current_room_id'] = room_id
     session['current_room_name'] = room['nome']
     
@@ -342,15 +2577,26 @@ def join_room_api(room_id):
 
 # --- Eventos Socket.IO ---
 @socketio.on('connect')
-def handle_connect():
-    print(f"Cliente conectado: {request.sid}")
+@timed_event
+def handle_connect(auth=None):
+    connected_clients.inc()
+    logger.debug('cliente conectado', extra={'sid': request.sid})
+    start_presence_flusher()
+    if 'user_id' in session:
+        # Canal do usuário: os cursores de leitura chegam a todas as abas abertas
+        join_room(f"user_{session['user_id']}")
     if 'user_id' in session and 'current_room_id' in session:
         user_id = session['user_id']
         room_id = session['current_room_id']
         username = session['username']
         
         join_room(f'room_{room_id}')
-        set_user_active_in_room(user_id, room_id)
+        presence.join(room_id, user_id, request.sid)
+        # auth vem do cliente sem validação: só um dict com last_message_id inteiro
+        # (send_catch_up descarta o que não for) dispara o catch-up
+        last_seen_id = auth.get('last_message_id') if isinstance(auth, dict) else None
+        if last_seen_id is not None:
+            send_catch_up(room_id, last_seen_id)
         
         join_event_data = {
             'username': username,
@@ -359,18 +2605,19 @@ def handle_connect():
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
         emit('user_joined_room', join_event_data, room=f'room_{room_id}')
-        print(f"{username} reentrou na sala {room_id} via Socket.IO")
+        logger.debug('usuário reentrou na sala', extra={'username': username, 'room_id': room_id, 'sid': request.sid})
 
 @socketio.on('disconnect')
+@timed_event
 def handle_disconnect():
-    print(f"Cliente desconectado: {request.sid}")
+    connected_clients.dec()
+    logger.debug('cliente desconectado', extra={'sid': request.sid})
+    presence.leave_all(request.sid)
+    rate_limiter.forget(request.sid)
     if 'user_id' in session and 'current_room_id' in session:
-        user_id = session['user_id']
         room_id = session['current_room_id']
         username = session['username']
 
-        remove_user_from_room(user_id, room_id)
-        
         leave_event_data = {
             'username': username,
             'room_id': room_id,
@@ -378,33 +2625,38 @@ def handle_disconnect():
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
         emit('user_left_room', leave_event_data, room=f'room_{room_id}')
-        print(f"{username} saiu da sala {room_id} via Socket.IO")
+        logger.debug('usuário saiu da sala', extra={'username': username, 'room_id': room_id, 'sid': request.sid})
 
         del session['current_room_id']
         del session['current_room_name']
 
 @socketio.on('join_room_event')
+@timed_event
+@rate_limited
 def on_join_room_event(data):
     room_id = data.get('room_id')
     user_id = session.get('user_id')
     username = session.get('username')
 
     if not user_id or not room_id or not username:
-        print("Erro: Informações incompletas para join_room_event")
+        logger.warning('informações incompletas', extra={'socket_event': 'join_room_event', 'sid': request.sid})
         return
 
     room = get_room_by_id(room_id)
     if not room:
-        print(f"Erro: Sala com ID {room_id} não encontrada no evento join_room_event.")
+        logger.warning('sala não encontrada', extra={'socket_event': 'join_room_event', 'room_id': room_id})
         return
 
     room_name_for_socket = f'room_{room_id}'
     join_room(room_name_for_socket)
-    set_user_active_in_room(user_id, room_id)
+    presence.join(room['id'], user_id, request.sid)
     session['current_room_id'] = room_id
     session['current_room_name'] = room['nome']
 
-    print(f"{username} juntou-se à sala {room_name_for_socket} via Socket.IO.")
+    logger.debug('usuário entrou na sala', extra={'username': username, 'room_id': room_id, 'sid': request.sid})
+    # Entra na sala antes de ler o buffer: o que chegar depois vem pelo 'new_message'
+    if data.get('last_message_id') is not None:
+        send_catch_up(room['id'], data['last_message_id'])
     
     join_event_data = {
         'username': username,
@@ -415,24 +2667,26 @@ def on_join_room_event(data):
     emit('user_joined_room', join_event_data, room=room_name_for_socket, include_self=False)
 
 @socketio.on('leave_room_event')
+@timed_event
+@rate_limited
 def on_leave_room_event(data):
     room_id = data.get('room_id')
     user_id = session.get('user_id')
     username = session.get('username')
     
     if not user_id or not room_id or not username:
-        print("Erro: Informações incompletas para leave_room_event")
+        logger.warning('informações incompletas', extra={'socket_event': 'leave_room_event', 'sid': request.sid})
         return
 
     room_name_for_socket = f'room_{room_id}'
     leave_room(room_name_for_socket)
-    remove_user_from_room(user_id, room_id)
+    presence.leave(room_id, request.sid)
     
     if 'current_room_id' in session and session['current_room_id'] == room_id:
         del session['current_room_id']
         del session['current_room_name']
     
-    print(f"{username} saiu da sala {room_name_for_socket} via Socket.IO.")
+    logger.debug('usuário saiu da sala', extra={'username': username, 'room_id': room_id, 'sid': request.sid})
 
     leave_event_data = {
         'username': username,
@@ -443,37 +2697,118 @@ def on_leave_room_event(data):
     emit('user_left_room', leave_event_data, room=room_name_for_socket)
 
 @socketio.on('send_message')
+@timed_event
+@rate_limited
 def handle_send_message(data):
     user_id = session.get('user_id')
     username = session.get('username')
-    room_id = data.get('room_id')
+    # O buffer de catch-up e o envio em lote indexam as salas por int
+    try:
+        room_id = int(data.get('room_id'))
+    except (TypeError, ValueError):
+        room_id = None
+    if room_id is not None and not 0 < room_id <= SQLITE_MAX_INTEGER:
+        room_id = None
     message_content = data.get('message')
 
     if not user_id or not username or not room_id or not message_content:
-        print("Erro: Informações incompletas para send_message")
+        logger.warning('informações incompletas', extra={'socket_event': 'send_message', 'sid': request.sid})
+        return
+
+    retry_after = write_backpressure()
+    if retry_after:
+        send_throttled('send_message', retry_after, 'overloaded', data)
         return
-    
-    # Adiciona a mensagem ao banco de dados com tipo 'text'
-    add_message(room_id, user_id, message_content, message_type='text')
     
     # Prepara os dados para serem enviados aos outros clientes na sala.
+    # A mensagem sai antes da gravação; o id chega depois em 'messages_persisted' (track_message).
     message_data = {
+        'temp_id': next_temp_id(),
         'username': username,
         'message': message_content,
-        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         'room_id': room_id,
         'type': 'text' # Adicionado o tipo da mensagem
     }
+    broadcast_message(message_data)
     
-    emit('new_message', message_data, room=f'room_{room_id}')
+    # Adiciona a mensagem ao banco de dados com tipo 'text'
+    pending = add_message(room_id, user_id, message_content, message_type='text')
+    track_message(pending, message_data)
+    wait_message_persisted(pending)
 
 @socketio.on('get_active_users')
+@timed_event
+@rate_limited
 def handle_get_active_users(data):
     room_id = data.get('room_id')
     if room_id:
         active_count = get_active_users_in_room(room_id)
         emit('active_users_update', {'room_id': room_id, 'count': active_count})
 
-if __name__ == '__main__':
+@socketio.on('subscribe_rooms')
+@timed_event
+@rate_limited
+def handle_subscribe_rooms():
+    # A lista de salas recebe os deltas de presença em vez de consultar /api/rooms periodicamente
+    join_room(ROOMS_LIST_CHANNEL)
+    counts = presence.counts()
+    emit('active_users_snapshot', [{'room_id': room_id, 'count': count} for room_id, count in counts.items()])
+
+@socketio.on('mark_read')
+@timed_event
+@rate_limited
+def handle_mark_read(data):
+    user_id = session.get('user_id')
+    try:
+        room_id = int(data.get('room_id'))
+        message_id = int(data.get('message_id'))
+    except (TypeError, ValueError):
+        room_id = message_id = None
+    if not user_id or not room_id or not message_id or max(room_id, message_id) > SQLITE_MAX_INTEGER:
+        logger.warning('informações incompletas', extra={'socket_event': 'mark_read', 'sid': request.sid})
+        return
+
+    cursor = mark_room_read(user_id, room_id, message_id)
+    if cursor:
+        emit('read_cursor', cursor, room=f'user_{user_id}')
+
+def install_shutdown_handlers(on_shutdown=None):
+    # SIGTERM (kill, systemctl stop) e SIGINT gravam a fila do gravador de mensagens
+    # antes de sair; on_shutdown roda em seguida. No modo threading o handler roda na
+    # thread principal e o SystemExit executa os demais atexit. Com eventlet/gevent o
+    # handler não pode bloquear nem interromper uma green thread qualquer: a parada
+    # roda em uma tarefa e termina o processo com os._exit.
+    def shutdown(signum):
+        logger.info('encerrando o servidor', extra={'signal': signal.Signals(signum).name})
+        message_writer.stop()
+        if on_shutdown is not None:
+            on_shutdown()
+
+    def handle_signal(signum, frame):
+        if ASYNC_MODE == 'threading':
+            shutdown(signum)
+            sys.exit(0)
+        def shutdown_and_exit():
+            shutdown(signum)
+            os._exit(0)
+        socketio.start_background_task(shutdown_and_exit)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+def run_server(host, port, debug=False, dev_server=False, on_shutdown=None):
+    # eventlet/gevent: servidor WSGI cooperativo, com no máximo SERVER_MAX_CONNECTIONS
+    # green threads (debug é ignorado). threading: servidor de desenvolvimento do
+    # Werkzeug, uma thread do sistema por conexão; fora de um terminal o
+    # Flask-SocketIO só o aceita com debug ou dev_server (testes locais).
     init_db()
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    install_shutdown_handlers(on_shutdown)
+    if ASYNC_MODE == 'eventlet':
+        socketio.run(app, host=host, port=port, max_size=SERVER_MAX_CONNECTIONS)
+    elif ASYNC_MODE == 'gevent':
+        socketio.run(app, host=host, port=port, spawn=SERVER_MAX_CONNECTIONS)
+    else:
+        socketio.run(app, debug=debug, host=host, port=port, allow_unsafe_werkzeug=debug or dev_server)
+
+if __name__ == '__main__':
+    run_server('0.0.0.0', int(os.environ.get('PORT', 5000)), debug=DEBUG)
\ No newline at end of file
@@ -0,0 +1,109 @@
+"""Custo do envio de mensagens para uma sala movimentada.
+
+Registra inscritos falsos em uma sala do servidor Socket.IO, publica mensagens
+em uma taxa fixa e compara o envio imediato ('new_message' por mensagem) com o
+envio em lote ('new_messages' por tick, em JSON e em binário). Os pacotes são
+contados no ponto em que seriam entregues ao Engine.IO, então o custo de
+escrita no socket de cada cliente fica de fora; ele cresce com o número de
+frames, que é reportado.
+
+    python benchmarks/broadcast_fanout.py --subscribers 200 --rate 1000
+    python benchmarks/broadcast_fanout.py --tick 0.1 --json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOM_ID = 1
+
+MODES = [
+    ('imediato', 0, 'json'),
+    ('lote-json', None, 'json'),
+    ('lote-binario', None, 'binary'),
+]
+
+
+def run(chat, tick, encoding, subscribers, rate, duration):
+    chat.app.config['BROADCAST_TICK'] = tick
+    chat.app.config['BROADCAST_ENCODING'] = encoding
+    sent = {'frames': 0, 'bytes': 0}
+
+    def count_packet(eio_sid, eio_packet):
+        sent['frames'] += 1
+        sent['bytes'] += len(eio_packet.data) if eio_packet.data is not None else 0
+
+    chat.socketio.server._send_eio_packet = count_packet
+
+    total = int(rate * duration)
+    interval = 1.0 / rate
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    for i in range(total):
+        # Mantém a taxa alvo sem acumular atraso
+        delay = start_wall + i * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        pending = Future()
+        message_data = {'username': f'user{i % 50}', 'message': f'mensagem de teste número {i}',
+                        'room_id': ROOM_ID, 'type': 'text', 'temp_id': str(i + 1)}
+        chat.broadcast_message(message_data)
+        chat.track_message(pending, message_data)
+        pending.set_result(i + 1)
+    if tick:
+        time.sleep(tick)
+        chat.room_broadcaster.flush()
+    cpu = time.process_time() - start_cpu
+    wall = time.perf_counter() - start_wall
+    deliveries = total * subscribers
+    return {
+        'mensagens': total,
+        'frames': sent['frames'],
+        'frames_por_s': round(sent['frames'] / wall),
+        'bytes_por_mensagem_entregue': round(sent['bytes'] / deliveries, 1),
+        'cpu_us_por_mensagem_entregue': round(cpu / deliveries * 1e6, 3),
+        'cpu_s': round(cpu, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscribers', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=1000, help='mensagens por segundo')
+    parser.add_argument('--duration', type=float, default=3.0, help='segundos por modo')
+    parser.add_argument('--tick', type=float, default=0.05, help='tick do envio em lote')
+    parser.add_argument('--json', action='store_true', help='imprime o resultado em JSON')
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_fanout_'))
+    sys.path.insert(0, ROOT)
+    import app as chat
+
+    manager = chat.socketio.server.manager
+    for i in range(args.subscribers):
+        eio_sid = f'bench-{i}'
+        sid = manager.connect(eio_sid, '/')
+        manager.enter_room(sid, '/', f'room_{ROOM_ID}', eio_sid)
+
+    results = {}
+    for name, tick, encoding in MODES:
+        results[name] = run(chat, args.tick if tick is None else tick, encoding,
+                            args.subscribers, args.rate, args.duration)
+
+    if args.json:
+        print(json.dumps({'subscribers': args.subscribers, 'rate': args.rate,
+                          'tick': args.tick, 'results': results}, indent=2))
+        return
+    print(f"{args.subscribers} inscritos, {args.rate:g} mensagens/s, tick {args.tick:g}s")
+    print(f"{'modo':<14}{'frames/s':>10}{'bytes/entrega':>15}{'CPU us/entrega':>16}")
+    for name, result in results.items():
+        print(f"{name:<14}{result['frames_por_s']:>10}{result['bytes_por_mensagem_entregue']:>15}"
+              f"{result['cpu_us_por_mensagem_entregue']:>16}")
+
+
+if __name__ == '__main__':
+    main()
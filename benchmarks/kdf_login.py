@@ -0,0 +1,91 @@
+"""Vazão de login com os parâmetros atuais do scrypt.
+
+Cria um banco temporário, cadastra um usuário e dispara logins concorrentes
+pelo cliente de testes do Flask, medindo logins/s e a latência de cada um.
+
+    python benchmarks/kdf_login.py --logins 200 --concurrency 16
+    KDF_SCRYPT_N=32768 KDF_WORKERS=4 python benchmarks/kdf_login.py
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--json', action='store_true', help='imprime o resultado em JSON')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_kdf_')
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app as chat
+
+    chat.app.config['DATABASE'] = os.path.join(workdir, 'bench.db')
+    chat.init_db()
+    client = chat.app.test_client()
+    client.post('/register', data={'username': 'bench', 'password': 'senha-de-teste'})
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    remaining = iter(range(args.logins))
+
+    def worker():
+        client = chat.app.test_client()
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            start = time.perf_counter()
+            response = client.post('/login', data={'username': 'bench', 'password': 'senha-de-teste'})
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        'scrypt': {'n': chat.KDF_SCRYPT_N, 'r': chat.KDF_SCRYPT_R, 'p': chat.KDF_SCRYPT_P},
+        'logins': args.logins,
+        'concurrency': args.concurrency,
+        'duration_seconds': round(duration, 3),
+        'logins_per_second': round(len(latencies) / duration, 1),
+        'latency_ms': {
+            'p50': round(statistics.median(latencies) * 1000, 1),
+            'p95': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+            'max': round(latencies[-1] * 1000, 1),
+        },
+        'status_codes': statuses,
+        'hasher': chat.password_hasher.stats(),
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"scrypt N={chat.KDF_SCRYPT_N} r={chat.KDF_SCRYPT_R} p={chat.KDF_SCRYPT_P}, "
+              f"{chat.KDF_WORKERS} workers, concorrência {args.concurrency}")
+        print(f"{result['logins_per_second']} logins/s em {result['duration_seconds']} s")
+        print(f"latência p50={result['latency_ms']['p50']} ms p95={result['latency_ms']['p95']} ms "
+              f"max={result['latency_ms']['max']} ms")
+        print(f"respostas: {statuses}; rejeitados pelo pool: {result['hasher']['rejected']}")
+
+
+if __name__ == '__main__':
+    main()
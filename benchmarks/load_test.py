@@ -0,0 +1,373 @@
+"""Teste de carga do servidor de chat com clientes Socket.IO reais.
+
+Sobe o app.py em um subprocesso (banco e uploads em uma pasta temporária),
+cadastra N usuários distribuídos em M salas e, durante o tempo configurado,
+cada cliente alterna entre enviar mensagens, pedir a contagem de ativos,
+consultar /api/rooms e enviar imagens. Ao final mostra:
+
+  * latência envio -> 'new_message' (p50/p90/p99/máx) medida em todos os
+    inscritos da sala;
+  * vazão de mensagens enviadas e de entregas;
+  * latência das requisições HTTP;
+  * tempo de espera pelo lock de escrita do SQLite no gravador de mensagens.
+
+Variáveis de ambiente são repassadas ao servidor, o que permite comparar
+configurações. Com --output o resultado é salvo em JSON.
+
+    pip install "python-socketio[client]"
+    python benchmarks/load_test.py --clients 50 --rooms 5 --duration 30
+    MESSAGE_WRITE_MODE=sync python benchmarks/load_test.py --output sync.json
+    BROADCAST_TICK=0.05 python benchmarks/load_test.py --output lote.json
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Variáveis de ambiente do servidor registradas no resultado
+SERVER_SETTINGS = ['MESSAGE_WRITE_MODE', 'MESSAGE_BATCH_SIZE', 'MESSAGE_BATCH_INTERVAL', 'DB_POOL_SIZE',
+                   'BROADCAST_TICK', 'BROADCAST_ENCODING', 'KDF_SCRYPT_N', 'KDF_WORKERS', 'RATE_LIMIT_SCALE',
+                   'ASYNC_MODE', 'BLOCKING_WORKERS']
+
+# Processo do servidor: ao receber SIGTERM o app esvazia o gravador de mensagens e
+# então as estatísticas são gravadas
+SERVER_SCRIPT = """
+import json, sys
+sys.path.insert(0, {root!r})
+import app as chat
+
+def write_stats():
+    with open({stats_file!r}, 'w') as f:
+        json.dump({{'message_writer': chat.message_writer.stats(),
+                   'password_hasher': chat.password_hasher.stats()}}, f)
+
+# O teste sobe o servidor local sem terminal; no modo threading é o do Werkzeug
+chat.run_server('127.0.0.1', {port}, dev_server=True, on_shutdown=write_stats)
+"""
+
+DEFAULT_MIX = 'send=0.80,active=0.10,rooms=0.08,upload=0.02'
+
+
+def tiny_png(seed):
+    # PNG 8x8 de uma cor só, diferente a cada envio para não reaproveitar o mesmo arquivo
+    def chunk(kind, data):
+        return struct.pack('!I', len(data)) + kind + data + struct.pack('!I', zlib.crc32(kind + data))
+    color = bytes([seed % 256, (seed >> 8) % 256, (seed >> 16) % 256])
+    raw = b''.join(b'\x00' + color * 8 for _ in range(8))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('!IIBBBBB', 8, 8, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+def decode_message_batch(buffer):
+    # Mesmo formato de encode_message_batch (app.py); só os conteúdos interessam aqui
+    _, _, count, timestamp_length = struct.unpack_from('!BIIB', buffer)
+    offset = 10 + timestamp_length
+    contents = []
+    for _ in range(count):
+        username_length, = struct.unpack_from('!H', buffer, offset + 5)
+        offset += 7 + username_length
+        content_length, = struct.unpack_from('!I', buffer, offset)
+        offset += 4
+        contents.append(buffer[offset:offset + content_length].decode())
+        offset += content_length
+        thumbnail_length, = struct.unpack_from('!H', buffer, offset)
+        offset += 2 + thumbnail_length
+    return contents
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda fraction: values[min(len(values) - 1, int(fraction * len(values)))]
+    return {
+        'count': len(values),
+        'p50_ms': round(pick(0.50) * 1000, 2),
+        'p90_ms': round(pick(0.90) * 1000, 2),
+        'p99_ms': round(pick(0.99) * 1000, 2),
+        'max_ms': round(values[-1] * 1000, 2),
+    }
+
+
+class Recorder:
+    """Coleta os tempos de todos os clientes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent_at = {} # conteúdo da mensagem -> instante do envio
+        self.deliveries = []
+        self.http = {} # operação -> latências
+        self.errors = {} # operação -> quantidade
+        self.throttled = {} # evento -> quantidade de 'throttled' recebidos
+        self.sent = 0
+
+    def message_sent(self, content):
+        with self.lock:
+            self.sent_at[content] = time.perf_counter()
+            self.sent += 1
+
+    def message_received(self, content):
+        now = time.perf_counter()
+        with self.lock:
+            sent_at = self.sent_at.get(content)
+            if sent_at is not None:
+                self.deliveries.append(now - sent_at)
+
+    def event_throttled(self, event):
+        with self.lock:
+            self.throttled[event] = self.throttled.get(event, 0) + 1
+
+    def request_done(self, operation, elapsed, ok):
+        with self.lock:
+            self.http.setdefault(operation, []).append(elapsed)
+            if not ok:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+
+class SimulatedClient:
+    def __init__(self, index, base_url, room_id, recorder, think_time, mix):
+        self.index = index
+        self.base_url = base_url
+        self.room_id = room_id
+        self.recorder = recorder
+        self.think_time = think_time
+        self.mix = mix
+        self.http = requests.Session()
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('new_message', self.on_new_message)
+        self.sio.on('new_messages', self.on_new_messages)
+        self.sio.on('throttled', lambda data: self.recorder.event_throttled(data['event']))
+        self.rooms_etag = None
+        self.sequence = 0
+        self.messages_sent = 0
+
+    def login(self):
+        username, password = f'bench{self.index}', 'senha-de-teste'
+        for _ in range(20):
+            self.http.post(f'{self.base_url}/register', data={'username': username, 'password': password})
+            response = self.http.post(f'{self.base_url}/login', data={'username': username, 'password': password},
+                                      allow_redirects=False)
+            if response.status_code == 302:
+                break
+            time.sleep(0.5) # 503: pool de hash de senhas cheio
+        else:
+            raise RuntimeError(f'login de {username} falhou: {response.status_code}')
+        # Abre a página da sala para gravar a sala atual na sessão
+        self.http.get(f'{self.base_url}/chat/{self.room_id}')
+
+    def connect(self):
+        cookie = '; '.join(f'{name}={value}' for name, value in self.http.cookies.items())
+        self.sio.connect(self.base_url, headers={'Cookie': cookie}, transports=['websocket'])
+        self.sio.emit('join_room_event', {'room_id': self.room_id})
+
+    def on_new_message(self, data):
+        self.recorder.message_received(data['message'])
+
+    def on_new_messages(self, batch):
+        if isinstance(batch, bytes):
+            contents = decode_message_batch(batch)
+        else:
+            contents = [message['message'] for message in batch['messages']]
+        for content in contents:
+            self.recorder.message_received(content)
+
+    def timed_request(self, operation, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, url, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        self.recorder.request_done(operation, time.perf_counter() - start, ok)
+
+    def run(self, deadline):
+        operations, weights = zip(*self.mix.items())
+        while time.perf_counter() < deadline:
+            time.sleep(random.expovariate(1.0 / self.think_time))
+            operation = random.choices(operations, weights)[0]
+            if operation == 'send':
+                self.sequence += 1
+                content = f'bench {self.index}-{self.sequence}'
+                self.recorder.message_sent(content)
+                self.messages_sent += 1
+                self.sio.emit('send_message', {'room_id': self.room_id, 'message': content})
+            elif operation == 'active':
+                self.sio.emit('get_active_users', {'room_id': self.room_id})
+            elif operation == 'rooms':
+                headers = {'If-None-Match': self.rooms_etag} if self.rooms_etag else {}
+                start = time.perf_counter()
+                response = self.http.get(f'{self.base_url}/api/rooms', headers=headers)
+                self.recorder.request_done('api_rooms', time.perf_counter() - start, response.status_code in (200, 304))
+                self.rooms_etag = response.headers.get('ETag', self.rooms_etag)
+            elif operation == 'upload':
+                self.sequence += 1
+                files = {'file': (f'bench{self.index}.png', tiny_png(self.index * 100000 + self.sequence), 'image/png')}
+                self.timed_request('upload_image', 'POST', f'{self.base_url}/upload_image', files=files)
+
+    def close(self):
+        self.sio.disconnect()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workdir, port, stats_file):
+    script = SERVER_SCRIPT.format(root=ROOT, port=port, stats_file=stats_file)
+    server = subprocess.Popen([sys.executable, '-c', script], cwd=workdir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(f'{base_url}/login', timeout=1)
+            return server, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('o servidor não respondeu')
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - {'send', 'active', 'rooms', 'upload'}
+    if unknown:
+        raise argparse.ArgumentTypeError(f'operações desconhecidas: {", ".join(sorted(unknown))}')
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=30.0, help='segundos de carga')
+    parser.add_argument('--think-time', type=float, default=1.0, help='intervalo médio entre ações de cada cliente')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'pesos das operações ({DEFAULT_MIX})')
+    parser.add_argument('--output', help='arquivo JSON com o resultado')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix='bench_load_')
+    stats_file = os.path.join(workdir, 'server_stats.json')
+    server, base_url = start_server(workdir, free_port(), stats_file)
+    recorder = Recorder()
+    clients = []
+    try:
+        admin = requests.Session()
+        admin.post(f'{base_url}/register', data={'username': 'bench-admin', 'password': 'senha-de-teste'})
+        admin.post(f'{base_url}/login', data={'username': 'bench-admin', 'password': 'senha-de-teste'})
+        for i in range(args.rooms):
+            admin.post(f'{base_url}/create_room', data={'room_name': f'sala {i + 1}'})
+        room_ids = [room['id'] for room in admin.get(f'{base_url}/api/rooms').json()]
+
+        clients = [SimulatedClient(i, base_url, room_ids[i % len(room_ids)], recorder, args.think_time, args.mix)
+                   for i in range(args.clients)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(SimulatedClient.login, clients))
+        for client in clients:
+            client.connect()
+        print(f'{args.clients} clientes conectados em {len(room_ids)} salas; carga por {args.duration:g}s...', file=sys.stderr)
+
+        start = time.perf_counter()
+        deadline = start + args.duration
+        threads = [threading.Thread(target=client.run, args=(deadline,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        time.sleep(1.0) # entregas ainda em trânsito
+        elapsed = time.perf_counter() - start
+    finally:
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+    server_stats = {}
+    if os.path.exists(stats_file):
+        with open(stats_file) as f:
+            server_stats = json.load(f)
+    writer = server_stats.get('message_writer', {})
+    # Cada mensagem deve chegar a todos os clientes da sala, inclusive ao remetente
+    room_sizes = Counter(client.room_id for client in clients)
+    expected = sum(room_sizes[client.room_id] * client.messages_sent for client in clients)
+    result = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'parameters': {
+            'clients': args.clients,
+            'rooms': len(room_ids),
+            'duration_s': args.duration,
+            'think_time_s': args.think_time,
+            'mix': args.mix,
+        },
+        'server_settings': {name: os.environ[name] for name in SERVER_SETTINGS if name in os.environ},
+        'messages_sent': recorder.sent,
+        'messages_per_s': round(recorder.sent / elapsed, 1),
+        'deliveries': len(recorder.deliveries),
+        'deliveries_per_s': round(len(recorder.deliveries) / elapsed, 1),
+        'delivery_ratio': round(len(recorder.deliveries) / expected, 4) if expected else None,
+        'delivery_latency': percentiles(recorder.deliveries),
+        'http_latency': {operation: percentiles(values) for operation, values in recorder.http.items()},
+        'http_errors': recorder.errors,
+        'throttled_events': recorder.throttled,
+        'sqlite_lock_wait': {
+            'total_s': round(writer.get('lock_wait_seconds', 0.0), 4),
+            'max_ms': round(writer.get('max_lock_wait', 0.0) * 1000, 2),
+            'batches': writer.get('batches', 0),
+            'rows': writer.get('rows', 0),
+        },
+        'server_cpu_s': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_utime
+                              + resource.getrusage(resource.RUSAGE_CHILDREN).ru_stime, 2),
+    }
+
+    latency = result['delivery_latency'] or {}
+    print(f"mensagens: {result['messages_sent']} ({result['messages_per_s']}/s), "
+          f"entregas: {result['deliveries']} ({result['deliveries_per_s']}/s, {result['delivery_ratio']} do esperado)")
+    print(f"latência de entrega: p50 {latency.get('p50_ms')} ms, p90 {latency.get('p90_ms')} ms, "
+          f"p99 {latency.get('p99_ms')} ms, máx {latency.get('max_ms')} ms")
+    for operation, summary in result['http_latency'].items():
+        print(f"{operation}: p50 {summary['p50_ms']} ms, p99 {summary['p99_ms']} ms "
+              f"({summary['count']} requisições, {recorder.errors.get(operation, 0)} erros)")
+    lock_wait = result['sqlite_lock_wait']
+    print(f"espera pelo lock do SQLite: {lock_wait['total_s']} s no total, máx {lock_wait['max_ms']} ms "
+          f"({lock_wait['batches']} lotes, {lock_wait['rows']} mensagens)")
+    if recorder.throttled:
+        print(f"eventos limitados pelo servidor: {recorder.throttled}")
+    print(f"CPU do servidor: {result['server_cpu_s']} s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Busca FTS5 em mensagens com milhões de linhas, comparada ao LIKE.
+
+Gera um banco temporário com mensagens sintéticas (os triggers mantêm o
+índice FTS5) e mede a latência das consultas de search_messages contra uma
+varredura com LIKE equivalente.
+
+    python benchmarks/search_messages.py --rows 2000000 --rooms 50
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ('reunião projeto entrega código banco dados servidor cliente prazo teste '
+         'deploy erro correção revisão tarefa sprint chamado usuário sala mensagem '
+         'imagem senha login cadastro relatório planilha backup rede integração').split()
+# Vocabulário com cauda longa: poucas palavras muito frequentes e muitas raras
+VOCABULARY = WORDS + [f'termo{i}' for i in range(50_000)]
+CUMULATIVE_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY))))
+
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(timings), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='imprime o resultado em JSON')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_search_')
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app as chat
+
+    chat.app.config['DATABASE'] = os.path.join(workdir, 'bench.db')
+    chat.init_db()
+    random.seed(42)
+
+    with chat.app.app_context():
+        db = chat.get_db()
+        db.execute("INSERT INTO usuarios (username, password_hash) VALUES ('bench', '-')")
+        db.executemany('INSERT INTO salas (nome) VALUES (?)', [(f'sala {i}',) for i in range(args.rooms)])
+        start = time.perf_counter()
+        batch = 50_000
+        for first in range(0, args.rows, batch):
+            rows = []
+            for _ in range(min(batch, args.rows - first)):
+                kind = 'image' if random.random() < 0.05 else 'text'
+                content = ' '.join(random.choices(VOCABULARY, cum_weights=CUMULATIVE_WEIGHTS, k=random.randint(4, 16)))
+                rows.append((random.randint(1, args.rooms), 1, content, kind))
+            db.executemany(chat.INSERT_MESSAGE_SQL, rows)
+            db.commit()
+        load_seconds = time.perf_counter() - start
+
+        queries = ['reunião', 'deploy erro', 'relat', 'termo4242', 'termo123 termo77']
+        results = []
+        for text in queries:
+            like = f'%{text}%'
+            results.append({
+                'query': text,
+                'fts_global_ms': timed(lambda: chat.search_messages(text, limit=20), args.repeat),
+                'fts_room_ms': timed(lambda: chat.search_messages(text, room_id=1, limit=20), args.repeat),
+                'matches': chat.query_db('SELECT COUNT(*) AS n FROM mensagens_fts WHERE mensagens_fts MATCH ?',
+                                         [chat.build_search_query(text)], one=True)['n'],
+                # Mesma página de resultados via LIKE (mais recentes primeiro), sem ranking
+                'like_global_ms': timed(lambda: chat.query_db(
+                    "SELECT id FROM mensagens WHERE tipo = 'text' AND conteudo LIKE ? ORDER BY id DESC LIMIT 20",
+                    [like]), args.repeat),
+            })
+
+    result = {'rows': args.rows, 'rooms': args.rooms, 'load_seconds': round(load_seconds, 1), 'queries': results}
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"{args.rows} mensagens em {args.rooms} salas carregadas em {result['load_seconds']} s")
+        print(f"{'consulta':<22}{'resultados':>12}{'FTS global':>12}{'FTS sala':>12}{'LIKE':>12}  (ms, mediana)")
+        for item in results:
+            print(f"{item['query']:<22}{item['matches']:>12}{item['fts_global_ms']:>12}"
+                  f"{item['fts_room_ms']:>12}{item['like_global_ms']:>12}")
+
+
+if __name__ == '__main__':
+    main()
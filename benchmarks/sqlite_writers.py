@@ -0,0 +1,107 @@
+"""Teto de gravação do SQLite com vários workers.
+
+Cada worker (um processo, como nos deploys com SOCKETIO_MESSAGE_QUEUE) grava
+lotes de mensagens no mesmo arquivo usando o mesmo caminho do gravador em lote
+do app.py (MessageWriter._write_batch: BEGIN IMMEDIATE, um INSERT por mensagem,
+contadores das salas e commit). Como o SQLite aceita um único escritor por vez,
+a vazão total não cresce com o número de workers; o que cresce é a espera pelo
+lock.
+
+    python benchmarks/sqlite_writers.py --workers 1 2 4 --batch 100 --duration 5
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOMS = 5
+
+
+def load_app(workdir):
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app as chat
+    return chat
+
+
+def worker(workdir, worker_id, batch_size, start_at, duration, results):
+    chat = load_app(workdir)
+    conn = chat.create_connection(chat.DATABASE)
+    rows = batches = 0
+    lock_wait = 0.0
+    while time.time() < start_at:
+        time.sleep(0.001)
+    deadline = start_at + duration
+    while time.time() < deadline:
+        batch = [((1 + (rows + i) % ROOMS, 1, f'mensagem {worker_id}-{rows + i}', 'text'), None)
+                 for i in range(batch_size)]
+        message_ids, _, waited, _ = chat.message_writer._write_batch(conn, batch)
+        rows += len(message_ids)
+        batches += 1
+        lock_wait += waited or 0.0
+    conn.close()
+    results.put({'rows': rows, 'batches': batches, 'lock_wait_s': lock_wait})
+
+
+def setup(workdir):
+    chat = load_app(workdir)
+    with chat.app.app_context():
+        chat.init_db()
+        db = chat.get_db()
+        db.execute("INSERT INTO usuarios (username, password_hash) VALUES ('bench', 'x')")
+        db.executemany('INSERT INTO salas (nome) VALUES (?)', [(f'sala {i + 1}',) for i in range(ROOMS)])
+        db.commit()
+
+
+def run(workers, batch_size, duration):
+    # Cada rodada usa um banco novo, criado em um processo separado
+    workdir = tempfile.mkdtemp(prefix='bench_writers_')
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=setup, args=(workdir,))
+    process.start()
+    process.join()
+
+    results = context.Queue()
+    start_at = time.time() + 3.0 # tempo para todos os processos importarem o app
+    processes = [context.Process(target=worker, args=(workdir, i, batch_size, start_at, duration, results))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    per_worker = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    rows = sum(result['rows'] for result in per_worker)
+    batches = sum(result['batches'] for result in per_worker)
+    return {
+        'workers': workers,
+        'mensagens_por_s': round(rows / duration),
+        'commits_por_s': round(batches / duration),
+        'espera_lock_media_ms': round(sum(r['lock_wait_s'] for r in per_worker) / batches * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--batch', type=int, default=100, help='mensagens por commit (MESSAGE_BATCH_SIZE)')
+    parser.add_argument('--duration', type=float, default=5.0, help='segundos por rodada')
+    parser.add_argument('--json', action='store_true', help='imprime o resultado em JSON')
+    args = parser.parse_args()
+
+    results = [run(workers, args.batch, args.duration) for workers in args.workers]
+    if args.json:
+        print(json.dumps({'batch': args.batch, 'results': results}, indent=2))
+        return
+    print(f"lotes de {args.batch} mensagens, {args.duration:g}s por rodada")
+    print(f"{'workers':>8}{'mensagens/s':>14}{'commits/s':>12}{'espera lock (ms)':>18}")
+    for result in results:
+        print(f"{result['workers']:>8}{result['mensagens_por_s']:>14}{result['commits_por_s']:>12}"
+              f"{result['espera_lock_media_ms']:>18}")
+
+
+if __name__ == '__main__':
+    main()
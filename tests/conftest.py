@@ -0,0 +1,52 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def chat(tmp_path_factory):
+    # O app cria o banco e as pastas de upload no diretório atual
+    previous = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('chat'))
+    sys.path.insert(0, ROOT)
+    try:
+        yield importlib.import_module('app')
+    finally:
+        os.chdir(previous)
+
+
+@pytest.fixture
+def db(chat, tmp_path):
+    # Banco e pasta de arquivo novos para cada teste, com as migrações aplicadas
+    saved = {key: chat.app.config[key] for key in ('DATABASE', 'ARCHIVE_FOLDER')}
+    chat.app.config['DATABASE'] = str(tmp_path / 'chat.db')
+    chat.app.config['ARCHIVE_FOLDER'] = str(tmp_path / 'archive')
+    chat.init_db()
+    chat.room_cache.invalidate()
+    chat.user_cache.invalidate()
+    chat.recent_messages = chat.RecentMessages(chat.app.config['RECENT_MESSAGES_PER_ROOM'])
+    conn = chat.create_connection(chat.app.config['DATABASE'])
+    conn.execute("INSERT INTO usuarios (username, password_hash) VALUES ('alice', '-')")
+    conn.execute("INSERT INTO salas (nome) VALUES ('geral')")
+    conn.commit()
+    try:
+        yield conn
+    finally:
+        conn.close()
+        chat.app.config.update(saved)
+
+
+@pytest.fixture
+def add_messages(db):
+    # Insere mensagens de texto direto no banco (sem o gravador) e retorna os ids
+    def add(contents, room_id=1):
+        ids = [db.execute('INSERT INTO mensagens (sala_id, usuario_id, conteudo, tipo) VALUES (?, 1, ?, ?)',
+                          (room_id, content, 'text')).lastrowid for content in contents]
+        db.execute('UPDATE salas SET total_mensagens = total_mensagens + ? WHERE id = ?', (len(ids), room_id))
+        db.commit()
+        return ids
+    return add
@@ -0,0 +1,46 @@
+"""Catch-up das mensagens perdidas ao reconectar."""
+import pytest
+
+
+def test_missed_range_moved_to_the_archive_resets_the_client(chat, db, add_messages):
+    ids = add_messages([f'mensagem {i}' for i in range(30)])
+    assert chat.archive_room(db, 1, ids[19], 10) == 20
+
+    with chat.app.app_context():
+        messages, reset = chat.get_missed_messages(1, ids[4])
+        assert reset # a página mais recente, que pode incluir mensagens arquivadas
+        assert [message['id'] for message in messages][-10:] == ids[20:]
+
+        messages, reset = chat.get_missed_messages(1, ids[24])
+        assert not reset
+        assert [message['id'] for message in messages] == ids[25:]
+
+
+@pytest.fixture
+def logged_in(chat, db):
+    client = chat.app.test_client()
+    with client.session_transaction() as session:
+        session.update(user_id=1, username='alice', current_room_id=1, current_room_name='geral')
+    return client
+
+
+@pytest.mark.parametrize('auth', ['abc', ['x'], {'last_message_id': 'x'}, {'last_message_id': [1]},
+                                  {'last_message_id': 10 ** 30}, {'last_message_id': float('inf')}])
+def test_connect_ignores_an_invalid_auth_payload(chat, logged_in, add_messages, auth):
+    add_messages(['mensagem'])
+    socket = chat.socketio.test_client(chat.app, flask_test_client=logged_in, auth=auth)
+    try:
+        assert socket.is_connected()
+        assert 'missed_messages' not in [event['name'] for event in socket.get_received()]
+    finally:
+        socket.disconnect()
+
+
+def test_connect_sends_the_missed_messages(chat, logged_in, add_messages):
+    ids = add_messages(['primeira', 'segunda'])
+    socket = chat.socketio.test_client(chat.app, flask_test_client=logged_in, auth={'last_message_id': ids[0]})
+    try:
+        missed = [event['args'][0] for event in socket.get_received() if event['name'] == 'missed_messages']
+        assert [message['id'] for message in missed[0]['messages']] == ids[1:]
+    finally:
+        socket.disconnect()
@@ -0,0 +1,66 @@
+"""Gravação das mensagens em lote e parada do gravador."""
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import textwrap
+from concurrent.futures import Future
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_stop_writes_the_queued_messages(chat, db, monkeypatch):
+    # Lote grande e espera longa: sem o stop nada seria gravado durante o teste
+    monkeypatch.setitem(chat.app.config, 'MESSAGE_BATCH_SIZE', 1000)
+    monkeypatch.setitem(chat.app.config, 'MESSAGE_BATCH_INTERVAL', 60)
+    writer = chat.MessageWriter()
+    futures = [writer.submit((1, 1, f'mensagem {i}', 'text')) for i in range(5)]
+
+    writer.stop()
+
+    assert [future.result(timeout=0) for future in futures] == [1, 2, 3, 4, 5]
+    assert db.execute('SELECT COUNT(*) FROM mensagens').fetchone()[0] == 5
+
+
+def test_sigterm_writes_the_queued_messages_before_exiting(tmp_path):
+    script = textwrap.dedent(f'''
+        import os, signal, sys, time
+        sys.path.insert(0, {ROOT!r})
+        import app as chat
+        chat.app.config.update(MESSAGE_WRITE_MODE='group', MESSAGE_BATCH_SIZE=1000, MESSAGE_BATCH_INTERVAL=60)
+        chat.init_db()
+        conn = chat.create_connection(chat.DATABASE)
+        conn.execute("INSERT INTO usuarios (username, password_hash) VALUES ('alice', '-')")
+        conn.execute("INSERT INTO salas (nome) VALUES ('geral')")
+        conn.commit()
+        chat.install_shutdown_handlers(lambda: print('on_shutdown', flush=True))
+        with chat.app.app_context():
+            for i in range(5):
+                chat.add_message(1, 1, f'mensagem {{i}}')
+        os.kill(os.getpid(), signal.SIGTERM)
+        time.sleep(30)
+    ''')
+    result = subprocess.run([sys.executable, '-c', script], cwd=tmp_path, capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 0, result.stderr
+    assert 'on_shutdown' in result.stdout
+    conn = sqlite3.connect(tmp_path / 'chat_database.db')
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM mensagens').fetchone()[0] == 5
+    finally:
+        conn.close()
+
+
+def test_wait_message_persisted_reports_a_failed_write(chat, monkeypatch):
+    monkeypatch.setitem(chat.app.config, 'MESSAGE_WRITE_MODE', 'group')
+    failed = Future()
+    failed.set_exception(sqlite3.OperationalError('database is locked'))
+    assert chat.wait_message_persisted(failed) is False
+
+    monkeypatch.setattr(chat, 'MESSAGE_WRITE_TIMEOUT', 0.01)
+    assert chat.wait_message_persisted(Future()) is False
+
+    done = Future()
+    done.set_result(1)
+    assert chat.wait_message_persisted(done) is True
@@ -0,0 +1,30 @@
+"""PresenceSyncMixin sobrescreve PubSubManager._handle_emit, um método interno
+do python-socketio. Este teste garante que, na versão instalada, os anúncios
+de presença publicados por um worker ainda chegam ao registro dos outros.
+
+    python -m pytest tests
+"""
+import time
+import uuid
+
+
+def test_presence_announcement_reaches_other_worker(chat):
+    channel = f'test-{uuid.uuid4().hex}'
+    servers = []
+    for _ in range(2):
+        manager = chat.create_client_manager('memory://', channel)
+        servers.append(chat.socketio_lib.Server(client_manager=manager, async_mode='threading'))
+        manager.initialize()
+    sender, receiver = servers
+    room_id = 424242
+
+    sender.emit(chat.PRESENCE_SYNC_EVENT, [[room_id, [7, 8]]], namespace=chat.PRESENCE_SYNC_NAMESPACE)
+    deadline = time.monotonic() + 5
+    while chat.presence.count(room_id) != 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    try:
+        assert chat.presence.count(room_id) == 2
+        assert sender.manager.host_id in chat.presence._peers
+    finally:
+        chat.presence.update_peer(sender.manager.host_id, [])
+    assert receiver.manager.host_id not in chat.presence._peers
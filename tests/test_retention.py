@@ -0,0 +1,41 @@
+"""Arquivamento das mensagens antigas em segmentos (retenção)."""
+
+
+def test_overlapping_archive_runs_register_the_segment_once(chat, db, add_messages, monkeypatch):
+    add_messages([f'mensagem {i}' for i in range(10)])
+    write_segment = chat.write_archive_segment
+    other = chat.create_connection(chat.app.config['DATABASE'])
+
+    # Outro processo arquiva a mesma faixa enquanto este ainda grava o arquivo
+    def write_while_other_archives(path, rows):
+        monkeypatch.setattr(chat, 'write_archive_segment', write_segment)
+        assert chat.archive_room(other, 1, 10, 5) == 10
+        write_segment(path, rows)
+
+    monkeypatch.setattr(chat, 'write_archive_segment', write_while_other_archives)
+    try:
+        assert chat.archive_room(db, 1, 10, 5) == 0
+    finally:
+        other.close()
+
+    segments = db.execute('SELECT primeiro_id, ultimo_id FROM arquivo_segmentos ORDER BY primeiro_id').fetchall()
+    assert [tuple(segment) for segment in segments] == [(1, 5), (6, 10)]
+    with chat.app.app_context():
+        archived = chat.get_archived_messages(1, None, 100)
+    assert [message['id'] for message in archived] == list(range(10, 0, -1))
+
+
+def test_archive_room_again_finds_nothing_to_archive(chat, db, add_messages):
+    add_messages([f'mensagem {i}' for i in range(10)])
+    assert chat.archive_room(db, 1, 10, 5) == 10
+    assert chat.archive_room(db, 1, 10, 5) == 0
+    assert db.execute('SELECT COUNT(*) FROM arquivo_segmentos').fetchone()[0] == 2
+    assert db.execute('SELECT COUNT(*) FROM mensagens').fetchone()[0] == 0
+
+
+def test_only_one_process_holds_the_retention_lock(chat, db):
+    assert chat.acquire_lock('retencao', 'worker-a', 60)
+    assert not chat.acquire_lock('retencao', 'worker-b', 60)
+    assert chat.acquire_lock('retencao', 'worker-a', -1) # o dono renova (aqui, já vencida)
+    assert chat.acquire_lock('retencao', 'worker-b', 60) # trava vencida passa a outro processo
+    assert not chat.acquire_lock('retencao', 'worker-a', 60)
@@ -0,0 +1,44 @@
+"""Busca textual (FTS5) nas mensagens."""
+
+
+def test_search_snippet_escapes_message_html(chat, db, add_messages):
+    add_messages(['hello <b>0</b> reunião <script>alert(1)</script>'])
+    client = chat.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['username'] = 'alice'
+
+    response = client.get('/api/search?q=reuniao')
+
+    assert response.status_code == 200
+    snippet = response.get_json()['results'][0]['snippet']
+    assert snippet == 'hello &lt;b&gt;0&lt;/b&gt; <mark>reunião</mark> &lt;script&gt;alert(1)&lt;/script&gt;'
+
+
+def test_short_last_term_is_not_a_prefix_query(chat):
+    assert chat.build_search_query('a') == '"a"'
+    assert chat.build_search_query('deploy re') == '"deploy" "re"'
+    assert chat.build_search_query('deploy rel') == '"deploy" "rel"*'
+
+
+def test_only_the_most_recent_matches_are_ranked(chat, db, add_messages, monkeypatch):
+    monkeypatch.setattr(chat, 'SEARCH_MAX_CANDIDATES', 3)
+    ids = add_messages(['reunião reunião reunião'] + ['reunião'] * 5)
+    with chat.app.app_context():
+        found = [row['id'] for row in chat.search_messages('reunião', limit=10)]
+    # A mensagem mais relevante é antiga demais para entrar na janela
+    assert sorted(found) == ids[-3:]
+
+
+def test_search_route_is_rate_limited(chat, db, monkeypatch):
+    monkeypatch.setitem(chat.app.config['RATE_LIMITS'], 'search', {'user': (1, 2)})
+    monkeypatch.setitem(chat.app.config, 'RATE_LIMIT_SCALE', 1)
+    monkeypatch.setattr(chat, 'rate_limiter', chat.RateLimiter())
+    client = chat.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['username'] = 'alice'
+
+    statuses = [client.get('/api/search?q=reuniao').status_code for _ in range(3)]
+
+    assert statuses == [200, 200, 429]
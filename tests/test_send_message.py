@@ -0,0 +1,30 @@
+"""Evento send_message."""
+import pytest
+
+
+@pytest.fixture
+def socket(chat, db):
+    client = chat.app.test_client()
+    with client.session_transaction() as session:
+        session.update(user_id=1, username='alice', current_room_id=1, current_room_name='geral')
+    socket = chat.socketio.test_client(chat.app, flask_test_client=client)
+    socket.emit('join_room_event', {'room_id': 1})
+    socket.get_received()
+    yield socket
+    socket.disconnect()
+    chat.message_writer.stop()
+
+
+@pytest.mark.parametrize('room_id', ['abc', None, [1], 0, -3, 10 ** 30])
+def test_invalid_room_id_is_rejected(chat, db, socket, room_id):
+    socket.emit('send_message', {'room_id': room_id, 'message': 'olá'})
+    assert socket.get_received() == []
+    assert db.execute('SELECT COUNT(*) FROM mensagens').fetchone()[0] == 0
+
+
+def test_room_id_is_coerced_to_int(chat, db, socket, monkeypatch):
+    monkeypatch.setitem(chat.app.config, 'MESSAGE_WRITE_MODE', 'sync')
+    socket.emit('send_message', {'room_id': '1', 'message': 'olá'})
+    events = {event['name']: event['args'][0] for event in socket.get_received()}
+    assert events['new_message']['room_id'] == 1
+    assert events['messages_persisted']['ids'][0][1] == 1
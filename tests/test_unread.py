@@ -0,0 +1,31 @@
+"""Cursores de leitura e contagem de não lidas."""
+
+
+def mark_read(chat, message_id):
+    with chat.app.app_context():
+        return chat.mark_room_read(1, 1, message_id)
+
+
+def test_cursor_is_clamped_to_the_last_message(chat, db, add_messages):
+    ids = add_messages(['a', 'b', 'c'])
+    cursor = mark_read(chat, 10 ** 12)
+    assert cursor == {'room_id': 1, 'last_read_id': ids[-1], 'read_count': 3}
+
+    # O cursor não ficou preso no id inventado: continua avançando com a sala
+    ids += add_messages(['d'])
+    assert mark_read(chat, ids[-1])['last_read_id'] == ids[-1]
+
+
+def test_cursor_counts_archived_messages(chat, db, add_messages):
+    ids = add_messages([f'mensagem {i}' for i in range(10)])
+    assert chat.archive_room(db, 1, ids[-1], 10) == 10
+
+    cursor = mark_read(chat, 10 ** 12)
+
+    assert cursor['last_read_id'] == ids[-1]
+    with chat.app.app_context():
+        assert chat.get_unread_counts(1)[1]['unread_count'] == 0
+
+
+def test_cursor_of_an_empty_room_does_not_take_the_client_id(chat, db):
+    assert mark_read(chat, 10 ** 12)['last_read_id'] == 0